@@ -0,0 +1,44 @@
+"""Lookups per second of a HashRing for each built-in hash_fn.
+
+Run from the Ex2 directory:
+
+    python -m benchmarks.bench_hash_functions [nodes] [lookups]
+"""
+import sys
+import time
+
+from cache_app.hash_ring import HASH_FUNCTIONS, HashRing
+
+
+def measure(ring, keys, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for key in keys:
+            ring.get_node(key)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(keys) / best
+
+
+def main(node_count=48, lookups=100000):
+    names = [f"node-{i}" for i in range(node_count)]
+    keys = [f"key-{i}" for i in range(lookups)]
+
+    print(f"nodes={node_count} lookups={lookups}")
+    print(f"{'hash_fn':12}{'points':>10}{'hash (ns)':>12}{'lookups/s':>14}")
+    for name in HASH_FUNCTIONS:
+        try:
+            ring = HashRing(names, hash_fn=name)
+        except ImportError as e:
+            print(f"{name:12}  skipped: {e}")
+            continue
+        start = time.perf_counter()
+        for key in keys:
+            ring.hashi(key)
+        hash_ns = (time.perf_counter() - start) / len(keys) * 1e9
+        print(f"{name:12}{ring.size:10}{hash_ns:12.0f}{measure(ring, keys):14.0f}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
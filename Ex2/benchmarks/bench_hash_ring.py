@@ -0,0 +1,147 @@
+"""Microbenchmark of the array-backed continuum against the legacy dict ring,
+checking the incremental preference table against a rebuild on churn.
+
+Run from the Ex2 directory:
+
+    python -m benchmarks.bench_hash_ring [nodes] [lookups]
+"""
+import random
+import sys
+import time
+import tracemalloc
+from bisect import bisect
+from hashlib import md5
+
+from cache_app.hash_ring import HashRing
+
+
+class LegacyRing:
+    """The previous MetaRing layout: {md5 int: nodename} plus a sorted key list."""
+
+    def __init__(self, nodes, vnodes=160):
+        self._nodes = {name: {"nodename": name} for name in nodes}
+        self._ring = {}
+        for name in nodes:
+            for w in range(vnodes):
+                self._ring[self.hashi(f"{name}-{w}")] = name
+        self._keys = sorted(self._ring.keys())
+
+    @staticmethod
+    def hashi(key):
+        return int(md5(str(key).encode("utf-8")).hexdigest(), 16)
+
+    def _get_pos(self, key):
+        p = bisect(self._keys, self.hashi(key))
+        return 0 if p == len(self._keys) else p
+
+    def _get(self, key, what):
+        if not self._ring:
+            return None
+        pos = self._get_pos(key)
+        nodename = self._ring[self._keys[pos]]
+        if what == "nodename":
+            return nodename
+        return self._nodes[nodename]
+
+    def get_node(self, key):
+        return self._get(key, "nodename")
+
+    def range(self, key, size):
+        all_nodes = set()
+        pos = self._get_pos(key)
+        for k in self._keys[pos:]:
+            nodename = self._ring[k]
+            if nodename in all_nodes:
+                continue
+            all_nodes.add(nodename)
+            yield self._nodes[nodename]
+            if len(all_nodes) == size:
+                break
+        else:
+            for i, k in enumerate(self._keys):
+                if i < pos:
+                    nodename = self._ring[k]
+                    if nodename in all_nodes:
+                        continue
+                    all_nodes.add(nodename)
+                    yield self._nodes[nodename]
+                    if len(all_nodes) == size:
+                        break
+
+
+def build_current(names):
+    ring = HashRing()
+    for name in names:
+        ring.add_node(name, {"instance": name})
+    return ring
+
+
+def check_preferences(names, changes=200, seed=0):
+    """Apply random joins, leaves and weight changes, checking after each
+    that the incrementally updated preference table matches a rebuild.
+    """
+    rng = random.Random(seed)
+    for preference_size in (2, 3):
+        ring = HashRing(preference_size=preference_size)
+        for _ in range(changes):
+            name = rng.choice(names)
+            if name in ring.nodes and rng.random() < 0.5:
+                ring.remove_node(name)
+            else:
+                ring.add_node(name, {"vnodes": rng.choice([5, 10, 160]), "weight": rng.randint(1, 3)})
+            rebuilt = ring.runtime.copy()
+            rebuilt._build_preferences()
+            assert ring.runtime._preferences == rebuilt._preferences
+            if ring.nodes:
+                for key in ("a", "b", "c"):
+                    assert len(list(ring.range(key, preference_size))) == min(
+                        preference_size, len(ring.nodes))
+
+
+def measure_memory(build, names):
+    tracemalloc.start()
+    ring = build(names)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ring, size
+
+
+def measure_lookups(fn, keys, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for key in keys:
+            fn(key)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(keys) * 1e9
+
+
+def main(node_count=48, lookups=100000):
+    names = [f"node-{i}" for i in range(node_count)]
+    keys = [f"key-{i}" for i in range(lookups)]
+
+    legacy, legacy_mem = measure_memory(LegacyRing, names)
+    current, current_mem = measure_memory(build_current, names)
+
+    for key in keys[:1000]:
+        assert legacy.get_node(key) == current.get_node(key)
+    check_preferences(names[:6])
+
+    print(f"nodes={node_count} points={current.size} lookups={lookups}")
+    print(f"{'':24}{'legacy':>12}{'array':>12}")
+    print(f"{'memory (KiB)':24}{legacy_mem / 1024:12.1f}{current_mem / 1024:12.1f}")
+    print("{:24}{:12.0f}{:12.0f}".format(
+        "get_node (ns/op)",
+        measure_lookups(legacy.get_node, keys),
+        measure_lookups(current.get_node, keys),
+    ))
+    print("{:24}{:12.0f}{:12.0f}".format(
+        "range size=2 (ns/op)",
+        measure_lookups(lambda k: list(legacy.range(k, 2)), keys),
+        measure_lookups(lambda k: list(current.range(k, 2)), keys),
+    ))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,148 @@
+"""Bytes on the wire and operations per second of the peer operations
+over the JSON HTTP client and over the binary protocol.
+
+A single node serves both protocols, each reached through a proxy
+counting the bytes of both directions. Run from the Ex2 directory:
+
+    python -m benchmarks.bench_protocol [threads] [operations] [value bytes]
+"""
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cache_app.datanode import DataNodeClient
+from cache_app.wire import BinaryDataNodeClient
+
+PORT = 18301
+PORT_OFFSET = 1000
+# the clients reach the node through counting proxies listening on
+# port + PROXY_OFFSET
+PROXY_OFFSET = 200
+BATCH = 100
+
+
+class CountingProxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, upstream):
+        self.upstream = upstream
+        self.bytes = 0
+        super().__init__(("127.0.0.1", port), ProxyHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class ProxyHandler(socketserver.BaseRequestHandler):
+
+    def pipe(self, src, dst):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                self.server.bytes += len(data)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            dst.close()
+
+    def handle(self):
+        upstream = socket.create_connection(("127.0.0.1", self.server.upstream))
+        for sock in (upstream, self.request):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self.pipe, args=(upstream, self.request), daemon=True).start()
+        self.pipe(self.request, upstream)
+
+
+def start_node(membership_file):
+    env = dict(
+        os.environ, INSTANCE_ID="a", PORT=str(PORT), MEMBERSHIP_FILE=membership_file,
+        PEER_PROTOCOL="binary", BINARY_PORT_OFFSET=str(PORT_OFFSET),
+        SERVER_WORKER_CLASS="gthread",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "cache_app/gunicorn.conf.py",
+         "cache_app.app:app"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{PORT}/health")
+            socket.create_connection(("127.0.0.1", PORT + PORT_OFFSET)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process
+
+
+def workloads(value_size):
+    value = "v" * value_size
+
+    def set_replica(client, dns, i):
+        client.set_replica(dns, f"key-{i}", value, time.time() + 600)
+
+    def get(client, dns, i):
+        assert client.get(dns, f"key-{i}") == value
+
+    def set_replicas(client, dns, i):
+        client.set_replicas(dns, [
+            {"key": f"batch-{i}-{j}", "value": value, "expires_at": None} for j in range(BATCH)
+        ])
+
+    def get_many(client, dns, i):
+        assert len(client.get_many(dns, [f"batch-{i}-{j}" for j in range(BATCH)])) == BATCH
+
+    return [
+        ("set_replica", 1, set_replica), ("get", 1, get),
+        ("set_replicas", BATCH, set_replicas), ("get_many", BATCH, get_many),
+    ]
+
+
+def run(client, dns, proxy, operation, threads, count):
+    proxy.bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda i: operation(client, dns, i), range(count)))
+    elapsed = time.perf_counter() - start
+    return count / elapsed, proxy.bytes / count
+
+
+def main(threads=16, operations=5000, value_size=100):
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"nodes": {"a": f"127.0.0.1:{PORT}"}}, f)
+    node = start_node(f.name)
+    proxy_port = PORT + PROXY_OFFSET
+    http_proxy = CountingProxy(proxy_port, PORT)
+    binary_proxy = CountingProxy(proxy_port + PORT_OFFSET, PORT + PORT_OFFSET)
+    dns = f"127.0.0.1:{proxy_port}"
+    protocols = [
+        ("json/http", DataNodeClient(pool_size=threads), http_proxy),
+        ("binary", BinaryDataNodeClient(port_offset=PORT_OFFSET), binary_proxy),
+    ]
+
+    print(f"threads={threads} operations={operations} value={value_size} bytes,"
+          f" batches of {BATCH} keys")
+    print(f"{'operation':14}{'protocol':11}{'ops/s':>10}{'keys/s':>10}{'bytes/op':>10}")
+    try:
+        for name, keys, operation in workloads(value_size):
+            count = max(operations // keys, 10)
+            for protocol, client, proxy in protocols:
+                rate, size = run(client, dns, proxy, operation, threads, count)
+                print(f"{name:14}{protocol:11}{rate:10.0f}{rate * keys:10.0f}{size:10.0f}")
+    finally:
+        node.terminate()
+        node.wait()
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
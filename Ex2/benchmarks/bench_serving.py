@@ -0,0 +1,162 @@
+"""Requests per second of a local 3 node cluster for each serving mode:
+the Werkzeug development server (`flask run`) and gunicorn with the gthread
+and gevent workers.
+
+Each client request is a GET of a key stored on other nodes, so it costs a
+peer round-trip, optionally slowed down by a proxy adding a delay to each
+peer response. Run from the Ex2 directory:
+
+    python -m benchmarks.bench_serving [concurrency] [seconds] [peer delay ms]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import json  # noqa: E402
+import os  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+import requests  # noqa: E402
+from gevent.server import StreamServer  # noqa: E402
+
+from cache_app.hash_ring import HashRing  # noqa: E402
+
+NODES = {"a": 18201, "b": 18202, "c": 18203}
+# peers reach each other through a delaying proxy listening on port + 100
+PROXY_OFFSET = 100
+
+SERVERS = {
+    "werkzeug": [
+        sys.executable, "-c",
+        "import os; from cache_app.app import app; "
+        "app.run(port=int(os.environ['PORT']), threaded=True)",
+    ],
+    "gunicorn gthread": [
+        sys.executable, "-m", "gunicorn", "--config", "cache_app/gunicorn.conf.py",
+        "cache_app.app:app",
+    ],
+    "gunicorn gevent": [
+        sys.executable, "-m", "gunicorn", "--config", "cache_app/gunicorn.conf.py",
+        "cache_app.app:app",
+    ],
+}
+
+
+def delay_proxy(port, delay):
+    """Forward the connections of port + PROXY_OFFSET to port, delaying
+    each chunk of the responses.
+    """
+    def pipe(src, dst, delayed):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                if delayed:
+                    gevent.sleep(delay)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            dst.close()
+
+    def handle(client, address):
+        upstream = socket.create_connection(("127.0.0.1", port))
+        gevent.spawn(pipe, upstream, client, True)
+        pipe(client, upstream, False)
+
+    server = StreamServer(("127.0.0.1", port + PROXY_OFFSET), handle)
+    server.start()
+    return server
+
+
+def start_cluster(server, membership_file):
+    processes = []
+    for name, port in NODES.items():
+        env = dict(
+            os.environ, INSTANCE_ID=name, PORT=str(port),
+            MEMBERSHIP_FILE=membership_file, MEMBERSHIP_INTERVAL="0.5",
+            SERVER_WORKER_CLASS=server.split()[-1],
+        )
+        processes.append(subprocess.Popen(
+            SERVERS[server], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    session = requests.Session()
+    for port in NODES.values():
+        for _ in range(100):
+            try:
+                if session.get(f"http://127.0.0.1:{port}/stats").json()["membership"]["nodes"] == 3:
+                    break
+            except (requests.ConnectionError, ValueError):
+                pass
+            time.sleep(0.1)
+    return processes
+
+
+def load(keys, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    def client():
+        nonlocal errors
+        session = requests.Session()
+        i = 0
+        while time.perf_counter() < deadline:
+            key = keys[i % len(keys)]
+            i += 1
+            start = time.perf_counter()
+            res = session.get(f"http://127.0.0.1:{NODES['a']}/get/{key}")
+            latencies.append(time.perf_counter() - start)
+            if res.status_code != 200:
+                errors += 1
+
+    gevent.joinall([gevent.spawn(client) for _ in range(concurrency)])
+    latencies.sort()
+    return (
+        len(latencies) / duration,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+        errors,
+    )
+
+
+def main(concurrency=64, duration=10, peer_delay=0):
+    ring = HashRing(list(NODES), preference_size=2)
+    # keys node "a" does not hold, each read goes to a peer
+    keys = [
+        f"key-{i}" for i in range(5000)
+        if "a" not in [node["nodename"] for node in ring.range(f"key-{i}", 2)]
+    ]
+    proxies = [delay_proxy(port, peer_delay / 1000) for port in NODES.values()]
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"nodes": {
+            name: f"127.0.0.1:{port + PROXY_OFFSET}" for name, port in NODES.items()
+        }}, f)
+
+    print(f"concurrency={concurrency} duration={duration}s peer delay={peer_delay}ms,"
+          f" remote GETs on one node")
+    print(f"{'server':18}{'req/s':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}{'errors':>8}")
+    for server in SERVERS:
+        processes = start_cluster(server, f.name)
+        try:
+            requests.post(f"http://127.0.0.1:{NODES['b']}/mset",
+                          json={"items": {key: "value" for key in keys}})
+            rate, p50, p99, errors = load(keys, concurrency, duration)
+            print(f"{server:18}{rate:10.0f}{p50:10.1f}{p99:10.1f}{errors:8}")
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+    for proxy in proxies:
+        proxy.stop()
+    os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,64 @@
+"""Operations per second of the node storage accessed by many threads:
+a StorageEngine behind a single lock vs. the lock-striped ShardedStorage.
+
+Run from the Ex2 directory:
+
+    python -m benchmarks.bench_storage [threads] [operations per thread]
+"""
+import random
+import sys
+import threading
+import time
+
+from cache_app.storage import ShardedStorage, StorageEngine
+
+
+class LockedStorage:
+    """A StorageEngine behind a global lock, the baseline."""
+
+    def __init__(self):
+        self.engine = StorageEngine()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.engine.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            return self.engine.set(key, value)
+
+
+def run(storage, threads, operations, keys):
+    def worker(seed):
+        rnd = random.Random(seed)
+        for _ in range(operations):
+            key = keys[rnd.randrange(len(keys))]
+            if rnd.random() < 0.2:
+                storage.set(key, "value")
+            else:
+                storage.get(key)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * operations / (time.perf_counter() - start)
+
+
+def main(threads=16, operations=20000):
+    keys = [f"key-{i}" for i in range(10000)]
+    print(f"threads={threads} operations={threads * operations} (80% get)")
+    print(f"{'storage':24}{'ops/s':>12}{'contention':>12}")
+    print(f"{'global lock':24}{run(LockedStorage(), threads, operations, keys):12.0f}{'':>12}")
+    for shards in (1, 16, 64):
+        storage = ShardedStorage(shards=shards)
+        rate = run(storage, threads, operations, keys)
+        contention = storage.stats()["contention_rate"]
+        print(f"{f'sharded shards={shards}':24}{rate:12.0f}{contention:12.2%}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
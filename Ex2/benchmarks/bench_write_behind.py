@@ -0,0 +1,93 @@
+"""Write throughput of a local 3 node cluster with synchronous replica
+writes and with write-behind batching of the replica writes.
+
+Concurrent clients SET keys through one node, each write costs a replica
+write to a peer, optionally slowed down by a proxy adding a delay to each
+peer response. Run from the Ex2 directory:
+
+    python -m benchmarks.bench_write_behind [concurrency] [seconds] [peer delay ms]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import json  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+import requests  # noqa: E402
+
+from benchmarks.bench_serving import NODES, PROXY_OFFSET, delay_proxy, start_cluster  # noqa: E402
+
+MODES = {
+    "synchronous": {"WRITE_BEHIND": "0"},
+    "write-behind": {"WRITE_BEHIND": "1"},
+}
+
+
+def load(concurrency, duration, keys=10000):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        nonlocal errors
+        session = requests.Session()
+        i = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            res = session.post(f"http://127.0.0.1:{NODES['a']}/set",
+                               json={"key": f"key-{i % keys}", "value": "value"})
+            latencies.append(time.perf_counter() - start)
+            if res.status_code != 200:
+                errors += 1
+            i += concurrency
+
+    gevent.joinall([gevent.spawn(client, offset) for offset in range(concurrency)])
+    latencies.sort()
+    return (
+        len(latencies) / duration,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+        errors,
+    )
+
+
+def main(concurrency=64, duration=10, peer_delay=0):
+    proxies = [delay_proxy(port, peer_delay / 1000) for port in NODES.values()]
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"nodes": {
+            name: f"127.0.0.1:{port + PROXY_OFFSET}" for name, port in NODES.items()
+        }}, f)
+
+    print(f"concurrency={concurrency} duration={duration}s peer delay={peer_delay}ms,"
+          f" SETs on one node")
+    print(f"{'mode':14}{'req/s':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}{'errors':>8}"
+          f"{'peer reqs':>11}{'batch':>7}{'lag (ms)':>10}")
+    for mode, env in MODES.items():
+        os.environ.update(env)
+        processes = start_cluster("gunicorn gevent", f.name)
+        try:
+            rate, p50, p99, errors = load(concurrency, duration)
+            stats = requests.get(f"http://127.0.0.1:{NODES['a']}/stats").json()
+            peer_requests = sum(peer["requests"] for peer in stats["client"]["peers"].values())
+            write_behind = stats["write_behind"]
+            batch = write_behind["mean_batch_size"] if write_behind else 1
+            lag = write_behind["lag_ewma_ms"] if write_behind else 0
+            print(f"{mode:14}{rate:10.0f}{p50:10.1f}{p99:10.1f}{errors:8}"
+                  f"{peer_requests:11}{batch or 0:7.1f}{lag:10.1f}")
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+    for proxy in proxies:
+        proxy.stop()
+    os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
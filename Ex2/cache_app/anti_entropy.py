@@ -0,0 +1,503 @@
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+
+from .storage import entry_size
+from .wire import write_entry
+
+# leaves of each continuum segment, split by the low bits of the key
+# points, so that a divergent leaf only lists a part of its segment
+LEAVES_PER_SEGMENT = 16
+EMPTY = 0
+# the pending change of a removed key
+REMOVED = object()
+
+
+class TopologyMismatch(Exception):
+    """The peer routes with another version of the ring."""
+
+
+def entry_digest(key, value, expires_at):
+    buf = bytearray()
+    write_entry(buf, str(key), value, expires_at)
+    return int.from_bytes(blake2b(buf, digest_size=16).digest(), "big")
+
+
+def node_hash(left, right):
+    if left == EMPTY and right == EMPTY:
+        return EMPTY
+    data = left.to_bytes(16, "big") + right.to_bytes(16, "big")
+    return int.from_bytes(blake2b(data, digest_size=16).digest(), "big")
+
+
+class MerkleIndex:
+    """Digests of the stored entries, grouped in leaves by continuum segment
+    and kept up to date as the storage changes (a storage listener).
+
+    The hash of a leaf is the XOR of the digests of its keys, so that a
+    change updates it in O(1). The hash tree of the segments this node
+    replicates with a peer is built over these leaves when they compare.
+
+    A write only records the change of its key in a pending dict, with a
+    single atomic assignment replacing the previous change of the key and
+    no lock. The changes are hashed and folded into the leaves when the
+    index is read by anti-entropy, off the write path.
+
+    Keys are named by their str, the form they take in the JSON key lists
+    exchanged with the peers. The keys removed here (deleted, evicted or
+    released after a rebalance) leave a tombstone, so that the peers do not
+    copy them back unless they were written since.
+    """
+
+    def __init__(self, instance_id, hash_ring, replicas, max_tombstones=10000):
+        """
+        :param replicas: the number of replicas of each key.
+        :param max_tombstones: the number of removed keys remembered, the
+                               oldest ones are forgotten first.
+        """
+        self.instance_id = instance_id
+        self.hash_ring = hash_ring
+        self.replicas = replicas
+        self.max_tombstones = max_tombstones
+        # key name -> (point, digest, written_at, expires_at, key)
+        self._entries = {}
+        # key name -> (point, removed_at), oldest removal first
+        self._tombstones = OrderedDict()
+        # key name -> (key, value or REMOVED, expires_at, time of the write
+        # or of the removal) of the changes not folded yet
+        self._pending = {}
+        # guards the entries, the tombstones and the leaves
+        self._lock = threading.Lock()
+        # names of the keys changed while a refresh rebuilds the leaves,
+        # None outside of a refresh
+        self._changed = None
+        self._refresh_lock = threading.Lock()
+
+        # the leaves are those of the segments of this continuum
+        self._runtime = None
+        self._leaves = []
+        # leaf -> its keys
+        self._members = {}
+        # peer -> continuum positions whose replicas are this node and the peer
+        self._shared = {}
+        # digest of the continuum, the nodes compare the same segments when equal
+        self.topology = None
+        self.rebuilds = 0
+
+    def _leaf(self, point, pos):
+        return pos * LEAVES_PER_SEGMENT + point % LEAVES_PER_SEGMENT
+
+    @staticmethod
+    def _add(leaves, members, leaf, name, digest):
+        leaves[leaf] ^= digest
+        members.setdefault(leaf, set()).add(name)
+
+    @staticmethod
+    def _remove(leaves, members, leaf, name, digest):
+        leaves[leaf] ^= digest
+        leaf_members = members[leaf]
+        leaf_members.discard(name)
+        if not leaf_members:
+            del members[leaf]
+
+    def stored(self, key, value, expires_at, written_at):
+        self._pending[str(key)] = (key, value, expires_at, written_at)
+
+    def removed(self, key):
+        self._pending[str(key)] = (key, REMOVED, None, time.time())
+
+    def _fold(self):
+        """Apply the pending changes to the entries, the tombstones and the
+        leaves, under the lock.
+        """
+        # popitem() is atomic, a change recorded meanwhile stays pending and
+        # those recorded during the fold are left to the next one
+        pending = self._pending
+        for _ in range(len(pending)):
+            try:
+                name, (key, value, expires_at, at) = pending.popitem()
+            except KeyError:
+                break
+            previous = self._entries.pop(name, None)
+            point = previous[0] if previous is not None else self.hash_ring.hashi(key)
+            leaf = self._leaf(point, self._runtime.position(point)) if self._leaves else None
+            if previous is not None and leaf is not None:
+                self._remove(self._leaves, self._members, leaf, name, previous[1])
+            if self._changed is not None:
+                self._changed.add(name)
+            self._tombstones.pop(name, None)
+            if value is REMOVED:
+                self._tombstones[name] = (point, at)
+                if len(self._tombstones) > self.max_tombstones:
+                    self._tombstones.popitem(last=False)
+                continue
+            digest = entry_digest(name, value, expires_at)
+            self._entries[name] = (point, digest, at, expires_at, key)
+            if leaf is not None:
+                self._add(self._leaves, self._members, leaf, name, digest)
+
+    def flush(self):
+        """Fold the changes recorded since the last read of the index."""
+        with self._lock:
+            self._fold()
+
+    def refresh(self):
+        """Regroup the digests by the segments of the current continuum,
+        after a membership change. The leaves are rebuilt out of the lock
+        from a copy of the digests, then the keys written meanwhile are
+        moved to their current digest.
+        """
+        with self._refresh_lock:
+            runtime = self.hash_ring.runtime
+            if runtime is not self._runtime:
+                self._refresh(runtime)
+            else:
+                self.flush()
+
+    def _refresh(self, runtime):
+        shared = {}
+        for pos in range(len(runtime._keys)):
+            successors = runtime.successors(pos, self.replicas)
+            if self.instance_id in successors:
+                for nodename in successors:
+                    if nodename != self.instance_id:
+                        shared.setdefault(nodename, []).append(pos)
+        topology = blake2b(runtime._keys.tobytes(), digest_size=16)
+        for nodename in sorted(runtime._nodes):
+            topology.update(nodename.encode())
+
+        with self._lock:
+            self._fold()
+            entries = dict(self._entries)
+            self._changed = set()
+        leaves = [EMPTY] * (len(runtime._keys) * LEAVES_PER_SEGMENT)
+        members = {}
+        if leaves:
+            names = list(entries)
+            points = [entries[name][0] for name in names]
+            for name, point, pos in zip(names, points, runtime.positions(points)):
+                self._add(leaves, members, self._leaf(point, pos), name, entries[name][1])
+
+        with self._lock:
+            self._fold()
+            if leaves:
+                for name in self._changed:
+                    before, after = entries.get(name), self._entries.get(name)
+                    if before is not None:
+                        leaf = self._leaf(before[0], runtime.position(before[0]))
+                        self._remove(leaves, members, leaf, name, before[1])
+                    if after is not None:
+                        leaf = self._leaf(after[0], runtime.position(after[0]))
+                        self._add(leaves, members, leaf, name, after[1])
+            self._changed = None
+            self._runtime = runtime
+            self._leaves = leaves
+            self._members = members
+            self._shared = shared
+            self.topology = topology.hexdigest()
+            self.rebuilds += 1
+
+    def peers(self):
+        """Returns the nodes this node shares replicas with."""
+        return sorted(self._shared)
+
+    def _check(self, topology):
+        if topology != self.topology:
+            raise TopologyMismatch(f"ring {topology} differs from the local ring {self.topology}")
+
+    def tree(self, peer, topology=None):
+        """Returns the hash tree of the leaves shared with the peer, as a
+        heap ordered list (root at 1, children of i at 2i and 2i + 1), and
+        the number of keys of its leaves.
+        """
+        with self._lock:
+            if topology is not None:
+                self._check(topology)
+            self._fold()
+            leaves = [
+                pos * LEAVES_PER_SEGMENT + i
+                for pos in self._shared.get(peer, ()) for i in range(LEAVES_PER_SEGMENT)
+            ]
+            hashes = [self._leaves[leaf] for leaf in leaves]
+            keys = sum(len(self._members.get(leaf, ())) for leaf in leaves)
+        width = 1 << max(0, len(hashes) - 1).bit_length()
+        tree = [EMPTY] * width + hashes + [EMPTY] * (width - len(hashes))
+        for i in range(width - 1, 0, -1):
+            tree[i] = node_hash(tree[2 * i], tree[2 * i + 1])
+        return tree, keys
+
+    def keys(self, peer, leaves, topology=None):
+        """Returns the {key name: (digest, written_at)} of the live keys of
+        the given leaves of the tree shared with the peer, and the
+        {key name: (None, removed_at)} of their removed keys.
+        """
+        now = time.time()
+        keys = {}
+        with self._lock:
+            if topology is not None:
+                self._check(topology)
+            self._fold()
+            shared = self._shared.get(peer, [])
+            wanted = {
+                shared[leaf // LEAVES_PER_SEGMENT] * LEAVES_PER_SEGMENT + leaf % LEAVES_PER_SEGMENT
+                for leaf in leaves if leaf // LEAVES_PER_SEGMENT < len(shared)
+            }
+            if wanted:
+                for name, (point, removed_at) in self._tombstones.items():
+                    if self._leaf(point, self._runtime.position(point)) in wanted:
+                        keys[name] = (None, removed_at)
+            for leaf in wanted:
+                for name in self._members.get(leaf, ()):
+                    _, digest, written_at, expires_at, _ = self._entries[name]
+                    if expires_at is None or expires_at > now:
+                        keys[name] = (digest, written_at)
+        return keys
+
+    def written_at(self, key):
+        """Returns the write time of the stored value of the key, None when
+        the key is missing, as of the last flush.
+        """
+        entry = self._entries.get(str(key))
+        return entry[2] if entry is not None else None
+
+    def removed_at(self, key):
+        """Returns when the key was last removed here, None when it was not
+        or its tombstone was forgotten, as of the last flush.
+        """
+        tombstone = self._tombstones.get(str(key))
+        return tombstone[1] if tombstone is not None else None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AntiEntropy:
+    """Compare the keys this node replicates with each peer, one peer per
+    round, and repair those that differ.
+
+    The nodes walk down their hash trees a few levels per round-trip,
+    following the subtrees whose hashes differ, then list the keys of the
+    divergent leaves only and transfer the divergent keys only: the repair
+    traffic follows the divergence, not the number of keys. The most
+    recently written value wins, on a tie the one of the node whose
+    instance id sorts first. A key removed on one side is only copied back
+    when the other side wrote it after the removal.
+    """
+
+    def __init__(self, instance_id, hash_ring, storage, index: MerkleIndex, client,
+                 levels=4, max_repair_keys=1000):
+        """
+        :param storage: the storage the index listens to.
+        :param levels: tree levels compared per round-trip.
+        :param max_repair_keys: maximum number of keys repaired per round,
+                                the others are left to the next rounds.
+        """
+        self.instance_id = instance_id
+        self.hash_ring = hash_ring
+        self.storage = storage
+        self.index = index
+        self.client = client
+        self.levels = levels
+        self.max_repair_keys = max_repair_keys
+        self._next_peer = 0
+
+        self.rounds = 0
+        self.in_sync_rounds = 0
+        self.failed_rounds = 0
+        self.topology_mismatches = 0
+        self.hashes_compared = 0
+        self.leaves_compared = 0
+        self.shared_keys = 0
+        self.divergent_keys = 0
+        self.released_keys = 0
+        self.pushed_keys = 0
+        self.pulled_keys = 0
+        self.deferred_keys = 0
+        self.repair_bytes = 0
+        self.last_round = None
+
+    def run(self):
+        """Compare the replicas shared with the next peer."""
+        self.index.refresh()
+        peers = [peer for peer in self.index.peers() if self.hash_ring.nodes.get(peer, {}).get('instance')]
+        if not peers:
+            return
+        peer = peers[self._next_peer % len(peers)]
+        self._next_peer += 1
+        try:
+            self.sync(peer)
+        except Exception:
+            self.failed_rounds += 1
+
+    def sync(self, peer):
+        """Compare and repair the replicas shared with the peer. Returns the
+        number of divergent keys, None when the peer routes with another ring.
+        """
+        private_dns = self.hash_ring.nodes[peer]['instance'].private_dns
+        topology = self.index.topology
+        tree, keys = self.index.tree(peer)
+        width = len(tree) // 2
+        self.rounds += 1
+        self.shared_keys += keys
+        round_stats = {'peer': peer, 'shared_keys': keys, 'round_trips': 0}
+        self.last_round = round_stats
+
+        # walk down the subtrees whose hashes differ, from the root
+        frontier = self._compare(private_dns, topology, tree, [1])
+        round_stats['round_trips'] += 1
+        while frontier and frontier[0] < width:
+            step = min(self.levels, width.bit_length() - frontier[0].bit_length())
+            indexes = [child for i in frontier for child in range(i << step, (i + 1) << step)]
+            frontier = self._compare(private_dns, topology, tree, indexes)
+            round_stats['round_trips'] += 1
+        if frontier is None:
+            self.topology_mismatches += 1
+            return None
+
+        if not frontier:
+            self.in_sync_rounds += 1
+            round_stats['divergent_keys'] = 0
+            return 0
+        leaves = [i - width for i in frontier]
+        self.leaves_compared += len(leaves)
+        remote = self.client.leaf_keys(private_dns, self.instance_id, topology, leaves)
+        round_stats['round_trips'] += 1
+        if remote is None:
+            self.topology_mismatches += 1
+            return None
+        local = self.index.keys(peer, leaves)
+
+        push, pull = [], []
+        for name in set(local).union(remote):
+            mine, theirs = local.get(name), remote.get(name)
+            mine_live = mine is not None and mine[0] is not None
+            theirs_live = theirs is not None and theirs[0] is not None
+            if mine_live and theirs_live:
+                if mine[0] == int(theirs[0], 16):
+                    continue
+                newer = self._wins(mine[1], theirs[1], peer)
+            elif mine_live or theirs_live:
+                # a side that removed the key only gets it back when it was
+                # written after the removal
+                removed, live = (theirs, mine) if mine_live else (mine, theirs)
+                if removed is not None and removed[1] >= live[1]:
+                    self.released_keys += 1
+                    continue
+                newer = mine_live
+            else:
+                continue
+            (push if newer else pull).append(name)
+        divergent = len(push) + len(pull)
+        self.divergent_keys += divergent
+        round_stats['divergent_keys'] = divergent
+
+        # the oldest divergences are repaired first when capped
+        budget = self.max_repair_keys
+        push, pull = push[:budget], pull[:max(0, budget - len(push))]
+        self.deferred_keys += divergent - len(push) - len(pull)
+        if push:
+            entries = self.entries(push)
+            self.client.repair(private_dns, self.instance_id, entries)
+            self.pushed_keys += len(entries)
+            self.repair_bytes += sum(entry_size(e['key'], e['value']) for e in entries)
+        if pull:
+            entries = self.client.fetch_entries(private_dns, pull)
+            self.apply(peer, entries)
+            self.pulled_keys += len(entries)
+            self.repair_bytes += sum(entry_size(e['key'], e['value']) for e in entries)
+        round_stats['round_trips'] += bool(push) + bool(pull)
+        return divergent
+
+    def _compare(self, private_dns, topology, tree, indexes):
+        """Returns the given tree nodes whose hash differs on the peer, None
+        when the peer routes with another ring.
+        """
+        remote = self.client.tree_hashes(private_dns, self.instance_id, topology, indexes)
+        if remote is None:
+            return None
+        self.hashes_compared += len(indexes)
+        return [i for i, h in zip(indexes, remote) if int(h, 16) != tree[i]]
+
+    def _wins(self, mine, theirs, peer):
+        """Returns whether the local value, written at `mine`, wins over the
+        one of the peer written at `theirs`.
+        """
+        if mine != theirs:
+            return mine > theirs
+        return self.instance_id < peer
+
+    def hashes(self, peer, topology, indexes):
+        """Returns the hex hashes of the given nodes of the tree shared with
+        the peer, raises TopologyMismatch when the peer routes with another ring.
+        """
+        tree, _ = self.index.tree(peer, topology)
+        return [format(tree[i] if i < len(tree) else EMPTY, '032x') for i in indexes]
+
+    def leaf_keys(self, peer, topology, leaves):
+        """Returns the {key: [hex digest, written_at]} of the given leaves of
+        the tree shared with the peer.
+        """
+        return {
+            name: [None if digest is None else format(digest, '032x'), written_at]
+            for name, (digest, written_at) in self.index.keys(peer, leaves, topology).items()
+        }
+
+    def entries(self, names):
+        """Returns the {'key', 'value', 'expires_at', 'written_at'} of the
+        keys of the given names stored here.
+        """
+        self.index.flush()
+        entries = []
+        for name in names:
+            entry = self.index._entries.get(name)
+            if entry is None:
+                continue
+            key = entry[4]
+            try:
+                value = self.storage[key]
+            except KeyError:
+                continue
+            entries.append({
+                'key': key, 'value': value, 'expires_at': entry[3], 'written_at': entry[2],
+            })
+        return entries
+
+    def apply(self, sender, entries):
+        """Store the repaired entries sent by a peer, unless the local value
+        was written, or the key removed, since.
+        """
+        self.index.flush()
+        for entry in entries:
+            key = entry['key']
+            current = self.index.written_at(key)
+            if current is None:
+                removed_at = self.index.removed_at(key)
+                if removed_at is not None and removed_at >= entry['written_at']:
+                    self.released_keys += 1
+                    continue
+            elif self._wins(current, entry['written_at'], sender):
+                continue
+            self.storage.set(key, entry['value'], entry.get('expires_at'), entry['written_at'])
+
+    def stats(self):
+        return {
+            'indexed_keys': len(self.index),
+            'tombstones': len(self.index._tombstones),
+            'index_rebuilds': self.index.rebuilds,
+            'rounds': self.rounds,
+            'in_sync_rounds': self.in_sync_rounds,
+            'failed_rounds': self.failed_rounds,
+            'topology_mismatches': self.topology_mismatches,
+            'hashes_compared': self.hashes_compared,
+            'leaves_compared': self.leaves_compared,
+            'shared_keys': self.shared_keys,
+            'divergent_keys': self.divergent_keys,
+            'divergence_rate': self.divergent_keys / self.shared_keys if self.shared_keys else None,
+            'released_keys': self.released_keys,
+            'pushed_keys': self.pushed_keys,
+            'pulled_keys': self.pulled_keys,
+            'deferred_keys': self.deferred_keys,
+            'repair_bytes': self.repair_bytes,
+            'last_round': self.last_round,
+        }
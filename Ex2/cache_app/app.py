@@ -1,10 +1,23 @@
+import ipaddress
+import json
 import os
+import time
+
 import boto3
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask, request
-from .coordinator import CacheCoordinator
-from .datanode import DataNodeSpecification
+from flask import Flask, Response, request, stream_with_context
+from .anti_entropy import AntiEntropy, MerkleIndex, TopologyMismatch
+from .coordinator import REPLICATION_FACTOR, CacheCoordinator, NodeDraining, QuorumNotReached
+from .datanode import DataNodeClient
 from .hash_ring import HashRing
+from .membership import ElbMembershipSource, FileMembershipSource, MembershipManager
+from .near_cache import NearCache
+from .persistence import PersistentStorage
+from .rebalance import Rebalancer
+from .single_flight import FlightTimeout
+from .storage import ShardedStorage
+from .wire import BinaryDataNodeClient, BinaryServer
+from .write_behind import WriteBehind
 
 session = boto3.Session(region_name='us-east-1')
 elb = session.client('elbv2')
@@ -14,48 +27,132 @@ app = Flask(__name__)
 
 instance_id = os.environ.get("INSTANCE_ID")
 
-# Initialize empty hash ring
-hash_ring = HashRing()
-coordinator = CacheCoordinator(hash_ring, instance_id)
-
+# Initialize empty hash ring, all the nodes must share the same hash function
+# RING_LOAD_FACTOR sends the reads of a replica loaded above (1 + factor)
+# times the average load to the next replica, unset to disable it
+load_factor = os.environ.get("RING_LOAD_FACTOR")
+hash_ring = HashRing(
+    hash_fn=os.environ.get("RING_HASH_FN", "md5"),
+    preference_size=REPLICATION_FACTOR,
+    load_factor=float(load_factor) if load_factor else None,
+    load_half_life=float(os.environ.get("RING_LOAD_HALF_LIFE", 10.0)),
+)
+# ANTI_ENTROPY_INTERVAL=0 disables the background repair of the replicas,
+# and the digests of the stored entries it compares with the peers
+anti_entropy_interval = float(os.environ.get("ANTI_ENTROPY_INTERVAL", 10))
+merkle_index = MerkleIndex(
+    instance_id, hash_ring, REPLICATION_FACTOR,
+    max_tombstones=int(os.environ.get("ANTI_ENTROPY_MAX_TOMBSTONES", 10000)),
+) if anti_entropy_interval else None
+max_bytes = os.environ.get("CACHE_MAX_BYTES")
+storage_options = dict(
+    max_bytes=int(max_bytes) if max_bytes else None,
+    policy=os.environ.get("CACHE_EVICTION_POLICY", "lru"),
+    shards=int(os.environ.get("CACHE_SHARDS", 16)),
+    listener=merkle_index,
+)
+# PERSIST_DIR keeps the keys across restarts in a log and a snapshot
+if os.environ.get("PERSIST_DIR"):
+    storage = PersistentStorage(
+        os.environ["PERSIST_DIR"],
+        fsync=os.environ.get("PERSIST_FSYNC", "everysec"),
+        max_log_bytes=int(os.environ.get("PERSIST_MAX_LOG_BYTES", 64 << 20)),
+        **storage_options,
+    )
+else:
+    storage = ShardedStorage(**storage_options)
+# the HTTP port of the node, and of the peers whose address has none
+port = int(os.environ.get("PORT", 8080))
+client_options = dict(
+    pool_size=int(os.environ.get("PEER_POOL_SIZE", 10)),
+    connect_timeout=float(os.environ.get("PEER_CONNECT_TIMEOUT", 0.5)),
+    read_timeout=float(os.environ.get("PEER_READ_TIMEOUT", 2.0)),
+    retries=int(os.environ.get("PEER_RETRIES", 2)),
+    default_port=port,
+)
+# PEER_PROTOCOL=binary sends the replica traffic as binary frames to a
+# listener on the HTTP port + BINARY_PORT_OFFSET, all the nodes must share it
+binary_port_offset = int(os.environ.get("BINARY_PORT_OFFSET", 1000))
+if os.environ.get("PEER_PROTOCOL", "http") == "binary":
+    client = BinaryDataNodeClient(
+        port_offset=binary_port_offset, **client_options)
+else:
+    client = DataNodeClient(**client_options)
+# NEAR_CACHE_BYTES=0 disables the near cache of remote values
+near_cache_bytes = int(os.environ.get("NEAR_CACHE_BYTES", 0))
+near_cache = NearCache(
+    near_cache_bytes, ttl=float(os.environ.get("NEAR_CACHE_TTL", 1.0))
+) if near_cache_bytes else None
+# WRITE_BEHIND=1 acknowledges the remote replica writes once queued and
+# sends them in batches of WRITE_BEHIND_BATCH_SIZE keys, or after
+# WRITE_BEHIND_INTERVAL seconds
+write_behind = WriteBehind(
+    client,
+    batch_size=int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 100)),
+    flush_interval=float(os.environ.get("WRITE_BEHIND_INTERVAL", 0.01)),
+    max_pending=int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 10000)),
+) if os.environ.get("WRITE_BEHIND", "0") == "1" else None
+rebalancer = Rebalancer(
+    instance_id, storage, client, REPLICATION_FACTOR,
+    chunk_size=int(os.environ.get("HANDOFF_CHUNK_SIZE", 500)),
+    concurrency=int(os.environ.get("HANDOFF_CONCURRENCY", 2)),
+    timeout=float(os.environ.get("HANDOFF_TIMEOUT", 60.0)),
+)
+coordinator = CacheCoordinator(
+    hash_ring, instance_id, storage, client,
+    write_quorum=int(os.environ.get("WRITE_QUORUM", REPLICATION_FACTOR)),
+    read_quorum=int(os.environ.get("READ_QUORUM", 1)),
+    max_workers=int(os.environ.get("REPLICA_WORKERS", 32)),
+    # HEDGE_DELAY=0 disables hedged reads
+    hedge_delay=float(os.environ.get("HEDGE_DELAY", 0.05)) or None,
+    hedge_percentile=float(os.environ.get("HEDGE_PERCENTILE", 95)),
+    near_cache=near_cache,
+    coalesce_timeout=float(os.environ.get("COALESCE_TIMEOUT", 5.0)),
+    rebalancer=rebalancer,
+    write_behind=write_behind,
+)
+binary_server = None
+if isinstance(client, BinaryDataNodeClient):
+    binary_server = BinaryServer(
+        coordinator, ("0.0.0.0", port + binary_port_offset),
+        workers=int(os.environ.get("REPLICA_WORKERS", 32)),
+    )
+    binary_server.start()
 
-def populate_datanode_state():
-    def get_targets_status():
-        target_group = elb.describe_target_groups(Names=["cache-elb-tg"])
-        target_group_arn = target_group["TargetGroups"][0]["TargetGroupArn"]
-        health = elb.describe_target_health(TargetGroupArn=target_group_arn)
-        healthy = []
-        sick = {}
-        for target in health["TargetHealthDescriptions"]:
-            if target["TargetHealth"]["State"] == "unhealthy":
-                sick[target["Target"]["Id"]] = target["TargetHealth"]["Description"]
-            else:
-                healthy.append(target["Target"]["Id"])
-        return healthy, sick
 
-    target_groups = get_targets_status()
+# where the cache nodes come from: the load balancer target group, or a
+# JSON file listing them for local clusters
+if os.environ.get("MEMBERSHIP_FILE"):
+    membership_source = FileMembershipSource(os.environ["MEMBERSHIP_FILE"])
+else:
+    membership_source = ElbMembershipSource(elb, ec2, "cache-elb-tg")
+membership = MembershipManager(hash_ring, membership_source, client, rebalancer, write_behind)
+anti_entropy = AntiEntropy(
+    instance_id, hash_ring, storage, merkle_index, client,
+    max_repair_keys=int(os.environ.get("ANTI_ENTROPY_MAX_KEYS", 1000)),
+) if merkle_index is not None else None
 
-    healthy = target_groups[0]
-    for healthy_instance in healthy:
-        private_dns = ec2.describe_instances(
-            InstanceIds=[healthy_instance]).get("Reservations")[0]['Instances'][0]['PrivateDnsName']
 
-        dn_config = {
-            'hostname': healthy_instance,
-            'instance': DataNodeSpecification(instance_id=healthy_instance, private_dns=private_dns)
-        }
+# the default number of keys of a /scan page
+SCAN_PAGE_SIZE = int(os.environ.get("SCAN_PAGE_SIZE", 1000))
 
-        hash_ring.add_node(healthy_instance, dn_config)
 
-    sick = list(target_groups[1].keys())
-    for sick_instance in sick:
-        # might be that the instance has registered but not yet initialized
-        if hash_ring.get_node(sick_instance):
-            hash_ring.remove_node(sick_instance)
+def populate_datanode_state():
+    membership.refresh()
 
 
 scheduler = BackgroundScheduler()
-scheduler.add_job(func=populate_datanode_state, trigger="interval", seconds=5)
+scheduler.add_job(
+    func=populate_datanode_state, trigger="interval",
+    seconds=float(os.environ.get("MEMBERSHIP_INTERVAL", 5)),
+)
+if anti_entropy is not None:
+    scheduler.add_job(func=anti_entropy.run, trigger="interval", seconds=anti_entropy_interval)
+if isinstance(storage, PersistentStorage):
+    scheduler.add_job(
+        func=storage.compact, trigger="interval",
+        seconds=float(os.environ.get("PERSIST_COMPACT_INTERVAL", 300)),
+    )
 scheduler.start()
 
 
@@ -64,34 +161,266 @@ def index():
     return "Hello cache!"
 
 
+def parse_ttl(data):
+    ttl = data.get('ttl')
+    if ttl is None:
+        return None
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+        raise ValueError("ttl should be a positive number of seconds")
+    return ttl
+
+
+def parse_key(key):
+    # the keys are logged, snapshotted and sent to the peers as strings
+    if not isinstance(key, str):
+        raise ValueError("key should be a string")
+    return key
+
+
+def parse_quorum(quorum):
+    if quorum is None:
+        return None
+    try:
+        quorum = int(quorum)
+    except (TypeError, ValueError):
+        quorum = 0
+    if quorum < 1:
+        raise ValueError("quorum should be a positive number of replicas")
+    return quorum
+
+
 @app.route('/set', methods=['POST'])
 def set_data():
     data = request.json
-    key = data['key']
     value = data['value']
-    coordinator.set(key, value)
+    try:
+        key = parse_key(data['key'])
+        ttl = parse_ttl(data)
+        write_quorum = parse_quorum(data.get('write_quorum'))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        coordinator.set(key, value, ttl, write_quorum)
+    except (QuorumNotReached, NodeDraining) as e:
+        return str(e), 503
     return ""
 
 
 @app.route('/set-replica', methods=['POST'])
 def set_replica():
     data = request.json
-    key = data['key']
     value = data['value']
-    coordinator.set_replica(key, value)
+    # replicas carry the absolute expiration time decided by the coordinator
+    expires_at = data.get('expires_at')
+    try:
+        key = parse_key(data['key'])
+        ttl = parse_ttl(data)
+    except ValueError as e:
+        return str(e), 400
+    if expires_at is None and ttl is not None:
+        expires_at = time.time() + ttl
+    coordinator.set_replica(key, value, expires_at, data.get('written_at'))
     return ""
 
 
+@app.route('/mset', methods=['POST'])
+def mset_data():
+    data = request.json
+    items = data['items']
+    try:
+        ttl = parse_ttl(data)
+        write_quorum = parse_quorum(data.get('write_quorum'))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        errors = coordinator.mset(items, ttl, write_quorum)
+    except NodeDraining as e:
+        return str(e), 503
+    return {'errors': errors}, 207 if errors else 200
+
+
+@app.route('/set-replicas', methods=['POST'])
+def set_replicas():
+    coordinator.set_replicas(request.json['entries'])
+    return ""
+
+
+@app.route('/mget', methods=['POST'])
+def mget_data():
+    try:
+        keys = [parse_key(key) for key in request.json['keys']]
+    except ValueError as e:
+        return str(e), 400
+    values, errors = coordinator.mget(keys)
+    return {'values': values, 'errors': errors}, 207 if errors else 200
+
+
+@app.route('/get-many', methods=['POST'])
+def get_many():
+    return {'values': coordinator.get_replicas(request.json['keys'])}
+
+
 @app.route('/get/<key>', methods=['GET'])
 def get_data(key):
-    return coordinator.get_value_from_datanode(key)
+    try:
+        read_quorum = parse_quorum(request.args.get('read_quorum'))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        return coordinator.get_value_from_datanode(key, read_quorum)
+    except QuorumNotReached as e:
+        return str(e), 503
+    except FlightTimeout as e:
+        return str(e), 504
+
+
+@app.route('/get-replica/<key>', methods=['GET'])
+def get_replica(key):
+    return {'value': coordinator.get_replica(key, request.args.get('near'))}
+
+
+@app.route('/handoff/begin', methods=['POST'])
+def handoff_begin():
+    data = request.json
+    rebalancer.begin(data['sender'], data['private_dns'], data['spans'])
+    return ""
+
+
+@app.route('/handoff', methods=['POST'])
+def handoff():
+    coordinator.receive_handoff(request.json['entries'])
+    return ""
+
+
+@app.route('/handoff/end', methods=['POST'])
+def handoff_end():
+    rebalancer.end(request.json['sender'])
+    return ""
+
+
+def from_private_network():
+    """Returns whether the request comes straight from a private address,
+    the peers and the operators in the vpc, not through the load balancer
+    which adds X-Forwarded-For.
+    """
+    if 'X-Forwarded-For' in request.headers:
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr).is_private
+    except ValueError:
+        return False
+
+
+@app.route('/drain', methods=['GET', 'POST'])
+def drain():
+    if not from_private_network():
+        return "Draining is only allowed from the private network", 403
+    if request.method == 'POST':
+        return coordinator.drain().stats()
+    if rebalancer.draining is None:
+        return {'state': 'serving'}
+    return rebalancer.draining.stats()
+
+
+@app.route('/drain/<node_id>', methods=['GET', 'POST'])
+def drain_node(node_id):
+    if node_id == instance_id:
+        return drain()
+    if not from_private_network():
+        return "Draining is only allowed from the private network", 403
+    # any node forwards to the drained one
+    private_dns = membership.private_dns(node_id)
+    if private_dns is None:
+        return f"Unknown node {node_id}", 404
+    return client.drain(private_dns, start=request.method == 'POST')
+
+
+@app.route('/invalidate', methods=['POST'])
+def invalidate():
+    coordinator.invalidate_near_cache(request.json['keys'])
+    return ""
+
+
+@app.route('/anti-entropy/hashes', methods=['POST'])
+def anti_entropy_hashes():
+    if anti_entropy is None:
+        return "Anti-entropy is disabled", 404
+    data = request.json
+    try:
+        return {'hashes': anti_entropy.hashes(data['peer'], data['topology'], data['indexes'])}
+    except TopologyMismatch as e:
+        return str(e), 409
+
+
+@app.route('/anti-entropy/keys', methods=['POST'])
+def anti_entropy_keys():
+    if anti_entropy is None:
+        return "Anti-entropy is disabled", 404
+    data = request.json
+    try:
+        return {'keys': anti_entropy.leaf_keys(data['peer'], data['topology'], data['leaves'])}
+    except TopologyMismatch as e:
+        return str(e), 409
+
+
+@app.route('/anti-entropy/entries', methods=['POST'])
+def anti_entropy_entries():
+    if anti_entropy is None:
+        return "Anti-entropy is disabled", 404
+    return {'entries': anti_entropy.entries(request.json['keys'])}
+
+
+@app.route('/anti-entropy/repair', methods=['POST'])
+def anti_entropy_repair():
+    if anti_entropy is None:
+        return "Anti-entropy is disabled", 404
+    data = request.json
+    anti_entropy.apply(data['sender'], data['entries'])
+    return ""
+
+
+def parse_scan(args):
+    try:
+        cursor = int(args.get('cursor', 0))
+        count = int(args.get('count', SCAN_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("cursor and count should be integers")
+    return coordinator.scan(cursor, count, args.get('prefix') or None)
+
+
+# a page of the local entries as NDJSON lines, then a {"cursor"} line to
+# pass back for the next page, "0" once all the entries were scanned
+@app.route('/scan', methods=['GET'])
+def scan():
+    try:
+        page = parse_scan(request.args)
+    except ValueError as e:
+        return str(e), 400
+    keys_only = request.args.get('keys_only', '').lower() in ('1', 'true')
+
+    def lines():
+        for key, value, expires_at in page:
+            if keys_only:
+                yield json.dumps({'key': key}) + '\n'
+            else:
+                yield json.dumps({'key': key, 'value': value, 'expires_at': expires_at}) + '\n'
+        yield json.dumps({'cursor': str(page.cursor)}) + '\n'
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
 
 
-@app.route('/get-content', methods=['GET'])
-def get_content():
-    return coordinator.get_dn_content()
+@app.route('/stats', methods=['GET'])
+def stats():
+    stats = coordinator.get_stats()
+    stats['membership'] = membership.stats()
+    stats['anti_entropy'] = anti_entropy.stats() if anti_entropy is not None else None
+    stats['binary_server'] = binary_server.stats() if binary_server else None
+    return stats
 
 
 @app.route('/health', methods=['GET'])
 def health():
+    # leave the load balancer rotation while draining
+    if coordinator.draining:
+        return "Draining", 503
     return "Healthy"
@@ -1,37 +1,457 @@
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+
 from .hash_ring import HashRing
 from .datanode import DataNodeClient
+from .near_cache import NearCache, NearCacheSubscribers
+from .rebalance import Rebalancer
+from .single_flight import SingleFlight
+from .storage import ShardedStorage
+from .write_behind import WriteBehind, WriteBehindFull
 
 REPLICATION_FACTOR = 2
 
 
+class QuorumNotReached(Exception):
+    pass
+
+
+class NodeDraining(Exception):
+    pass
+
+
 class CacheCoordinator:
 
-    def __init__(self, hash_ring: HashRing, instance_id: str):
+    def __init__(self, hash_ring: HashRing, instance_id: str, storage: ShardedStorage = None,
+                 client: DataNodeClient = None, write_quorum=REPLICATION_FACTOR, read_quorum=1,
+                 max_workers=32, hedge_delay=0.05, hedge_percentile=95,
+                 near_cache: NearCache = None, coalesce_timeout=5.0,
+                 rebalancer: Rebalancer = None, write_behind: WriteBehind = None):
         self.hash_ring = hash_ring
         self.instance_id = instance_id
 
-        self.storage = {}
+        self.storage = storage if storage is not None else ShardedStorage()
+        self.client = client if client is not None else DataNodeClient()
+
+        # replicas that must confirm a write / answer a read before the
+        # client gets its response, the others complete in the background
+        self.write_quorum = write_quorum
+        self.read_quorum = read_quorum
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='replica')
+
+        self.replica_writes = Counter()
+        self.replica_write_failures = Counter()
+        self.replica_read_failures = Counter()
+        self.quorum_failures = 0
+
+        # a read not answered after hedge_delay seconds, or after the
+        # hedge_percentile latency of the peer once known, is also sent to
+        # the next replica; None disables hedging
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.remote_reads = 0
+        self.hedged_reads = 0
+        self.hedge_wins = 0
+
+        # optional cache of the values read from remote replicas, and the
+        # coordinators to notify when a key stored here changes
+        self.near_cache = near_cache
+        self.near_subscribers = NearCacheSubscribers(near_cache.ttl if near_cache else 1.0)
+
+        # concurrent remote reads of the same key share a single request
+        self.flights = SingleFlight(coalesce_timeout)
+
+        # streams the moved keys to their new replicas on membership changes
+        self.rebalancer = rebalancer if rebalancer is not None else Rebalancer(
+            instance_id, self.storage, self.client, REPLICATION_FACTOR)
+        # a draining node no longer coordinates writes
+        self.draining = False
+
+        # optional background batching of the remote replica writes, a
+        # queued write counts as acknowledged by its replica
+        self.write_behind = write_behind
+
+    def _replicas(self, key):
+        return [node['instance'] for node in self.hash_ring.range(key=key, size=REPLICATION_FACTOR)]
+
+    def _await_quorum(self, futures, needed):
+        """Returns the first `needed` futures to succeed, raises
+        QuorumNotReached once too many of them failed.
+        """
+        done = []
+        if needed <= 0:
+            return done
+        for future in as_completed(futures):
+            if future.exception() is None:
+                done.append(future)
+                if len(done) == needed:
+                    return done
+        self.quorum_failures += 1
+        raise QuorumNotReached(f"{len(done)} of the {needed} required replicas answered")
 
-    def set(self, key, value):
-        for node in self.hash_ring.range(key=key, size=REPLICATION_FACTOR):
-            datanode = node['instance']
+    def _track_replica_write(self, datanode, future):
+        if future.exception() is None:
+            self.replica_writes[datanode.instance_id] += 1
+        else:
+            self.replica_write_failures[datanode.instance_id] += 1
+
+    def set(self, key, value, ttl=None, write_quorum=None):
+        if self.draining:
+            raise NodeDraining("the node is draining, write through another node")
+        # replicas share the absolute expiration time so all the copies
+        # expire at the same moment, and the write time settling conflicts
+        written_at = time.time()
+        expires_at = written_at + ttl if ttl is not None else None
+        replicas = self._replicas(key)
+        quorum = min(write_quorum or self.write_quorum, len(replicas))
+
+        if self.near_cache:
+            self.near_cache.invalidate([key])
+        self._forget_reads([key])
+
+        acks = 0
+        futures = []
+        for datanode in replicas:
             if datanode.instance_id == self.instance_id:
                 # store in local node
-                datanode.set_data(key, value)
+                self.set_replica(key, value, expires_at, written_at)
+                acks += 1
+            elif self.write_behind:
+                try:
+                    self.write_behind.enqueue(
+                        datanode.private_dns, [(key, value, expires_at, written_at)])
+                    acks += 1
+                except WriteBehindFull:
+                    self.replica_write_failures[datanode.instance_id] += 1
             else:
-                key_datanode = self.hash_ring.get_node_instance(key)
-                DataNodeClient.set_replica(key_datanode.private_dns, key, value)
+                future = self.executor.submit(
+                    self.client.set_replica, datanode.private_dns, key, value, expires_at, written_at)
+                future.add_done_callback(partial(self._track_replica_write, datanode))
+                futures.append(future)
+        self._await_quorum(futures, quorum - acks)
 
-    def get_value_from_datanode(self, key):
-        key_datanode = self.hash_ring.get_node_instance(key)
-        if key_datanode.instance_id == self.instance_id:
-            return self.storage.get(key)
+    def _forget_reads(self, keys):
+        """Reads in flight may return the values being overwritten, the
+        reads arriving from now on must not share them.
+        """
+        for key in keys:
+            for quorum in range(1, REPLICATION_FACTOR + 1):
+                self.flights.forget((key, quorum))
 
-        else:
-            return DataNodeClient.get(key_datanode.private_dns, key)
+    def _read_replica(self, datanode, key):
+        subscriber = self.instance_id if self.near_cache else None
+        try:
+            return self.client.get(datanode.private_dns, key, subscriber)
+        except Exception:
+            self.replica_read_failures[datanode.instance_id] += 1
+            raise
+
+    def _rank_replicas(self, replicas):
+        """Order the remote replicas live first, then by latency EWMA, then
+        by ring preference. With bounded loads, the order of the ring is
+        kept for the live replicas.
+        """
+        bounded = self.hash_ring.load_factor is not None
+
+        def rank(item):
+            pos, datanode = item
+            latency = None if bounded else self.client.latency(datanode.private_dns)
+            return not self.client.is_live(datanode.private_dns), latency or 0, pos
+        return [datanode for _, datanode in sorted(enumerate(replicas), key=rank)]
+
+    def _hedge_delay(self, datanode):
+        if self.hedge_percentile is not None:
+            delay = self.client.latency_percentile(datanode.private_dns, self.hedge_percentile)
+            if delay is not None:
+                return delay
+        return self.hedge_delay
+
+    def _read_fastest(self, key, replicas):
+        """Read the key from the fastest live remote replica, hedging to the
+        next one when it is slow, through the near cache if any.
+        """
+        if not self.near_cache:
+            return self._read_remote(key, replicas)
+        generation = self.near_cache.fetching(key)
+        value = None
+        try:
+            value = self._read_remote(key, replicas)
+        finally:
+            self.near_cache.fill(key, value, generation)
+        return value
+
+    def _read_remote(self, key, replicas):
+        replicas = self._rank_replicas(replicas)
+        self.remote_reads += 1
+        first = self.executor.submit(self._read_replica, replicas[0], key)
+        if len(replicas) == 1 or self.hedge_delay is None:
+            return first.result()
+
+        done, _ = wait([first], timeout=self._hedge_delay(replicas[0]))
+        if done and first.exception() is None:
+            return first.result()
+
+        self.hedged_reads += 1
+        hedge = self.executor.submit(self._read_replica, replicas[1], key)
+        pending = {first, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    return future.result()
+        raise first.exception()
+
+    def get_value_from_datanode(self, key, read_quorum=None):
+        replicas = self._replicas(key)
+        quorum = min(read_quorum or self.read_quorum, len(replicas))
+        if quorum <= 1:
+            if self.hash_ring.load_factor is not None and replicas:
+                replicas = self._bounded_replicas(key, replicas)
+                if replicas[0].instance_id == self.instance_id:
+                    return self._get_local(key)
+                replicas = [
+                    datanode for datanode in replicas if datanode.instance_id != self.instance_id
+                ]
+            else:
+                for datanode in replicas:
+                    if datanode.instance_id == self.instance_id:
+                        return self._get_local(key)
+            if self.near_cache:
+                value = self.near_cache.get(key)
+                if value is not None:
+                    return value
+            return self.flights.do((key, 1), partial(self._read_fastest, key, replicas))
+        return self.flights.do((key, quorum), partial(self._read_quorum, key, replicas, quorum))
+
+    def _bounded_replicas(self, key, replicas):
+        """Order the replicas of the key starting with the first one under
+        the load bound of the ring, which takes the overflow of a loaded
+        primary.
+        """
+        chosen = self.hash_ring.get_bounded(key, len(replicas))
+        if chosen is None or chosen['instance'] is None:
+            return replicas
+        chosen_id = chosen['instance'].instance_id
+        return sorted(replicas, key=lambda datanode: datanode.instance_id != chosen_id)
+
+    def _read_quorum(self, key, replicas, quorum):
+        ranks = {}
+        for rank, datanode in enumerate(replicas):
+            if datanode.instance_id == self.instance_id:
+                future = Future()
+                future.set_result(self._get_local(key))
+            else:
+                future = self.executor.submit(self._read_replica, datanode, key)
+            ranks[future] = rank
+        done = self._await_quorum(list(ranks), quorum)
+
+        # replicas that missed the key (e.g. a node that just joined) do not
+        # hide the value, the closest replica to the primary wins otherwise
+        for future in sorted(done, key=ranks.get):
+            value = future.result()
+            if value is not None:
+                return value
+        return None
+
+    def mset(self, items, ttl=None, write_quorum=None):
+        """Store many keys with one batched request per replica node.
+        Returns a {key: error} dict of the keys that missed the write quorum.
+        :param items: {key: value} dict of the entries to store.
+        """
+        if self.draining:
+            raise NodeDraining("the node is draining, write through another node")
+        written_at = time.time()
+        expires_at = written_at + ttl if ttl is not None else None
+        if self.near_cache:
+            self.near_cache.invalidate(items)
+        self._forget_reads(items)
+        # route the whole batch under a single version of the ring
+        ring = self.hash_ring.snapshot()
+        grouped = ring.range_many_grouped(list(items), REPLICATION_FACTOR)
+        quorum = write_quorum or self.write_quorum
+
+        acks = Counter()
+        replicas = Counter()
+        futures = {}
+        errors = {}
+        for nodename, keys in grouped.items():
+            replicas.update(keys)
+            datanode = ring.nodes[nodename]['instance']
+            if datanode.instance_id == self.instance_id:
+                for key in keys:
+                    self.set_replica(key, items[key], expires_at, written_at)
+                acks.update(keys)
+            elif self.write_behind:
+                try:
+                    self.write_behind.enqueue(
+                        datanode.private_dns,
+                        [(key, items[key], expires_at, written_at) for key in keys])
+                    acks.update(keys)
+                except WriteBehindFull as e:
+                    self.replica_write_failures[datanode.instance_id] += 1
+                    for key in keys:
+                        errors.setdefault(key, []).append(str(e))
+            else:
+                entries = [
+                    {'key': key, 'value': items[key], 'expires_at': expires_at,
+                     'written_at': written_at}
+                    for key in keys
+                ]
+                future = self.executor.submit(self.client.set_replicas, datanode.private_dns, entries)
+                future.add_done_callback(partial(self._track_replica_write, datanode))
+                futures[future] = keys
+
+        for future in as_completed(futures):
+            if future.exception() is None:
+                acks.update(futures[future])
+            else:
+                for key in futures[future]:
+                    errors.setdefault(key, []).append(str(future.exception()))
+        failed = {}
+        for key in items:
+            if acks[key] < min(quorum, replicas[key]) or not replicas[key]:
+                failed[key] = "; ".join(errors.get(key, ["no replica available"]))
+        return failed
+
+    def mget(self, keys):
+        """Fetch many keys with one batched request per owner node.
+        Returns the ({key: value}, {key: error}) dicts of the fetched and
+        failed keys.
+        """
+        values = {}
+        errors = {}
+        futures = {}
+        ring = self.hash_ring.snapshot()
+        for nodename, node_keys in ring.get_many_grouped(keys).items():
+            datanode = ring.nodes[nodename]['instance']
+            if datanode.instance_id == self.instance_id:
+                values.update(self.get_replicas(node_keys))
+            else:
+                future = self.executor.submit(self.client.get_many, datanode.private_dns, node_keys)
+                futures[future] = node_keys
+
+        for future in as_completed(futures):
+            if future.exception() is None:
+                values.update(future.result())
+            else:
+                errors.update((key, str(future.exception())) for key in futures[future])
+        for key in keys:
+            if key not in values and key not in errors:
+                errors[key] = "no replica available"
+        return values, errors
+
+    def set_replica(self, key, value, expires_at=None, written_at=None):
+        """:param written_at: the time the coordinator took the write, now by default."""
+        self.storage.set(key, value, expires_at, written_at)
+        self._notify_subscribers([key])
+
+    def set_replicas(self, entries):
+        for entry in entries:
+            self.storage.set(
+                entry['key'], entry['value'], entry.get('expires_at'), entry.get('written_at'))
+        self._notify_subscribers([entry['key'] for entry in entries])
+
+    def _notify_subscribers(self, keys):
+        """Send the changed keys to the near caches that may hold them,
+        one invalidation request per coordinator.
+        """
+        notified = {}
+        for key in keys:
+            for instance_id in self.near_subscribers.pop(key):
+                notified.setdefault(instance_id, []).append(key)
+        for instance_id, instance_keys in notified.items():
+            node = self.hash_ring.nodes.get(instance_id)
+            if instance_id == self.instance_id or not node or not node['instance']:
+                continue
+            self.executor.submit(self.client.invalidate, node['instance'].private_dns, instance_keys)
+
+    def invalidate_near_cache(self, keys):
+        if self.near_cache:
+            self.near_cache.invalidate(keys)
+
+    def get_replica(self, key, subscriber=None):
+        """Read the key from the local storage.
+        :param subscriber: instance id of the coordinator near caching the
+                           value, notified when the key changes.
+        """
+        if subscriber:
+            self.near_subscribers.add(key, subscriber)
+        return self._get_local(key)
+
+    def get_replicas(self, keys):
+        return {key: self._get_local(key) for key in keys}
+
+    def _get_local(self, key):
+        """Read the key from the local storage, or from the previous replica
+        while the range of the key is still being streamed to this node.
+        """
+        value = self.storage.get(key)
+        if value is None:
+            private_dns = self.rebalancer.source(self.hash_ring.hashi(key))
+            if private_dns:
+                try:
+                    return self.client.get(private_dns, key)
+                except Exception:
+                    return None
+        return value
+
+    def receive_handoff(self, entries):
+        """Store the streamed entries of the keys that were not written here
+        since the range moved.
+        """
+        for entry in entries:
+            self.storage.add(entry['key'], entry['value'], entry.get('expires_at'))
+
+    def drain(self):
+        """Stop coordinating writes and stream all the local keys to their
+        replicas without this node. Returns the DrainProgress.
+        """
+        self.draining = True
+        if self.write_behind:
+            # the replicas get the queued writes before the keys are streamed
+            self.write_behind.flush()
+        return self.rebalancer.drain(self.hash_ring.snapshot())
+
+    def close(self):
+        """Send the queued replica writes, on shutdown."""
+        if self.write_behind:
+            self.write_behind.close()
 
-    def set_replica(self, key, value):
-        self.storage[key] = value
+    def scan(self, cursor=0, count=None, prefix=None):
+        """Returns the ScanPage of up to `count` local entries from the cursor."""
+        return self.storage.scan(cursor, count, prefix)
 
-    def get_dn_content(self):
-        return self.storage
+    def get_stats(self):
+        return {
+            'instance_id': self.instance_id,
+            'ring_version': self.hash_ring.version,
+            'storage': self.storage.stats(),
+            'client': self.client.stats(),
+            'replication': {
+                'write_quorum': self.write_quorum,
+                'read_quorum': self.read_quorum,
+                'replica_writes': dict(self.replica_writes),
+                'replica_write_failures': dict(self.replica_write_failures),
+                'replica_read_failures': dict(self.replica_read_failures),
+                'quorum_failures': self.quorum_failures,
+            },
+            'near_cache': self.near_cache.stats() if self.near_cache else None,
+            'near_cache_subscribed_keys': len(self.near_subscribers),
+            'coalescing': self.flights.stats(),
+            'rebalance': self.rebalancer.stats(),
+            'bounded_loads': (
+                self.hash_ring.load_stats() if self.hash_ring.load_factor is not None else None
+            ),
+            'write_behind': self.write_behind.stats() if self.write_behind else None,
+            'reads': {
+                'remote_reads': self.remote_reads,
+                'hedged_reads': self.hedged_reads,
+                'hedge_wins': self.hedge_wins,
+                'hedge_rate': self.hedged_reads / self.remote_reads if self.remote_reads else None,
+                'hedge_win_rate': self.hedge_wins / self.hedged_reads if self.hedged_reads else None,
+            },
+        }
@@ -1,6 +1,16 @@
-import json
+import random
+import threading
+import time
+from collections import deque
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+# failures worth retrying on another attempt
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+RETRY_STATUSES = (502, 503, 504)
 
 
 class DataNodeSpecification:
@@ -10,18 +20,297 @@ class DataNodeSpecification:
         self.private_dns = private_dns
 
 
+class PeerAdapter(HTTPAdapter):
+    """Connection pool of a single peer, counting the sockets it opens."""
+
+    def __init__(self, pool_size):
+        self.requests = 0
+        self.connects = 0
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        class CountingConnection(HTTPConnection):
+            def connect(self):
+                super().connect()
+                adapter.connects += 1
+
+        class CountingConnectionPool(HTTPConnectionPool):
+            ConnectionCls = CountingConnection
+
+        self.poolmanager.pool_classes_by_scheme = dict(
+            self.poolmanager.pool_classes_by_scheme, http=CountingConnectionPool
+        )
+
+    def send(self, *args, **kwargs):
+        self.requests += 1
+        return super().send(*args, **kwargs)
+
+    def open_connections(self):
+        """Returns the number of connections in use or idle but connected."""
+        count = 0
+        for pool_key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            queued = list(pool.pool.queue)
+            count += pool.pool.maxsize - len(queued) + sum(
+                1 for conn in queued
+                if conn is not None and getattr(conn, 'sock', None) is not None
+            )
+        return count
+
+
 class DataNodeClient:
+    """HTTP client of the peer cache nodes.
+
+    Each peer gets its own keep-alive connection pool, reused across
+    requests until the peer leaves the ring and its pool is evicted.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=0.5, read_timeout=2.0,
+                 retries=2, backoff=0.05, latency_alpha=0.2, down_cooldown=2.0,
+                 default_port=8080):
+        """
+        :param pool_size: maximum number of kept-alive connections per peer.
+        :param connect_timeout: seconds to wait for a connection to a peer.
+        :param read_timeout: seconds to wait for a peer response.
+        :param retries: number of retries of a failed request.
+        :param backoff: base delay before a retry, doubled on each attempt
+                        and jittered.
+        :param latency_alpha: weight of the last sample in the latency EWMA.
+        :param down_cooldown: seconds a failing peer is not considered live.
+        :param default_port: HTTP port of the peers whose address has none.
+        """
+        self.pool_size = pool_size
+        self.default_port = default_port
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        # private dns -> session holding the connection pool of the peer
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        self.latency_alpha = latency_alpha
+        self.down_cooldown = down_cooldown
+        # private dns -> latency EWMA / recent latency samples / last failure
+        self._latency = {}
+        self._samples = {}
+        self._failed_at = {}
+
+        self.retried = 0
+        self.failures = 0
+        self.evicted_pools = 0
+
+    def _session(self, private_dns):
+        session = self._sessions.get(private_dns)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(private_dns)
+                if session is None:
+                    session = requests.Session()
+                    session.mount('http://', PeerAdapter(self.pool_size))
+                    self._sessions[private_dns] = session
+        return session
+
+    def _request(self, method, private_dns, path, **kwargs):
+        session = self._session(private_dns)
+        host, _, port = private_dns.partition(':')
+        url = f'http://{host}:{port or self.default_port}{path}'
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.monotonic()
+                res = session.request(method, url, timeout=self.timeout, **kwargs)
+                if res.status_code not in RETRY_STATUSES:
+                    self._record_latency(private_dns, time.monotonic() - start)
+                    return res
+                if attempt == self.retries:
+                    self._failed_at[private_dns] = time.monotonic()
+                    return res
+            except RETRY_EXCEPTIONS:
+                if attempt == self.retries:
+                    self.failures += 1
+                    self._failed_at[private_dns] = time.monotonic()
+                    raise
+            self.retried += 1
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def _record_latency(self, private_dns, elapsed):
+        ewma = self._latency.get(private_dns)
+        if ewma is None:
+            self._latency[private_dns] = elapsed
+        else:
+            self._latency[private_dns] = ewma + self.latency_alpha * (elapsed - ewma)
+        samples = self._samples.get(private_dns)
+        if samples is None:
+            samples = self._samples[private_dns] = deque(maxlen=128)
+        samples.append(elapsed)
+
+    def latency(self, private_dns):
+        """Returns the latency EWMA of the peer in seconds, None if unknown."""
+        return self._latency.get(private_dns)
 
-    @staticmethod
-    def set_replica(private_dns, key, value):
+    def latency_percentile(self, private_dns, percentile, min_samples=20):
+        """Returns the given percentile of the recent latencies of the peer,
+        None until enough samples were collected.
+        """
+        samples = sorted(self._samples.get(private_dns, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[int(percentile / 100 * (len(samples) - 1))]
+
+    def is_live(self, private_dns):
+        failed_at = self._failed_at.get(private_dns)
+        return failed_at is None or time.monotonic() - failed_at > self.down_cooldown
+
+    def evict(self, private_dns):
+        """Close the connection pool of a peer that left the ring."""
+        with self._lock:
+            session = self._sessions.pop(private_dns, None)
+            self._latency.pop(private_dns, None)
+            self._samples.pop(private_dns, None)
+            self._failed_at.pop(private_dns, None)
+        if session is not None:
+            session.close()
+            self.evicted_pools += 1
+
+    def close(self):
+        for private_dns in list(self._sessions):
+            self.evict(private_dns)
+
+    def set_replica(self, private_dns, key, value, expires_at=None, written_at=None):
         payload = {
             'key': key,
-            'value': value
+            'value': value,
+            'expires_at': expires_at,
+            'written_at': written_at,
         }
 
-        requests.post(f'http://{private_dns}/set-replica', data=json.dumps(payload))
+        res = self._request('POST', private_dns, '/set-replica', json=payload)
+        res.raise_for_status()
+
+    def set_replicas(self, private_dns, entries):
+        """Store a batch of replicas on the peer.
+        :param entries: list of {'key', 'value', 'expires_at', 'written_at'} dicts.
+        """
+        res = self._request('POST', private_dns, '/set-replicas', json={'entries': entries})
+        res.raise_for_status()
+
+    def get(self, private_dns, key, subscriber=None):
+        """
+        :param subscriber: instance id of the near cache keeping the value,
+                           the peer notifies it when the key changes.
+        """
+        params = {'near': subscriber} if subscriber else None
+        res = self._request('GET', private_dns, f'/get-replica/{key}', params=params)
+        res.raise_for_status()
+        return res.json()['value']
+
+    def get_many(self, private_dns, keys):
+        """Returns a {key: value} dict of the given keys stored on the peer,
+        missing keys map to None.
+        """
+        res = self._request('POST', private_dns, '/get-many', json={'keys': keys})
+        res.raise_for_status()
+        return res.json()['values']
+
+    def handoff_begin(self, private_dns, sender, spans):
+        """Announce the continuum ranges the sender starts streaming to the peer.
+        :param sender: the DataNodeSpecification of the streaming node.
+        :param spans: list of the (start, end) continuum ranges.
+        """
+        payload = {
+            'sender': sender.instance_id,
+            'private_dns': sender.private_dns,
+            'spans': spans,
+        }
+        res = self._request('POST', private_dns, '/handoff/begin', json=payload)
+        res.raise_for_status()
 
-    @staticmethod
-    def get(private_dns, key):
-        res = requests.get(f'http://{private_dns}/get/{key}')
+    def handoff(self, private_dns, entries):
+        """Store a chunk of streamed entries on the peer, unless it holds a
+        more recent value of the key.
+        :param entries: list of {'key', 'value', 'expires_at'} dicts.
+        """
+        res = self._request('POST', private_dns, '/handoff', json={'entries': entries})
+        res.raise_for_status()
+
+    def handoff_end(self, private_dns, sender):
+        res = self._request('POST', private_dns, '/handoff/end', json={'sender': sender})
+        res.raise_for_status()
+
+    def drain(self, private_dns, start=False):
+        """Returns the drain progress of the peer, starting the drain first
+        when `start` is set.
+        """
+        res = self._request('POST' if start else 'GET', private_dns, '/drain')
+        res.raise_for_status()
         return res.json()
+
+    def tree_hashes(self, private_dns, sender, topology, indexes):
+        """Returns the hashes of the given nodes of the Merkle tree the peer
+        shares with the sender, None when the peer routes with another ring.
+        :param topology: the digest of the ring of the sender.
+        """
+        payload = {'peer': sender, 'topology': topology, 'indexes': indexes}
+        res = self._request('POST', private_dns, '/anti-entropy/hashes', json=payload)
+        if res.status_code == 409:
+            return None
+        res.raise_for_status()
+        return res.json()['hashes']
+
+    def leaf_keys(self, private_dns, sender, topology, leaves):
+        """Returns the {key: [digest, written_at]} of the given leaves of the
+        Merkle tree the peer shares with the sender, None when the peer
+        routes with another ring.
+        """
+        payload = {'peer': sender, 'topology': topology, 'leaves': leaves}
+        res = self._request('POST', private_dns, '/anti-entropy/keys', json=payload)
+        if res.status_code == 409:
+            return None
+        res.raise_for_status()
+        return res.json()['keys']
+
+    def fetch_entries(self, private_dns, keys):
+        """Returns the {'key', 'value', 'expires_at', 'written_at'} of the
+        given keys stored on the peer.
+        """
+        res = self._request('POST', private_dns, '/anti-entropy/entries', json={'keys': keys})
+        res.raise_for_status()
+        return res.json()['entries']
+
+    def repair(self, private_dns, sender, entries):
+        """Store repaired entries on the peer, unless it wrote them since.
+        :param entries: list of {'key', 'value', 'expires_at', 'written_at'} dicts.
+        """
+        payload = {'sender': sender, 'entries': entries}
+        res = self._request('POST', private_dns, '/anti-entropy/repair', json=payload)
+        res.raise_for_status()
+
+    def invalidate(self, private_dns, keys):
+        """Drop the given keys from the near cache of the peer."""
+        res = self._request('POST', private_dns, '/invalidate', json={'keys': keys})
+        res.raise_for_status()
+
+    def stats(self):
+        peers = {}
+        for private_dns, session in list(self._sessions.items()):
+            adapter = session.get_adapter('http://')
+            peers[private_dns] = {
+                'requests': adapter.requests,
+                'connections_opened': adapter.connects,
+                'open_connections': adapter.open_connections(),
+                'reuse_rate': 1 - adapter.connects / adapter.requests if adapter.requests else None,
+                'latency_ewma_ms': (self._latency.get(private_dns) or 0) * 1000,
+                'live': self.is_live(private_dns),
+            }
+        return {
+            'pool_size': self.pool_size,
+            'peers': peers,
+            'retried': self.retried,
+            'failures': self.failures,
+            'evicted_pools': self.evicted_pools,
+        }
@@ -0,0 +1,34 @@
+# production serving of a cache node, run from the directory holding cache_app:
+#   gunicorn --config cache_app/gunicorn.conf.py cache_app.app:app
+import os
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# the cache lives in the memory of the process, a single worker process
+# must serve all the requests of the node
+workers = 1
+
+# gevent serves each request on a greenlet and makes the peer calls
+# non-blocking, "gthread" serves them on a thread pool instead
+worker_class = os.environ.get("SERVER_WORKER_CLASS", "gevent")
+# concurrent client connections of a gevent worker
+worker_connections = int(os.environ.get("SERVER_CONNECTIONS", 2000))
+# request threads of a gthread worker
+threads = int(os.environ.get("SERVER_THREADS", 64))
+
+keepalive = 5
+timeout = 30
+
+if worker_class == "gevent":
+    # greenlets are cheap, let each request fan out to peers without
+    # queuing behind a small pool
+    os.environ.setdefault("REPLICA_WORKERS", "1000")
+    os.environ.setdefault("PEER_POOL_SIZE", "100")
+
+
+def worker_exit(server, worker):
+    # the replica writes still queued by the write-behind mode reach their peers
+    app = sys.modules.get("cache_app.app")
+    if app is not None:
+        app.coordinator.close()
@@ -1,39 +1,258 @@
-from bisect import bisect
+import threading
+import time
+from array import array
+from bisect import bisect, bisect_left
 from collections import Counter
-from hashlib import md5
+from hashlib import blake2b, md5
+from itertools import chain
+from struct import Struct
 
+try:
+    import numpy
+except ImportError:  # in requirements.txt, batch routing falls back to bisect without it
+    numpy = None
 
-class MetaRing:
-    """Implement a tunable consistent hashing ring."""
+try:
+    import xxhash
+except ImportError:  # in requirements.txt, only needed by hash_fn='xxhash'
+    xxhash = None
+
+_unpack_point = Struct(">Q").unpack_from
+# padding of the preference lists shorter than the preference size
+NO_NODE = 0xFFFF
+_unpack_ketama = Struct("<I").unpack_from
+_unpack_ketama_points = Struct("<4I").unpack_from
+
+
+class HashFunction:
+    """Map keys and node vnodes onto the continuum.
+    Every node of the cluster must use the same hash function.
+    """
+
+    # number of bits of the continuum points
+    width = 64
+
+    def point(self, key):
+        """Returns the continuum point of the given key."""
+        raise NotImplementedError
+
+    def points(self, node_name, count):
+        """Returns the continuum points of the vnodes of the given node.
+        :param node_name: the node name.
+        :param count: the number of vnodes of the node.
+        """
+        return [self.point(f"{node_name}-{w}") for w in range(0, count)]
+
+
+class Md5Hash(HashFunction):
+    """The top 64 bits of the md5 digest.
+    This is the compatibility mode: the placement of keys is the one of the
+    original ring hashing the full 128-bit md5 digest.
+    """
+
+    def point(self, key):
+        return _unpack_point(md5(str(key).encode("utf-8")).digest())[0]
+
+
+class KetamaHash(HashFunction):
+    """libketama compatible 32-bit points, each md5 digest of a node yields
+    four vnode points.
+    """
+
+    width = 32
+
+    def point(self, key):
+        return _unpack_ketama(md5(str(key).encode("utf-8")).digest())[0]
+
+    def points(self, node_name, count):
+        points = []
+        for i in range(0, (count + 3) // 4):
+            digest = md5(f"{node_name}-{i}".encode("utf-8")).digest()
+            points.extend(_unpack_ketama_points(digest))
+        return points[:count]
+
+
+class Blake2bHash(HashFunction):
+    """A 64-bit blake2b digest."""
+
+    def point(self, key):
+        return _unpack_point(blake2b(str(key).encode("utf-8"), digest_size=8).digest())[0]
+
+
+class XXHash(HashFunction):
+    """The non-cryptographic 64-bit xxh64 hash, requires the xxhash package."""
 
     def __init__(self):
+        if xxhash is None:
+            raise ImportError("hash_fn 'xxhash' requires the xxhash package, see requirements.txt")
+
+    def point(self, key):
+        return xxhash.xxh64_intdigest(str(key).encode("utf-8"))
+
+
+class CallableHash(HashFunction):
+    """Wrap a user provided callable returning an int in [0, 2**64)."""
+
+    def __init__(self, fn):
+        self.point = fn
+
+
+HASH_FUNCTIONS = {
+    "md5": Md5Hash,
+    "ketama": KetamaHash,
+    "blake2b": Blake2bHash,
+    "xxhash": XXHash,
+}
+
+
+def get_hash_function(hash_fn=None):
+    """Returns the HashFunction matching the given hash_fn option.
+    :param hash_fn: a HashFunction, a callable or one of the HASH_FUNCTIONS
+                    names, defaults to 'md5'.
+    """
+    if hash_fn is None:
+        return Md5Hash()
+    if isinstance(hash_fn, HashFunction):
+        return hash_fn
+    if isinstance(hash_fn, str):
+        try:
+            return HASH_FUNCTIONS[hash_fn]()
+        except KeyError:
+            raise ValueError(
+                "unknown hash_fn '{}', available: {}".format(
+                    hash_fn, list(HASH_FUNCTIONS)
+                )
+            )
+    if not hasattr(hash_fn, "__call__"):
+        raise TypeError("hash_fn should be a callable function or a name")
+    return CallableHash(hash_fn)
+
+
+class LoadTracker:
+    """Load of each node, e.g. the requests routed to it, halved every
+    `half_life` seconds so that it follows the current traffic.
+    """
+
+    def __init__(self, half_life=10.0):
+        """
+        :param half_life: seconds for a load to decay by half, None to
+                          never decay.
+        """
+        self.half_life = half_life
+        # node name -> (load, last update time)
+        self._loads = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.overflows = 0
+
+    def _decayed(self, load, updated_at, now):
+        if self.half_life is None:
+            return load
+        return load * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def add(self, nodename, amount=1.0):
+        now = time.monotonic()
+        with self._lock:
+            load, updated_at = self._loads.get(nodename, (0.0, now))
+            self._loads[nodename] = (self._decayed(load, updated_at, now) + amount, now)
+
+    def loads(self, nodenames):
+        """Returns the current {node name: load} of the given nodes."""
+        now = time.monotonic()
+        loads = self._loads
+        return {
+            nodename: self._decayed(*loads[nodename], now) if nodename in loads else 0.0
+            for nodename in nodenames
+        }
+
+    def stats(self, nodenames):
+        return {
+            'half_life': self.half_life,
+            'loads': self.loads(nodenames),
+            'lookups': self.lookups,
+            'overflows': self.overflows,
+            'overflow_rate': self.overflows / self.lookups if self.lookups else None,
+        }
+
+
+class MetaRing:
+    """Implement a tunable consistent hashing ring.
+
+    The continuum is stored as two parallel compact arrays: the sorted
+    fixed-width points and, for each point, the small-int index of the node owning it.
+    """
+
+    def __init__(self, hash_fn=None, preference_size=0):
         """Create a new HashRing.
+        :param hash_fn: the HashFunction mapping keys on the continuum.
+        :param preference_size: number of distinct successor nodes to
+                                precompute for each continuum segment.
         """
         self._distribution = Counter()
-        self._keys = []
         self._nodes = {}
-        self._ring = {}
 
-        self._hash_fn = lambda key: int(md5(str(key).encode("utf-8")).hexdigest(), 16)
+        # sorted continuum points and their owner node index
+        self._keys = array("Q")
+        self._owners = array("H")
+        # node index <-> node name
+        self._names = []
+        self._index = {}
+        # node name -> sorted points of its vnodes
+        self._points = {}
+        # row i holds the indexes of the first distinct nodes met walking
+        # the continuum from position i, padded with NO_NODE
+        self._preference_size = preference_size
+        self._preferences = array("H")
+        self._hasher = hash_fn or Md5Hash()
+        self._hash_fn = self._hasher.point
+
+        # jump table narrowing each bisect to the points sharing the
+        # top `width - _shift` bits of the hashed key
+        self._shift = self._hasher.width - 1
+        self._buckets = array("I", [0, 0, 0])
+
+        # bumped on each published membership change
+        self.version = 0
 
     def hashi(self, key):
-        """Returns an integer derived from the md5 hash of the given key."""
+        """Returns the continuum point of the given key."""
         return self._hash_fn(key)
 
+    def _node_index(self, node_name):
+        """Returns the small-int index of the given node, allocating one."""
+        idx = self._index.get(node_name)
+        if idx is None:
+            try:
+                idx = self._names.index(None)
+                self._names[idx] = node_name
+            except ValueError:
+                idx = len(self._names)
+                self._names.append(node_name)
+            self._index[node_name] = idx
+        return idx
+
+    def _node_points(self, node_name, node_conf):
+        """Returns the sorted continuum points of the given node.
+        Points are cached per node so that membership changes never rehash
+        the vnodes of a node whose configuration did not change.
+        """
+        count = node_conf["vnodes"] * node_conf["weight"]
+        points = self._points.get(node_name)
+        if points is None or len(points) != count:
+            points = array("Q", sorted(self._hasher.points(node_name, count)))
+            self._points[node_name] = points
+        return points
+
     def _create_ring(self, nodes):
         """Generate a ketama compatible continuum/ring."""
-        for node_name, node_conf in nodes:
-            for w in range(0, node_conf["vnodes"] * node_conf["weight"]):
-                self._distribution[node_name] += 1
-                self._ring[self.hashi(f"{node_name}-{w}")] = node_name
-        self._keys = sorted(self._ring.keys())
+        self._apply(nodes, [])
 
     def _remove_node(self, node_name):
         """Remove the given node from the continuum/ring.
         :param node_name: the node name.
         """
         try:
-            node_conf = self._nodes.pop(node_name)
+            self._nodes.pop(node_name)
         except Exception:
             raise KeyError(
                 "node '{}' not found, available nodes: {}".format(
@@ -41,39 +260,311 @@ class MetaRing:
                 )
             )
         else:
-            self._distribution.pop(node_name)
-            for w in range(0, node_conf["vnodes"] * node_conf["weight"]):
-                del self._ring[self.hashi(f"{node_name}-{w}")]
-            self._keys = sorted(self._ring.keys())
+            self._apply([], [node_name])
+
+    def _apply(self, nodes, removed):
+        """Update the continuum for the given added/changed and removed nodes.
+        Small changes are spliced into the sorted continuum, larger ones
+        trigger a single rebuild.
+        :param nodes: (node name, node conf) of the added or changed nodes.
+        :param removed: names of the nodes to drop from the continuum.
+        """
+        dropped = []
+        for node_name in removed:
+            self._distribution.pop(node_name, None)
+            idx = self._index.pop(node_name, None)
+            if idx is not None:
+                dropped.append((idx, self._points.pop(node_name)))
+                self._names[idx] = None
+
+        added = []
+        for node_name, node_conf in nodes:
+            idx = self._index.get(node_name)
+            if idx is not None:
+                # changed node, drop its previous points first
+                dropped.append((idx, self._points[node_name]))
+            else:
+                idx = self._node_index(node_name)
+            points = self._node_points(node_name, node_conf)
+            self._distribution[node_name] = len(points)
+            added.append((idx, points))
+
+        moved = sum(len(points) for _, points in chain(dropped, added))
+        if not moved:
+            return
+        if moved <= len(self._keys) // 4:
+            dirty = self._splice(dropped, added)
+            # each row is derived from the next one: walking back from the
+            # segments before the dropped points recomputes every row still
+            # holding a dropped node. On a ring smaller than the preference
+            # lists such a row would stay padded with it, rebuild them all
+            if len(self._index) < self._preference_size:
+                self._build_preferences()
+            else:
+                self._update_preferences(dirty)
+        else:
+            self._rebuild(dropped, added)
+            self._build_preferences()
+        self._reindex()
+
+    def _splice(self, dropped, added):
+        """Remove and insert the given node points in place.
+        Returns the positions whose preference list must be updated.
+        """
+        keys, owners, table = self._keys, self._owners, self._preferences
+        n = self._preference_size
+        placeholder = array("H", [NO_NODE] * n)
+        for idx, points in dropped:
+            for point in points:
+                i = bisect_left(keys, point)
+                while owners[i] != idx:
+                    i += 1
+                del keys[i]
+                del owners[i]
+                del table[i * n:(i + 1) * n]
+        for idx, points in added:
+            for point in points:
+                i = bisect(keys, point)
+                keys.insert(i, point)
+                owners.insert(i, idx)
+                table[i * n:i * n] = placeholder
+
+        dirty = []
+        if not n or not keys:
+            return dirty
+        for idx, points in dropped:
+            # the segment right before a dropped point walked through it
+            dirty.extend(bisect_left(keys, point) - 1 for point in points)
+        for idx, points in added:
+            for point in points:
+                i = bisect_left(keys, point)
+                while owners[i] != idx:
+                    i += 1
+                dirty.append(i)
+        return dirty
+
+    def _rebuild(self, dropped, added):
+        """Rebuild the whole continuum without the dropped node points."""
+        dropped = {idx for idx, _ in dropped}
+        points = [
+            (point, owner)
+            for point, owner in zip(self._keys, self._owners)
+            if owner not in dropped
+        ]
+        for idx, node_points in added:
+            points.extend((point, idx) for point in node_points)
+        points.sort()
+        self._keys = array("Q", [point for point, _ in points])
+        self._owners = array("H", [owner for _, owner in points])
+
+    def _preference_row(self, pos):
+        """Returns the preference list of the given position, derived from
+        its owner and the preference list of the next position.
+        """
+        n = self._preference_size
+        owner = self._owners[pos]
+        nxt = (pos + 1) % len(self._keys)
+        row = array("H", [owner])
+        for other in self._preferences[nxt * n:(nxt + 1) * n]:
+            if len(row) == n:
+                break
+            if other != owner and other != NO_NODE:
+                row.append(other)
+        row.extend([NO_NODE] * (n - len(row)))
+        return row
+
+    def _build_preferences(self):
+        """Compute the preference list of every continuum position."""
+        n, owners = self._preference_size, self._owners
+        size = len(owners)
+        self._preferences = table = array("H", [NO_NODE] * (n * size))
+        if not n or not size:
+            return
+        # seed the last position walking around the ring, then derive
+        # each position from the next one
+        last = []
+        for i in chain(range(size - 1, size), range(size - 1)):
+            if owners[i] not in last:
+                last.append(owners[i])
+                if len(last) == n:
+                    break
+        table[(size - 1) * n:(size - 1) * n + len(last)] = array("H", last)
+        for pos in range(size - 2, -1, -1):
+            table[pos * n:(pos + 1) * n] = self._preference_row(pos)
+
+    def _update_preferences(self, dirty):
+        """Recompute the preference lists from each of the dirty positions
+        backwards, until a recomputed list is unchanged.
+        """
+        n, table = self._preference_size, self._preferences
+        size = len(self._keys)
+        for pos in sorted(set(dirty), reverse=True):
+            pos %= size
+            for _ in range(size):
+                row = self._preference_row(pos)
+                if row == table[pos * n:(pos + 1) * n]:
+                    break
+                table[pos * n:(pos + 1) * n] = row
+                pos = (pos - 1) % size
+            else:
+                return self._build_preferences()
+
+    def _reindex(self):
+        """Rebuild the jump table, sized to about one bucket per point."""
+        bits = min(self._hasher.width, max(1, len(self._keys).bit_length()))
+        self._shift = self._hasher.width - bits
+        keys = self._keys
+        buckets = array("I")
+        pos = 0
+        for b in range(1 << bits):
+            pos = bisect_left(keys, b << self._shift, pos)
+            buckets.append(pos)
+        buckets.append(len(keys))
+        self._buckets = buckets
+
+    def position(self, point):
+        """Returns the index of the first continuum point above the given one,
+        wrapping around to 0 past the end of the continuum.
+        :param point: the hashed key.
+        """
+        keys = self._keys
+        b = point >> self._shift
+        p = bisect(keys, point, self._buckets[b], self._buckets[b + 1])
+        if p == len(keys):
+            return 0
+        return p
+
+    def positions(self, points):
+        """Returns the continuum positions of the given points, resolved with
+        a single vectorized search when numpy is available.
+        :param points: the hashed keys.
+        """
+        if numpy is None or not self._keys:
+            return [self.position(point) for point in points]
+        keys = numpy.frombuffer(self._keys, dtype=numpy.uint64)
+        pos = numpy.searchsorted(keys, numpy.array(points, dtype=numpy.uint64), side="right")
+        pos[pos == len(keys)] = 0
+        return pos.tolist()
+
+    def successors(self, pos, size):
+        """Returns the names of the first `size` distinct nodes met walking
+        the continuum from the given position.
+        :param pos: the continuum position to start from.
+        :param size: the number of distinct nodes to look for.
+        """
+        keys, owners, names = self._keys, self._owners, self._names
+        n = self._preference_size
+        if size <= n:
+            row = self._preferences[pos * n:pos * n + size]
+            return [names[owner] for owner in row if owner != NO_NODE]
+        found = []
+        for i in chain(range(pos, len(keys)), range(pos)):
+            nodename = names[owners[i]]
+            if nodename not in found:
+                found.append(nodename)
+                if len(found) == size:
+                    break
+        return found
+
+    def footprint(self):
+        """Returns the memory used by the continuum structures, in bytes."""
+        return {
+            name: len(data) * data.itemsize
+            for name, data in [
+                ("points", self._keys),
+                ("owners", self._owners),
+                ("buckets", self._buckets),
+                ("preferences", self._preferences),
+            ]
+        }
+
+    def copy(self):
+        """Returns a mutable copy of the continuum, the base of the next
+        published version.
+        """
+        ring = MetaRing.__new__(MetaRing)
+        ring.__dict__.update(self.__dict__)
+        ring._distribution = Counter(self._distribution)
+        ring._nodes = dict(self._nodes)
+        ring._keys = self._keys[:]
+        ring._owners = self._owners[:]
+        ring._names = list(self._names)
+        ring._index = dict(self._index)
+        ring._points = dict(self._points)
+        ring._preferences = self._preferences[:]
+        ring._buckets = self._buckets[:]
+        return ring
+
+    def owner(self, pos):
+        """Returns the name of the node owning the given continuum position."""
+        return self._names[self._owners[pos]]
+
+    @property
+    def _ring(self):
+        """Returns a {point: nodename} view of the continuum."""
+        return dict(zip(self._keys, map(self._names.__getitem__, self._owners)))
 
 
 class HashRing:
-    """Implement a consistent hashing ring."""
+    """Implement a consistent hashing ring.
+
+    The continuum is published as immutable snapshots: membership changes
+    update a copy of the current MetaRing and swap it in, so readers never
+    lock and each read works on a single version of the ring.
+    """
 
     def __init__(self, nodes=[], **kwargs):
         """Create a new HashRing given the implementation.
         :param nodes: nodes used to create the continuum (see doc for format).
         :param hash_fn: use this callable function to hash keys, can be set to
-                        'ketama' to use the ketama compatible implementation.
+                        one of the HASH_FUNCTIONS names: 'md5' (default),
+                        'ketama' to use the ketama compatible implementation,
+                        'blake2b' or 'xxhash'.
         :param vnodes: default number of vnodes per node.
         :param weight_fn: use this function to calculate the node's weight.
+        :param preference_size: number of distinct successor nodes precomputed
+                                per continuum segment to serve `range` with a
+                                single lookup (default 3, 0 to disable).
+        :param load_factor: the epsilon of the bounded loads mode of
+                            `get_bounded`, None to disable it.
+        :param load_half_life: seconds for the tracked loads to decay by half.
         """
         weight_fn = kwargs.get("weight_fn", None)
 
-        self.runtime = MetaRing()
+        self.runtime = MetaRing(
+            get_hash_function(kwargs.get("hash_fn")),
+            kwargs.get("preference_size", 3),
+        )
         self._default_vnodes = 160
         self.hashi = self.runtime.hashi
+        # serialize the writers, readers never lock
+        self._lock = threading.Lock()
 
         if weight_fn and not hasattr(weight_fn, "__call__"):
             raise TypeError("weight_fn should be a callable function")
         self._weight_fn = weight_fn
 
-        if self._configure_nodes(nodes):
+        # consistent hashing with bounded loads: get_bounded skips the nodes
+        # loaded above (1 + load_factor) times the average load, the
+        # snapshots share the loads of the ring
+        self.load_factor = kwargs.get("load_factor", None)
+        if self.load_factor is not None and self.load_factor < 0:
+            raise ValueError("load_factor should be a positive number")
+        self.loads = LoadTracker(kwargs.get("load_half_life", 10.0))
+
+        if self._configure_nodes(nodes, self.runtime):
             self.runtime._create_ring(self.runtime._nodes.items())
 
-    def _configure_nodes(self, nodes):
+    def _publish(self, runtime):
+        """Swap in the updated copy of the continuum as the next version."""
+        runtime.version = self.runtime.version + 1
+        self.runtime = runtime
+
+    def _configure_nodes(self, nodes, runtime):
         """Parse and set up the given nodes.
+        Returns the names of the nodes whose continuum points need an update.
         :param nodes: nodes used to create the continuum (see doc for format).
+        :param runtime: the unpublished MetaRing to configure.
         """
         if isinstance(nodes, str):
             nodes = [nodes]
@@ -83,8 +574,9 @@ class HashRing:
                 " got {}".format(type(nodes))
             )
 
-        conf_changed = False
+        changed = set()
         for node in nodes:
+            conf_changed = False
             conf = {
                 "hostname": node,
                 "instance": None,
@@ -93,7 +585,7 @@ class HashRing:
                 "vnodes": self._default_vnodes,
                 "weight": 1,
             }
-            current_conf = self.runtime._nodes.get(node, {})
+            current_conf = runtime._nodes.get(node, {})
             nodename = node
             # new node, trigger a ring update
             if not current_conf:
@@ -121,14 +613,19 @@ class HashRing:
             # changing the weight of a node trigger a ring update
             if current_conf.get("weight") != conf["weight"]:
                 conf_changed = True
-            self.runtime._nodes[nodename] = conf
-        return conf_changed
+            runtime._nodes[nodename] = conf
+            if conf_changed:
+                changed.add(nodename)
+        return changed
 
     def __delitem__(self, nodename):
         """Remove the given node.
         :param nodename: the node name.
         """
-        self.runtime._remove_node(nodename)
+        with self._lock:
+            runtime = self.runtime.copy()
+            runtime._remove_node(nodename)
+            self._publish(runtime)
 
     remove_node = __delitem__
 
@@ -145,11 +642,40 @@ class HashRing:
         :param nodename: the node name.
         :param conf: the node configuration.
         """
-        if self._configure_nodes({nodename: conf}):
-            self.runtime._create_ring([(nodename, self._nodes[nodename])])
+        with self._lock:
+            runtime = self.runtime.copy()
+            if self._configure_nodes({nodename: conf}, runtime):
+                runtime._create_ring([(nodename, runtime._nodes[nodename])])
+            self._publish(runtime)
 
     add_node = __setitem__
 
+    def apply_membership(self, added=None, removed=None):
+        """Add, update and remove nodes with a single continuum update.
+        Returns the (added or changed, removed) sets of node names.
+        :param added: nodes to add or update (see doc for format).
+        :param removed: names of the nodes to remove, unknown ones and the
+                        ones also present in `added` are ignored.
+        """
+        added = added or {}
+        if isinstance(added, str):
+            added = [added]
+        with self._lock:
+            runtime = self.runtime.copy()
+            removed = {
+                nodename for nodename in removed or []
+                if nodename in runtime._nodes and nodename not in added
+            }
+            for nodename in removed:
+                runtime._nodes.pop(nodename)
+            changed = self._configure_nodes(added, runtime)
+            runtime._apply(
+                [(nodename, runtime._nodes[nodename]) for nodename in changed],
+                removed,
+            )
+            self._publish(runtime)
+        return changed, removed
+
     def _get_pos(self, key):
         """Get the index of the given key in the sorted key list.
         We return the position with the nearest hash based on
@@ -157,11 +683,8 @@ class HashRing:
         in which case we return the 0 (beginning) index position.
         :param key: the key to hash and look for.
         """
-        p = bisect(self.runtime._keys, self.hashi(key))
-        if p == len(self.runtime._keys):
-            return 0
-        else:
-            return p
+        runtime = self.runtime
+        return runtime.position(runtime._hash_fn(key))
 
     def _get(self, key, what):
         """Generic getter magic method.
@@ -174,22 +697,23 @@ class HashRing:
             - tuple: ketama compatible (pos, name) tuple
             - weight: node weight
         """
-        if not self.runtime._ring:
+        runtime = self.runtime
+        if not runtime._keys:
             return None
 
-        pos = self._get_pos(key)
+        pos = runtime.position(runtime._hash_fn(key))
         if what == "pos":
             return pos
 
-        nodename = self.runtime._ring[self.runtime._keys[pos]]
+        nodename = runtime._names[runtime._owners[pos]]
         if what in ["hostname", "instance", "port", "weight"]:
-            return self.runtime._nodes[nodename][what]
+            return runtime._nodes[nodename][what]
         elif what == "dict":
-            return self.runtime._nodes[nodename]
+            return runtime._nodes[nodename]
         elif what == "nodename":
             return nodename
         elif what == "tuple":
-            return (self.runtime._keys[pos], nodename)
+            return (runtime._keys[pos], nodename)
 
     def get(self, key):
         """Returns the node object dict matching the hashed key.
@@ -246,7 +770,12 @@ class HashRing:
 
     def get_points(self):
         """Returns a ketama compatible list of (position, nodename) tuples."""
-        return [(k, self.runtime._ring[k]) for k in self.runtime._keys]
+        runtime = self.runtime
+        names = runtime._names
+        return [
+            (k, names[owner])
+            for k, owner in zip(runtime._keys, runtime._owners)
+        ]
 
     def get_server(self, key):
         """Returns a ketama compatible (position, nodename) tuple.
@@ -263,22 +792,58 @@ class HashRing:
         if `distinct` is set, then the nodes returned will be unique,
         i.e. no virtual copies will be returned.
         """
-        if not self.runtime._ring:
+        if not self.runtime._keys:
             yield None
         else:
             for node in self.range(key, unique=distinct):
                 yield node["nodename"]
 
-    def print_continuum(self):
-        """Prints a ketama compatible continuum report."""
-        numpoints = len(self.runtime._keys)
-        if numpoints:
-            print(f"Numpoints in continuum: {numpoints}")
+    def get_bounded(self, key, size=None, amount=1.0):
+        """Returns the node dict of the first node met walking the continuum
+        from the key whose load stays under (1 + load_factor) times the
+        average load once charged with `amount`, the owner of the key when
+        the bounded loads mode is off. The returned node is charged.
+        :param key: the key to look for.
+        :param size: only walk the first `size` distinct nodes, e.g. the
+                     replicas of the key, the least loaded of them is
+                     returned when they are all above the bound.
+        :param amount: the load of the request.
+        """
+        runtime = self.runtime
+        if not runtime._keys:
+            return None
+        pos = runtime.position(runtime._hash_fn(key))
+        if self.load_factor is None:
+            nodename = runtime.owner(pos)
         else:
-            print("Continuum empty")
-        for p in self.get_points():
-            point, node = p
-            print(f"{node} ({point})")
+            nodes = runtime._nodes
+            candidates = runtime.successors(pos, size or len(nodes))
+            loads = self.loads.loads(nodes)
+            bound = (1 + self.load_factor) * (sum(loads.values()) + amount) / len(nodes)
+            self.loads.lookups += 1
+            for nodename in candidates:
+                if loads[nodename] + amount <= bound:
+                    break
+            else:
+                nodename = min(candidates, key=loads.get)
+            if nodename != candidates[0]:
+                self.loads.overflows += 1
+        self.loads.add(nodename, amount)
+        return runtime._nodes[nodename]
+
+    def load_stats(self):
+        """Returns the loads tracked by the bounded loads mode."""
+        stats = self.loads.stats(self.runtime._nodes)
+        stats['load_factor'] = self.load_factor
+        return stats
+
+    def print_continuum(self, size=1):
+        """Prints the ownership report of the continuum, see ring_analysis.
+        :param size: the number of replicas of each key.
+        """
+        from .ring_analysis import ownership_report
+
+        print(ownership_report(self, size))
 
     def range(self, key, size=None, unique=True):
         """Returns a generator of nodes' configuration available
@@ -287,40 +852,114 @@ class HashRing:
         :param size: limit the list to at most this number of nodes.
         :param unique: a node may only appear once in the list (default True).
         """
+        runtime = self.runtime
         all_nodes = set()
         if unique:
-            size = size or len(self.runtime._nodes)
+            size = size or len(runtime._nodes)
+            if size <= runtime._preference_size:
+                if runtime._keys:
+                    pos = runtime.position(runtime._hash_fn(key))
+                    for nodename in runtime.successors(pos, size):
+                        yield runtime._nodes[nodename]
+                return
         else:
             all_nodes = []
 
-        pos = self._get_pos(key)
-        for key in self.runtime._keys[pos:]:
-            nodename = self.runtime._ring[key]
+        keys, owners, names = runtime._keys, runtime._owners, runtime._names
+        if not keys:
+            return
+        pos = runtime.position(runtime._hash_fn(key))
+        for i in chain(range(pos, len(keys)), range(pos)):
+            nodename = names[owners[i]]
             if unique:
                 if nodename in all_nodes:
                     continue
                 all_nodes.add(nodename)
             else:
                 all_nodes.append(nodename)
-            yield self.runtime._nodes[nodename]
+            yield runtime._nodes[nodename]
             if len(all_nodes) == size:
                 break
-        else:
-            for i, key in enumerate(self.runtime._keys):
-                if i < pos:
-                    nodename = self.runtime._ring[key]
-                    if unique:
-                        if nodename in all_nodes:
-                            continue
-                        all_nodes.add(nodename)
-                    else:
-                        all_nodes.append(nodename)
-                    yield self.runtime._nodes[nodename]
-                    if len(all_nodes) == size:
-                        break
+
+    def _positions(self, runtime, keys):
+        """Hash the given keys and returns their positions on the given continuum."""
+        return runtime.positions([runtime._hash_fn(key) for key in keys])
+
+    def get_many(self, keys):
+        """Returns the node object dicts matching each of the hashed keys.
+        :param keys: the keys to look for.
+        """
+        runtime = self.runtime
+        if not runtime._keys:
+            return [None] * len(keys)
+        owners, names, nodes = runtime._owners, runtime._names, runtime._nodes
+        return [nodes[names[owners[pos]]] for pos in self._positions(runtime, keys)]
+
+    def get_many_grouped(self, keys):
+        """Returns a {nodename: [keys]} dict of the keys owned by each node.
+        :param keys: the keys to look for.
+        """
+        runtime = self.runtime
+        grouped = {}
+        if not runtime._keys:
+            return grouped
+        owners, names = runtime._owners, runtime._names
+        for key, pos in zip(keys, self._positions(runtime, keys)):
+            grouped.setdefault(names[owners[pos]], []).append(key)
+        return grouped
+
+    def range_many(self, keys, size=None):
+        """Returns, for each of the keys, the list of the configurations of
+        the distinct nodes holding it, as `range` would.
+        :param keys: the keys to look for.
+        :param size: limit the lists to at most this number of nodes.
+        """
+        runtime = self.runtime
+        if not runtime._keys:
+            return [[] for _ in keys]
+        size = size or len(runtime._nodes)
+        nodes = runtime._nodes
+        return [
+            [nodes[nodename] for nodename in runtime.successors(pos, size)]
+            for pos in self._positions(runtime, keys)
+        ]
+
+    def range_many_grouped(self, keys, size=None):
+        """Returns a {nodename: [keys]} dict of the keys held by each node,
+        a key being listed under each of its `size` replicas.
+        :param keys: the keys to look for.
+        :param size: limit the replicas of a key to at most this number of nodes.
+        """
+        runtime = self.runtime
+        grouped = {}
+        if not runtime._keys:
+            return grouped
+        size = size or len(runtime._nodes)
+        for key, pos in zip(keys, self._positions(runtime, keys)):
+            for nodename in runtime.successors(pos, size):
+                grouped.setdefault(nodename, []).append(key)
+        return grouped
 
     def regenerate(self):
-        self.runtime._create_ring(self.runtime._nodes.items())
+        with self._lock:
+            runtime = self.runtime.copy()
+            runtime._create_ring(runtime._nodes.items())
+            self._publish(runtime)
+
+    def snapshot(self):
+        """Returns a ring bound to the current version of the continuum,
+        unaffected by later membership changes, e.g. to route all the
+        requests of an operation under the same topology.
+        """
+        ring = HashRing.__new__(HashRing)
+        ring.__dict__.update(self.__dict__)
+        ring._lock = threading.Lock()
+        return ring
+
+    @property
+    def version(self):
+        """The version of the continuum, bumped on each membership change."""
+        return self.runtime.version
 
     @property
     def conf(self):
@@ -328,6 +967,10 @@ class HashRing:
 
     nodes = conf
 
+    @property
+    def footprint(self):
+        return self.runtime.footprint()
+
     @property
     def distribution(self):
         return self.runtime._distribution
@@ -340,7 +983,7 @@ class HashRing:
 
     @property
     def size(self):
-        return len(self.runtime._ring)
+        return len(self.runtime._keys)
 
     @property
     def _ring(self):
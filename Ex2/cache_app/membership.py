@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+
+from .datanode import DataNodeSpecification
+
+
+class MembershipSource:
+    """Where the cache nodes and their addresses come from."""
+
+    def targets(self):
+        """Returns the (healthy, leaving) lists of instance ids, leaving
+        instances being unhealthy or deregistering ones.
+        """
+        raise NotImplementedError
+
+    def resolve(self, instance_ids):
+        """Returns the {instance id: private dns} of the given instances."""
+        raise NotImplementedError
+
+
+class ElbMembershipSource(MembershipSource):
+    """The instances registered in the load balancer target group."""
+
+    def __init__(self, elb, ec2, target_group="cache-elb-tg"):
+        self.elb = elb
+        self.ec2 = ec2
+        self.target_group = target_group
+        self._target_group_arn = None
+        self.api_calls = 0
+
+    def targets(self):
+        if self._target_group_arn is None:
+            target_group = self.elb.describe_target_groups(Names=[self.target_group])
+            self.api_calls += 1
+            self._target_group_arn = target_group["TargetGroups"][0]["TargetGroupArn"]
+        health = self.elb.describe_target_health(TargetGroupArn=self._target_group_arn)
+        self.api_calls += 1
+        healthy = []
+        leaving = []
+        for target in health["TargetHealthDescriptions"]:
+            # draining targets are being deregistered
+            if target["TargetHealth"]["State"] in ("unhealthy", "draining"):
+                leaving.append(target["Target"]["Id"])
+            else:
+                healthy.append(target["Target"]["Id"])
+        return healthy, leaving
+
+    def resolve(self, instance_ids):
+        resolved = {}
+        if not instance_ids:
+            return resolved
+        try:
+            self._describe(instance_ids, resolved)
+        except Exception:
+            if len(instance_ids) == 1:
+                return resolved
+            # an unknown instance fails the whole batch, resolve the others
+            for instance_id in instance_ids:
+                resolved.update(self.resolve([instance_id]))
+        return resolved
+
+    def _describe(self, instance_ids, resolved):
+        paginator = self.ec2.get_paginator("describe_instances")
+        for page in paginator.paginate(InstanceIds=list(instance_ids)):
+            self.api_calls += 1
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    resolved[instance["InstanceId"]] = instance["PrivateDnsName"]
+
+
+class StaticMembershipSource(MembershipSource):
+    """A fixed set of nodes, e.g. for local clusters, tests and benchmarks."""
+
+    def __init__(self, nodes, leaving=()):
+        """
+        :param nodes: {instance id: private dns} dict of the healthy nodes.
+        :param leaving: instance ids of the unhealthy nodes.
+        """
+        self.nodes = dict(nodes)
+        self.leaving = list(leaving)
+
+    def targets(self):
+        return list(self.nodes), list(self.leaving)
+
+    def resolve(self, instance_ids):
+        return {
+            instance_id: self.nodes[instance_id]
+            for instance_id in instance_ids if instance_id in self.nodes
+        }
+
+
+class FileMembershipSource(StaticMembershipSource):
+    """Nodes listed in a JSON file, re-read when it changes:
+    {"nodes": {instance id: private dns}, "leaving": [instance ids]}
+    """
+
+    def __init__(self, path):
+        super().__init__({})
+        self.path = path
+        self._mtime = None
+
+    def targets(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            with open(self.path) as f:
+                conf = json.load(f)
+            self.nodes = dict(conf.get("nodes", {}))
+            self.leaving = list(conf.get("leaving", []))
+            self._mtime = mtime
+        return super().targets()
+
+
+class MembershipManager:
+    """Keep the hash ring in sync with a membership source.
+
+    The private dns of the instances is cached, only the new instances are
+    resolved, with a single batched call. Each refresh applies the
+    difference with the current ring as one membership change.
+    """
+
+    def __init__(self, hash_ring, source: MembershipSource, client=None, rebalancer=None,
+                 write_behind=None):
+        """
+        :param client: DataNodeClient whose pools of the removed peers are closed.
+        :param rebalancer: Rebalancer streaming the keys of the moved ranges.
+        :param write_behind: WriteBehind whose queues of the removed peers are dropped.
+        """
+        self.hash_ring = hash_ring
+        self.source = source
+        self.client = client
+        self.rebalancer = rebalancer
+        self.write_behind = write_behind
+        # instance id -> private dns
+        self._dns = {}
+        self._lock = threading.Lock()
+
+        self.refreshes = 0
+        self.resolved = 0
+        self.changes = 0
+
+    def private_dns(self, instance_id):
+        """Returns the private dns of the instance, resolving it if unknown."""
+        private_dns = self._dns.get(instance_id)
+        if private_dns is None:
+            private_dns = self.source.resolve([instance_id]).get(instance_id)
+            if private_dns:
+                self._dns[instance_id] = private_dns
+        return private_dns
+
+    def refresh(self):
+        """Apply the membership changes since the last refresh.
+        Returns the (added or changed, removed) sets of node names.
+        """
+        with self._lock:
+            healthy, leaving = self.source.targets()
+            self.refreshes += 1
+
+            unknown = [instance_id for instance_id in healthy if instance_id not in self._dns]
+            resolved = self.source.resolve(unknown)
+            self.resolved += len(resolved)
+            self._dns.update(resolved)
+
+            nodes = self.hash_ring.nodes
+            added = {}
+            for instance_id in healthy:
+                private_dns = self._dns.get(instance_id)
+                if private_dns is None:
+                    # might be that the instance is not yet initialized
+                    continue
+                current = nodes.get(instance_id, {}).get("instance")
+                if current is None or current.private_dns != private_dns:
+                    added[instance_id] = {
+                        "hostname": instance_id,
+                        "instance": DataNodeSpecification(instance_id, private_dns),
+                    }
+            # deregistered instances are no longer listed at all
+            registered = set(healthy).union(leaving)
+            removed = [
+                name for name in nodes
+                if name in leaving or name not in registered
+            ]
+            for instance_id in list(self._dns):
+                if instance_id not in registered:
+                    del self._dns[instance_id]
+            if not added and not removed:
+                return set(), set()
+
+            removed_dns = {
+                name: nodes[name]["instance"].private_dns
+                for name in removed if nodes[name]["instance"]
+            }
+            old_ring = self.hash_ring.snapshot()
+            changed, removed = self.hash_ring.apply_membership(added, removed)
+            new_ring = self.hash_ring.snapshot()
+            self.changes += 1
+
+        if self.rebalancer is not None and (changed or removed):
+            # hand the moved key ranges over to their new replicas
+            self.rebalancer.rebalance(old_ring, new_ring)
+        for name in removed:
+            if name not in removed_dns:
+                continue
+            # close the connection pools of the peers that left the ring
+            if self.client is not None:
+                self.client.evict(removed_dns[name])
+            if self.write_behind is not None:
+                self.write_behind.evict(removed_dns[name])
+        return changed, removed
+
+    def stats(self):
+        return {
+            'source': type(self.source).__name__,
+            'nodes': len(self.hash_ring.nodes),
+            'known_addresses': len(self._dns),
+            'refreshes': self.refreshes,
+            'resolved': self.resolved,
+            'changes': self.changes,
+            'api_calls': getattr(self.source, 'api_calls', None),
+        }
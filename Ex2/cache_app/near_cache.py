@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .storage import ShardedStorage
+
+
+class NearCache:
+    """Small, short lived cache of the values a coordinator fetched from
+    remote replicas.
+
+    Entries expire after `ttl` seconds at most, and are dropped earlier when
+    a replica reports the key changed.
+    """
+
+    def __init__(self, max_bytes, ttl=1.0):
+        """
+        :param max_bytes: the byte budget of the near cache.
+        :param ttl: seconds a fetched value may be served from the near cache.
+        """
+        self.storage = ShardedStorage(max_bytes=max_bytes, policy="lru", shards=4)
+        self.ttl = ttl
+        # key -> [fetches in flight, generation], only for the keys being
+        # fetched: an invalidation of the key bumps its generation, a fetch
+        # started before it must not fill the cache with a stale value
+        self._fetches = {}
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.storage.get(key)
+
+    def fetching(self, key):
+        """Returns the generation of the key before fetching its value, the
+        fetch must end with fill() whatever its outcome.
+        """
+        with self._lock:
+            fetch = self._fetches.get(key)
+            if fetch is None:
+                fetch = self._fetches[key] = [0, 0]
+            fetch[0] += 1
+            return fetch[1]
+
+    def fill(self, key, value, generation):
+        """Cache a value fetched while the key was at the given generation,
+        None when the fetch failed or found no value.
+        """
+        with self._lock:
+            fetch = self._fetches[key]
+            fetch[0] -= 1
+            if not fetch[0]:
+                del self._fetches[key]
+            if value is not None and generation == fetch[1]:
+                self.storage.set(key, value, time.time() + self.ttl)
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                fetch = self._fetches.get(key)
+                if fetch is not None:
+                    fetch[1] += 1
+                if self.storage.delete(key):
+                    self.invalidations += 1
+
+    def stats(self):
+        stats = self.storage.stats()
+        stats['ttl'] = self.ttl
+        stats['invalidations'] = self.invalidations
+        return stats
+
+
+class NearCacheSubscribers:
+    """Remember which coordinators recently fetched a key, so that a replica
+    only sends invalidations to the near caches that may hold it.
+    """
+
+    def __init__(self, ttl=1.0, max_keys=100000):
+        """
+        :param ttl: seconds after which a fetch no longer needs invalidating,
+                    the near cache TTL of the coordinators.
+        :param max_keys: maximum number of tracked keys, oldest dropped first.
+        """
+        self.ttl = ttl
+        self.max_keys = max_keys
+        # key -> {instance id: fetch time}
+        self._subscribers = OrderedDict()
+        # the request handlers subscribe and pop concurrently
+        self._lock = threading.Lock()
+
+    def add(self, key, instance_id):
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None:
+                subscribers = self._subscribers[key] = {}
+                if len(self._subscribers) > self.max_keys:
+                    self._subscribers.popitem(last=False)
+            else:
+                self._subscribers.move_to_end(key)
+            subscribers[instance_id] = time.time()
+
+    def pop(self, key):
+        """Returns the instances whose near cache may still hold the key."""
+        with self._lock:
+            subscribers = self._subscribers.pop(key, None)
+        if not subscribers:
+            return []
+        oldest = time.time() - self.ttl
+        return [instance_id for instance_id, fetched_at in subscribers.items() if fetched_at >= oldest]
+
+    def __len__(self):
+        return len(self._subscribers)
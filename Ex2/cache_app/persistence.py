@@ -0,0 +1,518 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from contextlib import ExitStack, contextmanager
+from hashlib import blake2b
+
+from .storage import ShardedStorage
+from .wire import U32, Reader, write_entry, write_str
+
+# log record: operation, payload length and crc32 of the payload
+RECORD = struct.Struct(">BII")
+SET = 1
+DELETE = 2
+
+# snapshot header: magic, format version, first log generation not
+# covered by the snapshot, number of entries, slots and offset of the index
+SNAPSHOT_HEADER = struct.Struct(">8sIIQQQ")
+SNAPSHOT_MAGIC = b"CACHESNP"
+SNAPSHOT_VERSION = 1
+# index slot: hash of the key and offset of its entry, 0 for an empty slot
+SLOT = struct.Struct(">QQ")
+
+FSYNC_POLICIES = ("always", "everysec", "no")
+# write time reported for the restored entries, older than any live write
+RESTORED = 0.0
+
+
+def key_hash(key):
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class AppendOnlyLog:
+    """Append-only file of the set and delete records of one generation.
+
+    Records are written unbuffered, so they survive a crash of the process;
+    the fsync policy decides what survives a crash of the machine: "always"
+    syncs each record, "everysec" once per second, "no" leaves it to the OS.
+    """
+
+    def __init__(self, path, fsync="everysec"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy '{fsync}', available: {list(FSYNC_POLICIES)}")
+        self.path = path
+        self.fsync = fsync
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self._fd).st_size
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.records = 0
+        self.syncs = 0
+
+    def _append(self, op, payload):
+        record = RECORD.pack(op, len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            os.write(self._fd, record)
+            self.size += len(record)
+            self.records += 1
+            if self.fsync == "always":
+                os.fsync(self._fd)
+                self.syncs += 1
+            else:
+                self._dirty = True
+
+    def set(self, key, value, expires_at):
+        buf = bytearray()
+        write_entry(buf, key, value, expires_at)
+        self._append(SET, buf)
+
+    def delete(self, key):
+        buf = bytearray()
+        write_str(buf, key)
+        self._append(DELETE, buf)
+
+    def extend(self, path):
+        """Append the records of another log file, in order."""
+        with open(path, "rb") as f:
+            records = f.read()
+        with self._lock:
+            os.write(self._fd, records)
+            self.size += len(records)
+            self._dirty = True
+
+    def sync(self):
+        """fsync the records written since the last sync."""
+        with self._lock:
+            if self._dirty and self._fd is not None:
+                os.fsync(self._fd)
+                self._dirty = False
+                self.syncs += 1
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+
+def replay_log(path):
+    """Yields the (op, Reader) of the records of a log file, stopping at
+    the first torn or corrupted record.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        op, size, crc = RECORD.unpack_from(data, offset)
+        payload = data[offset + RECORD.size:offset + RECORD.size + size]
+        if len(payload) < size or zlib.crc32(payload) != crc:
+            return
+        yield op, Reader(payload)
+        offset += RECORD.size + size
+
+
+def write_snapshot(path, entries, log_generation):
+    """Write the entries to a snapshot file: the encoded entries followed by
+    an open addressing index of their offsets by key hash.
+    :param entries: iterable of (key, value, expires_at) tuples.
+    :param log_generation: the first log generation the snapshot misses.
+    Returns the number of written entries.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        count = _write_snapshot(tmp_path, entries, log_generation)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return count
+
+
+def _write_snapshot(tmp_path, entries, log_generation):
+    hashes = array("Q")
+    offsets = array("Q")
+    with open(tmp_path, "wb") as f:
+        f.write(bytes(SNAPSHOT_HEADER.size))
+        offset = SNAPSHOT_HEADER.size
+        buf = bytearray()
+        for key, value, expires_at in entries:
+            hashes.append(key_hash(key))
+            offsets.append(offset + len(buf))
+            write_entry(buf, key, value, expires_at)
+            if len(buf) >= 1 << 20:
+                f.write(buf)
+                offset += len(buf)
+                buf = bytearray()
+        f.write(buf)
+        offset += len(buf)
+
+        # at most half full, so that a lookup probes a few slots
+        slots = 1 << max(3, (2 * len(offsets)).bit_length())
+        mask = slots - 1
+        table = array("Q", bytes(16 * slots))
+        for h, entry_offset in zip(hashes, offsets):
+            i = h & mask
+            while table[2 * i + 1]:
+                i = (i + 1) & mask
+            table[2 * i] = h
+            table[2 * i + 1] = entry_offset
+        if struct.pack("=H", 1) != struct.pack(">H", 1):
+            table.byteswap()
+        f.write(table.tobytes())
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, log_generation, len(offsets), slots, offset))
+        f.flush()
+        os.fsync(f.fileno())
+    return len(offsets)
+
+
+class Snapshot:
+    """Read-only, memory-mapped snapshot file.
+
+    Opening it only reads the header: a lookup hashes the key, probes the
+    index and compares the key in place, and only the value of a matching
+    entry is decoded.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, version, self.log_generation, self.count, self.slots, self._table = \
+            SNAPSHOT_HEADER.unpack_from(self._view, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+
+    def lookup(self, key):
+        """Returns the (value, expires_at) of the key, None when missing."""
+        h = key_hash(key)
+        encoded = key.encode()
+        mask = self.slots - 1
+        i = h & mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._view, self._table + SLOT.size * i)
+            if not offset:
+                return None
+            if slot_hash == h:
+                reader = Reader(self._view)
+                reader.offset = offset
+                size = reader.unpack(U32)
+                if self._view[reader.offset:reader.offset + size] == encoded:
+                    reader.offset += size
+                    return reader.value(), reader.expires_at()
+            i = (i + 1) & mask
+
+    def entries(self):
+        """Yields the (key, value, expires_at) of the entries, in file order."""
+        reader = Reader(self._view)
+        reader.offset = SNAPSHOT_HEADER.size
+        for _ in range(self.count):
+            entry = reader.entry()
+            yield entry['key'], entry['value'], entry['expires_at']
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+
+class PersistentStorage(ShardedStorage):
+    """ShardedStorage persisting its writes, so that a restarted node serves
+    its previous keys instead of starting empty.
+
+    Every set and delete is appended to a log. The log is periodically
+    compacted into a snapshot of the entries, the log then starts over. On
+    startup, the log is replayed and the snapshot is only mapped: its keys
+    are loaded on first access, and by a background warm-up.
+    Until the warm-up completes, items(), entries() and len() only see the
+    loaded keys, scan() waits for it.
+
+    Only the writes the engine accepted are logged; an update it did not
+    admit is logged as a delete, the previous value being dropped. Keys
+    must be str, the other ones are refused before any change.
+    """
+
+    def __init__(self, path, fsync="everysec", max_log_bytes=64 << 20, **kwargs):
+        """
+        :param path: directory of the snapshot and of the logs.
+        :param fsync: fsync policy of the log, one of FSYNC_POLICIES.
+        :param max_log_bytes: size of the log triggering a compaction.
+        :param kwargs: the ShardedStorage arguments.
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.fsync = fsync
+        self.max_log_bytes = max_log_bytes
+        os.makedirs(path, exist_ok=True)
+        self._snapshot_path = os.path.join(path, "snapshot")
+        self._compact_lock = threading.Lock()
+
+        self.replayed_records = 0
+        self.snapshot_keys = 0
+        self.snapshot_faults = 0
+        self.warmed_keys = 0
+        self.compactions = 0
+        self.last_compaction = None
+
+        start = time.monotonic()
+        # the keys written or deleted since startup, their snapshot entry is stale
+        self._shadowed = set()
+        # set once all the keys of the snapshot are loaded
+        self._warmed = threading.Event()
+        self.snapshot = None
+        generation = 0
+        if os.path.exists(self._snapshot_path):
+            self.snapshot = Snapshot(self._snapshot_path)
+            self.snapshot_keys = self.snapshot.count
+            generation = self.snapshot.log_generation
+        for log_generation in self._log_generations():
+            log_path = self._log_path(log_generation)
+            if log_generation < generation:
+                # already compacted into the snapshot
+                os.remove(log_path)
+                continue
+            self._replay(log_path)
+            generation = log_generation + 1
+        self.log = AppendOnlyLog(self._log_path(generation), fsync)
+        self.generation = generation
+        self.load_time = time.monotonic() - start
+
+        if self.snapshot is not None:
+            threading.Thread(target=self._warm_up, name="warm-up", daemon=True).start()
+        else:
+            self._warmed.set()
+        if fsync == "everysec":
+            threading.Thread(target=self._sync_every_second, name="fsync", daemon=True).start()
+
+    def _log_path(self, generation):
+        return os.path.join(self.path, f"log.{generation:08d}")
+
+    def _log_generations(self):
+        return sorted(
+            int(name.split(".")[1]) for name in os.listdir(self.path)
+            if name.startswith("log.") and name.split(".")[1].isdigit()
+        )
+
+    def _replay(self, log_path):
+        for op, reader in replay_log(log_path):
+            if op == SET:
+                entry = reader.entry()
+                key = entry['key']
+                with self._shard(key) as engine:
+                    engine.set(key, entry['value'], entry['expires_at'], RESTORED)
+            else:
+                key = reader.str()
+                with self._shard(key) as engine:
+                    engine.delete(key)
+            self._shadowed.add(key)
+            self.replayed_records += 1
+
+    @contextmanager
+    def _locked(self):
+        """Hold the locks of all the shards, no write is in progress."""
+        with ExitStack() as stack:
+            for shard in self._shards:
+                stack.enter_context(shard)
+            yield
+
+    def _fault(self, engine, key):
+        """Load the key from the snapshot when it was not loaded yet, under
+        the lock of its shard.
+        """
+        if self.snapshot is None or key in self._shadowed or key in engine:
+            return
+        entry = self.snapshot.lookup(key)
+        if entry is not None:
+            value, expires_at = entry
+            engine.set(key, value, expires_at, RESTORED)
+            self.snapshot_faults += 1
+
+    def _warm_up(self):
+        snapshot = self.snapshot
+        for key, value, expires_at in snapshot.entries():
+            with self._shard(key) as engine:
+                if key not in self._shadowed and engine.add(key, value, expires_at, RESTORED):
+                    self.warmed_keys += 1
+        # all the keys are loaded, stale snapshot entries no longer matter
+        with self._locked():
+            self.snapshot = None
+            self._shadowed = set()
+        self._warmed.set()
+        snapshot.close()
+
+    def _sync_every_second(self):
+        while True:
+            time.sleep(1)
+            self.log.sync()
+
+    @staticmethod
+    def _check_key(key):
+        if not isinstance(key, str):
+            raise TypeError(f"persisted keys should be str, not {type(key).__name__}")
+
+    def _log_write(self, engine, key, value, expires_at, stored, existed):
+        """Log a write of the key, under the lock of its shard.
+        :param stored: whether the engine stored the value.
+        :param existed: whether the key was stored before the write.
+        """
+        if stored:
+            self.log.set(key, value, expires_at)
+        elif existed and key not in engine:
+            # the engine did not admit the update but dropped the previous value
+            self.log.delete(key)
+        else:
+            return
+        self._written(key)
+
+    def _written(self, key):
+        """Record a write of the key, under the lock of its shard."""
+        if self.snapshot is not None:
+            self._shadowed.add(key)
+        if (self.snapshot is None and self.log.size >= self.max_log_bytes
+                and self._compact_lock.acquire(blocking=False)):
+            threading.Thread(target=self._compact_in_background, name="compaction", daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self._compact()
+        finally:
+            self._compact_lock.release()
+
+    def get(self, key, default=None):
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            return engine.get(key, default)
+
+    def set(self, key, value, expires_at=None, written_at=None):
+        self._check_key(key)
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            existed = key in engine
+            stored = engine.set(key, value, expires_at, written_at)
+            self._log_write(engine, key, value, expires_at, stored, existed)
+        return stored
+
+    def add(self, key, value, expires_at=None, written_at=None):
+        self._check_key(key)
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            stored = engine.add(key, value, expires_at, written_at)
+            self._log_write(engine, key, value, expires_at, stored, False)
+        return stored
+
+    def get_and_set(self, key, value, expires_at=None):
+        self._check_key(key)
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            existed = key in engine
+            previous = engine.get_and_set(key, value, expires_at)
+            self._log_write(engine, key, value, expires_at, key in engine, existed)
+        return previous
+
+    def compare_and_set(self, key, expected, value, expires_at=None):
+        self._check_key(key)
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            existed = key in engine
+            stored = engine.compare_and_set(key, expected, value, expires_at)
+            self._log_write(engine, key, value, expires_at, stored, existed)
+        return stored
+
+    def delete(self, key):
+        self._check_key(key)
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            deleted = engine.delete(key)
+            self.log.delete(key)
+            self._written(key)
+        return deleted
+
+    __setitem__ = set
+
+    def __getitem__(self, key):
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            return engine[key]
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self._shard(key) as engine:
+            self._fault(engine, key)
+            return key in engine
+
+    def scan(self, cursor=0, count=None, prefix=None):
+        # the keys of the snapshot not loaded yet would be missed, e.g. by
+        # a drain or a handoff
+        self._warmed.wait()
+        return super().scan(cursor, count, prefix)
+
+    def compact(self):
+        """Write the entries to a new snapshot and start a new log, skipped
+        while the previous snapshot is still being loaded.
+        Returns whether it compacted.
+        """
+        with self._compact_lock:
+            return self._compact()
+
+    def _compact(self):
+        if self.snapshot is not None or not self.log.size:
+            return False
+        start = time.monotonic()
+        generation = self.generation + 1
+        # the writes from now on go to the new log, those made while
+        # dumping the entries may be in both, replaying them is harmless
+        with self._locked():
+            old_log = self.log
+            self.log = AppendOnlyLog(self._log_path(generation), self.fsync)
+        try:
+            write_snapshot(self._snapshot_path, self.scan(), generation)
+        except BaseException:
+            # back to the old log, followed by the writes made meanwhile
+            with self._locked():
+                new_log = self.log
+                new_log.close()
+                old_log.extend(new_log.path)
+                os.remove(new_log.path)
+                self.log = old_log
+            raise
+        old_log.close()
+        self.generation = generation
+        for generation in self._log_generations():
+            if generation < self.generation:
+                os.remove(self._log_path(generation))
+        self.compactions += 1
+        self.last_compaction = time.monotonic() - start
+        return True
+
+    def close(self):
+        self.log.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats["persistence"] = {
+            "path": self.path,
+            "fsync": self.fsync,
+            "log_generation": self.generation,
+            "log_bytes": self.log.size,
+            "max_log_bytes": self.max_log_bytes,
+            "log_syncs": self.log.syncs,
+            "load_seconds": self.load_time,
+            "replayed_records": self.replayed_records,
+            "snapshot_keys": self.snapshot_keys,
+            "warming_up": self.snapshot is not None,
+            "warmed_keys": self.warmed_keys,
+            "snapshot_faults": self.snapshot_faults,
+            "compactions": self.compactions,
+            "last_compaction_seconds": self.last_compaction,
+        }
+        return stats
@@ -0,0 +1,369 @@
+import threading
+import time
+from array import array
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+from .storage import entry_size
+
+# the continuum points are 64 bits wide at most
+POINT_LIMIT = 1 << 64
+
+
+class MovedRanges:
+    """Continuum ranges whose replicas differ between two rings.
+
+    The boundaries of both continua split the ring in ranges routed to a
+    single position of each continuum; a range moved when its replica set
+    is not the same in the two rings.
+    """
+
+    def __init__(self, old_ring, new_ring, size):
+        """
+        :param old_ring: the HashRing before the membership change.
+        :param new_ring: the HashRing after the membership change.
+        :param size: the number of replicas of each key.
+        """
+        old, new = old_ring.runtime, new_ring.runtime
+        self._bounds = bounds = array("Q", sorted(set(old._keys).union(new._keys)))
+        # index of the range end in _bounds -> (old replicas, new replicas)
+        self._moves = {}
+        for j in range(len(bounds)):
+            # a key hashed in [bounds[j - 1], bounds[j]) goes to the first
+            # point above it, the same one for all the keys of the range
+            start = bounds[j - 1]
+            before = old.successors(old.position(start), size) if old._keys else []
+            after = new.successors(new.position(start), size) if new._keys else []
+            if set(before) != set(after):
+                self._moves[j] = (before, after)
+
+    def lookup(self, point):
+        """Returns the (old replicas, new replicas) of the range holding the
+        point, None when the range did not move.
+        """
+        if not self._moves:
+            return None
+        j = bisect(self._bounds, point)
+        return self._moves.get(j if j < len(self._bounds) else 0)
+
+    def spans(self):
+        """Returns the (start, end, old replicas, new replicas) of the moved
+        ranges, the range [start, end) wrapping around when start >= end.
+        """
+        bounds = self._bounds
+        return [
+            (bounds[j - 1], bounds[j], before, after)
+            for j, (before, after) in sorted(self._moves.items())
+        ]
+
+    def __len__(self):
+        return len(self._moves)
+
+
+def handoff_sender(before, new_ring):
+    """Returns the old replica streaming a moved range to its new replicas,
+    the first one still in the ring, None when they all left.
+    """
+    for nodename in before:
+        if nodename in new_ring.nodes:
+            return nodename
+    return None
+
+
+class IncomingRanges:
+    """Ranges a peer is streaming to this node.
+    Reads of a key missing from such a range fall back to the sender until
+    it reports the transfer complete, or `timeout` seconds passed.
+    """
+
+    def __init__(self, private_dns, spans, timeout):
+        self.private_dns = private_dns
+        self.deadline = time.monotonic() + timeout
+        ranges = []
+        for start, end in spans:
+            if start < end:
+                ranges.append((start, end))
+            else:
+                ranges.extend([(start, POINT_LIMIT), (0, end)])
+        ranges.sort()
+        self._starts = [start for start, _ in ranges]
+        self._ends = [end for _, end in ranges]
+
+    def __contains__(self, point):
+        i = bisect(self._starts, point) - 1
+        return i >= 0 and point < self._ends[i]
+
+
+class DrainProgress:
+    """Progress of a node streaming all its keys away before leaving."""
+
+    def __init__(self):
+        self.state = 'draining'
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        # an entry is a key sent to one of its new replicas
+        self.total_entries = 0
+        self.total_bytes = 0
+        self.sent_entries = 0
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, entries, size):
+        with self._lock:
+            self.sent_entries += entries
+            self.sent_bytes += size
+
+    def finish(self, error=None):
+        self.state = 'failed' if error else 'drained'
+        self.error = error
+        self.finished_at = time.time()
+
+    def stats(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            'state': self.state,
+            'error': self.error,
+            'elapsed': elapsed,
+            'total_entries': self.total_entries,
+            'total_bytes': self.total_bytes,
+            'sent_entries': self.sent_entries,
+            'sent_bytes': self.sent_bytes,
+            'progress': self.sent_entries / self.total_entries if self.total_entries else None,
+            'keys_per_second': self.sent_entries / elapsed if elapsed else None,
+            'mb_per_second': self.sent_bytes / (1 << 20) / elapsed if elapsed else None,
+        }
+
+
+class Rebalancer:
+    """Stream the keys whose replicas changed after a membership change to
+    their new replicas, instead of letting them miss there.
+
+    For each moved range, the first old replica still in the ring streams
+    the keys it holds to the new replicas, in chunks each sent once the
+    previous one was acknowledged so that a slow receiver slows the stream
+    down. Keys this node no longer replicates are released once streamed.
+
+    A node leaving the ring drains first: it streams all its keys to the
+    replicas they get without it.
+    """
+
+    def __init__(self, instance_id, storage, client, replicas, chunk_size=500,
+                 chunk_bytes=1 << 20, concurrency=2, timeout=60.0):
+        """
+        :param replicas: the number of replicas of each key.
+        :param chunk_size: maximum number of keys sent in a single request.
+        :param chunk_bytes: maximum approximate size of a single request.
+        :param concurrency: maximum number of peers streamed to at once.
+        :param timeout: seconds after which an incoming transfer that did
+                        not report its completion is considered complete.
+        """
+        self.instance_id = instance_id
+        self.storage = storage
+        self.client = client
+        self.replicas = replicas
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='handoff')
+
+        # sender instance id -> ranges it is streaming to this node
+        self._incoming = {}
+        self._lock = threading.Lock()
+        # progress of the drain of this node, None until it drains
+        self.draining = None
+
+        self.rebalances = 0
+        # (old, new) versions of the ring of the last rebalance
+        self.ring_versions = None
+        self.streamed_keys = 0
+        self.streamed_chunks = 0
+        self.failed_streams = 0
+        self.released_keys = 0
+        self.fallback_reads = 0
+
+    def rebalance(self, old_ring, new_ring):
+        """Stream, in the background, the local keys of the ranges this node
+        sends to new replicas.
+        :param old_ring: a copy of the HashRing before the membership change.
+        :param new_ring: a copy of the HashRing after the membership change.
+        """
+        moved = MovedRanges(old_ring, new_ring, self.replicas)
+        if not moved:
+            return
+        self.rebalances += 1
+        self.ring_versions = (old_ring.version, new_ring.version)
+        threading.Thread(
+            target=self._stream, args=(moved, new_ring), name='rebalance', daemon=True
+        ).start()
+
+    def _stream(self, moved, new_ring):
+        spans = {}
+        for start, end, before, after in moved.spans():
+            if handoff_sender(before, new_ring) != self.instance_id:
+                continue
+            for nodename in after:
+                if nodename not in before:
+                    spans.setdefault(nodename, []).append((start, end))
+
+        sender = new_ring.nodes.get(self.instance_id, {}).get('instance')
+        futures = {
+            nodename: self.executor.submit(
+                self._stream_to, sender, new_ring.nodes[nodename]['instance'], spans[nodename],
+                self._moved_entries(moved, new_ring, nodename))
+            for nodename in spans if sender and new_ring.nodes[nodename]['instance']
+        }
+        streamed = {nodename for nodename, future in futures.items() if future.result()}
+
+        # a draining node keeps serving its keys until it is terminated
+        if self.draining is not None:
+            return
+        for key, _, _ in self.storage.scan():
+            move = moved.lookup(new_ring.hashi(key))
+            if move is None or self.instance_id in move[1]:
+                continue
+            before, after = move
+            # the keys of a range this node failed to stream are kept, the
+            # sender of a range keeps them on failure when it is another node
+            if handoff_sender(before, new_ring) == self.instance_id and any(
+                nodename not in before and nodename not in streamed for nodename in after
+            ):
+                continue
+            if self.storage.delete(key):
+                self.released_keys += 1
+
+    def _moved_entries(self, moved, new_ring, nodename):
+        """Yields the local entries this node streams to the given new
+        replica, read from the storage as the stream goes.
+        """
+        for key, value, expires_at in self.storage.scan():
+            move = moved.lookup(new_ring.hashi(key))
+            if move is None:
+                continue
+            before, after = move
+            if (nodename in after and nodename not in before
+                    and handoff_sender(before, new_ring) == self.instance_id):
+                yield key, value, expires_at
+
+    def _drained_entries(self, moved, ring, nodename):
+        """Yields the local entries a draining node streams to the given
+        replica, read from the storage as the stream goes.
+        """
+        for key, value, expires_at in self.storage.scan():
+            move = moved.lookup(ring.hashi(key))
+            # keys out of the ranges of this node are left-overs of earlier
+            # membership changes
+            if move is not None and self.instance_id in move[0] and nodename in move[1]:
+                yield key, value, expires_at
+
+    def drain(self, ring):
+        """Stream, in the background, all the local keys to the replicas
+        they get once this node leaves the ring. Returns the DrainProgress,
+        a drain already in progress or completed is not restarted.
+        :param ring: a copy of the current HashRing.
+        """
+        with self._lock:
+            if self.draining is None or self.draining.state == 'failed':
+                self.draining = DrainProgress()
+                threading.Thread(
+                    target=self._drain, args=(ring, self.draining), name='drain', daemon=True
+                ).start()
+            return self.draining
+
+    def _drain(self, ring, progress):
+        sender = ring.nodes.get(self.instance_id, {}).get('instance')
+        if sender is None:
+            return progress.finish("the node is not in the ring")
+        new_ring = ring.snapshot()
+        new_ring.apply_membership(removed=[self.instance_id])
+        if not new_ring.nodes:
+            return progress.finish("no other node to drain to")
+
+        # the remaining replicas get the keys too, the successors of this
+        # node are promoted and may have missed some of its writes
+        moved = MovedRanges(ring, new_ring, self.replicas)
+        spans = {}
+        for start, end, before, after in moved.spans():
+            if self.instance_id in before:
+                for nodename in after:
+                    spans.setdefault(nodename, []).append((start, end))
+        # counted by a first scan, the entries are read again as they stream
+        for key, value, _ in self.storage.scan():
+            move = moved.lookup(ring.hashi(key))
+            if move is not None and self.instance_id in move[0]:
+                progress.total_entries += len(move[1])
+                progress.total_bytes += entry_size(key, value) * len(move[1])
+
+        futures = [
+            self.executor.submit(self._stream_to, sender, new_ring.nodes[nodename]['instance'],
+                                 spans[nodename], self._drained_entries(moved, ring, nodename),
+                                 progress)
+            for nodename in spans if new_ring.nodes[nodename]['instance']
+        ]
+        failed = sum(not future.result() for future in futures)
+        progress.finish(f"{failed} of the {len(futures)} streams failed" if failed else None)
+
+    def _chunks(self, entries):
+        chunk, size = [], 0
+        for key, value, expires_at in entries:
+            chunk.append({'key': key, 'value': value, 'expires_at': expires_at})
+            size += entry_size(key, value)
+            if len(chunk) >= self.chunk_size or size >= self.chunk_bytes:
+                yield chunk, size
+                chunk, size = [], 0
+        if chunk:
+            yield chunk, size
+
+    def _stream_to(self, sender, datanode, spans, entries, progress=None):
+        """Returns whether all the entries reached the new replica."""
+        try:
+            self.client.handoff_begin(datanode.private_dns, sender, spans)
+            for chunk, size in self._chunks(entries):
+                self.client.handoff(datanode.private_dns, chunk)
+                self.streamed_chunks += 1
+                self.streamed_keys += len(chunk)
+                if progress is not None:
+                    progress.record(len(chunk), size)
+            self.client.handoff_end(datanode.private_dns, self.instance_id)
+        except Exception:
+            self.failed_streams += 1
+            return False
+        return True
+
+    def begin(self, sender, private_dns, spans):
+        """Register the ranges a peer starts streaming to this node."""
+        with self._lock:
+            self._incoming[sender] = IncomingRanges(private_dns, spans, self.timeout)
+
+    def end(self, sender):
+        with self._lock:
+            self._incoming.pop(sender, None)
+
+    def source(self, point):
+        """Returns the private dns of the peer streaming the range holding
+        the point to this node, None when no transfer is pending for it.
+        """
+        if not self._incoming:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            for sender, incoming in list(self._incoming.items()):
+                if incoming.deadline < now:
+                    del self._incoming[sender]
+                elif point in incoming:
+                    self.fallback_reads += 1
+                    return incoming.private_dns
+        return None
+
+    def stats(self):
+        return {
+            'rebalances': self.rebalances,
+            'ring_versions': self.ring_versions,
+            'streamed_keys': self.streamed_keys,
+            'streamed_chunks': self.streamed_chunks,
+            'failed_streams': self.failed_streams,
+            'released_keys': self.released_keys,
+            'incoming_transfers': len(self._incoming),
+            'fallback_reads': self.fallback_reads,
+            'drain': self.draining.stats() if self.draining else None,
+        }
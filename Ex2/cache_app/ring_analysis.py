@@ -0,0 +1,194 @@
+"""Distribution analysis of a hash ring: the share of the keyspace owned by
+each node, the imbalance factor, the key movement of a proposed membership
+change and the load of a sample of keys, with and without bounded loads.
+
+    python -m cache_app.ring_analysis --nodes a b c [--add d] [--remove a]
+        [--replicas 2] [--vnodes 160] [--hash-fn md5]
+        [--keys <file of "key [load]" lines> | --sample 100000 --skew 1.0]
+        [--requests 100000] [--load-factor 0.25]
+"""
+import argparse
+import random
+import sys
+
+from .hash_ring import HashRing, LoadTracker
+from .rebalance import MovedRanges
+
+
+def keyspace(ring):
+    """Returns the number of points of the continuum of the ring."""
+    return 1 << ring.runtime._hasher.width
+
+
+def ownership(ring, size=1):
+    """Returns the {node name: fraction of the keyspace} the nodes hold,
+    the fractions summing to `size`.
+    :param size: the number of replicas of each key.
+    """
+    runtime = ring.runtime
+    keys = runtime._keys
+    space = keyspace(ring)
+    owned = dict.fromkeys(runtime._nodes, 0)
+    for pos in range(len(keys)):
+        # the keys hashed right below a point go to it
+        length = (keys[pos] - keys[pos - 1]) % space or space
+        for nodename in runtime.successors(pos, size):
+            owned[nodename] += length
+    return {nodename: length / space for nodename, length in owned.items()}
+
+
+def imbalance(ring, shares):
+    """Returns the largest ratio of a node share to its fair share, the one
+    its weight entitles it to; 1.0 is a perfect balance.
+    :param shares: {node name: share} e.g. as returned by ownership().
+    """
+    nodes = ring.nodes
+    total_share = sum(shares.values())
+    total_weight = sum(nodes[nodename]["weight"] for nodename in shares)
+    if not total_share or not total_weight:
+        return None
+    return max(
+        (share / total_share) / (nodes[nodename]["weight"] / total_weight)
+        for nodename, share in shares.items()
+    )
+
+
+def movement(ring, added=None, removed=None, size=1):
+    """Returns the key movement of a membership change: the fraction of the
+    keys whose replicas change, of the key copies to transfer, and the
+    fraction of the keyspace each node gains and loses.
+    :param added: nodes to add or update, see HashRing.apply_membership.
+    :param removed: names of the nodes to remove.
+    :param size: the number of replicas of each key.
+    """
+    proposed = ring.snapshot()
+    proposed.apply_membership(added, removed)
+    space = keyspace(ring)
+    moved = 0
+    gained, lost = {}, {}
+    for start, end, before, after in MovedRanges(ring, proposed, size).spans():
+        length = (end - start) % space or space
+        moved += length
+        for nodename in after:
+            if nodename not in before:
+                gained[nodename] = gained.get(nodename, 0) + length / space
+        for nodename in before:
+            if nodename not in after:
+                lost[nodename] = lost.get(nodename, 0) + length / space
+    return {
+        "moved_keys": moved / space,
+        "transferred_copies": sum(gained.values()) / size,
+        "gained": gained,
+        "lost": lost,
+        "proposed": proposed,
+    }
+
+
+def key_loads(ring, keys, size=1, load_factor=None, requests=100000, seed=0):
+    """Returns the {node name: fraction of the requests} of a stream of
+    requests of the keys, routed to their owner, or with bounded loads to
+    the first of their `size` replicas under the bound when `load_factor`
+    is set.
+    :param keys: list of (key, load) tuples, the requests pick the keys in
+                 proportion to their load, e.g. their request counts.
+    :param requests: the number of simulated requests.
+    """
+    simulated = ring.snapshot()
+    simulated.load_factor = load_factor
+    simulated.loads = LoadTracker(half_life=None)
+    loads = dict.fromkeys(ring.nodes, 0)
+    stream = random.Random(seed).choices(
+        [key for key, _ in keys], [load for _, load in keys], k=requests)
+    for key in stream:
+        loads[simulated.get_bounded(key, size)["nodename"]] += 1
+    return {nodename: load / requests for nodename, load in loads.items()}
+
+
+def sample_keys(count, skew=1.0):
+    """Returns `count` (key, load) tuples with a zipf distributed load."""
+    return [(f"key-{i}", 1 / (i + 1) ** skew) for i in range(count)]
+
+
+def read_keys(path):
+    """Returns the (key, load) tuples of a file of "key [load]" lines."""
+    keys = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                keys.append((fields[0], float(fields[1]) if len(fields) > 1 else 1.0))
+    return keys
+
+
+def _table(rows):
+    nodes = sorted(set().union(*(row for _, row in rows)))
+    lines = [f"{'node':16}" + "".join(f"{title:>16}" for title, _ in rows)]
+    for nodename in nodes:
+        lines.append(f"{nodename:16}" + "".join(
+            f"{row[nodename] * 100:15.2f}%" if nodename in row else f"{'-':>16}"
+            for _, row in rows
+        ))
+    return "\n".join(lines)
+
+
+def ownership_report(ring, size=1):
+    """Returns the text report of the keyspace share of each node."""
+    if not ring.size:
+        return "Continuum empty"
+    rows = [("primary", ownership(ring, 1))]
+    if size > 1:
+        rows.append((f"{size} replicas", ownership(ring, size)))
+    lines = [
+        f"{len(ring.nodes)} nodes, {ring.size} points in continuum",
+        _table(rows),
+    ]
+    for title, shares in rows:
+        lines.append(f"imbalance factor ({title}): {imbalance(ring, shares):.3f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", nargs="+", required=True, help="the nodes of the ring")
+    parser.add_argument("--add", nargs="*", default=[], help="nodes the proposed change adds")
+    parser.add_argument("--remove", nargs="*", default=[], help="nodes the proposed change removes")
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--vnodes", type=int, default=160)
+    parser.add_argument("--hash-fn", default="md5")
+    parser.add_argument("--keys", help='file of "key [load]" lines')
+    parser.add_argument("--sample", type=int, help="number of zipf distributed sample keys")
+    parser.add_argument("--skew", type=float, default=1.0, help="zipf exponent of the sample keys")
+    parser.add_argument("--requests", type=int, default=100000, help="number of simulated requests")
+    parser.add_argument("--load-factor", type=float, help="epsilon of the bounded loads")
+    args = parser.parse_args(argv)
+
+    ring = HashRing(
+        {nodename: {"vnodes": args.vnodes} for nodename in args.nodes},
+        hash_fn=args.hash_fn, preference_size=args.replicas,
+    )
+    print(ownership_report(ring, args.replicas))
+
+    if args.add or args.remove:
+        added = {nodename: {"vnodes": args.vnodes} for nodename in args.add}
+        moved = movement(ring, added, args.remove, args.replicas)
+        print(f"\nadding {args.add or '-'}, removing {args.remove or '-'}:")
+        print(f"keys changing replicas: {moved['moved_keys'] * 100:.2f}%,"
+              f" key copies to transfer: {moved['transferred_copies'] * 100:.2f}%")
+        print(_table([("gains", moved["gained"]), ("loses", moved["lost"])]))
+        print(ownership_report(moved["proposed"], args.replicas))
+
+    keys = read_keys(args.keys) if args.keys else (
+        sample_keys(args.sample, args.skew) if args.sample else None)
+    if keys:
+        rows = [("request load", key_loads(ring, keys, requests=args.requests))]
+        if args.load_factor is not None:
+            rows.append((f"bounded {args.load_factor}", key_loads(
+                ring, keys, args.replicas, args.load_factor, args.requests)))
+        print(f"\n{args.requests} requests of {len(keys)} keys:")
+        print(_table(rows))
+        for title, shares in rows:
+            print(f"imbalance factor ({title}): {imbalance(ring, shares):.3f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
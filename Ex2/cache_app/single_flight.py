@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class FlightTimeout(Exception):
+    pass
+
+
+class SingleFlight:
+    """De-duplicate concurrent calls: the first caller of a key runs the
+    call, the callers arriving while it is in flight share its result or
+    its error instead of running it again.
+    """
+
+    def __init__(self, timeout=None):
+        """
+        :param timeout: seconds a caller waits for the in-flight call of
+                        another caller, None to wait until it completes.
+        """
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # key -> future of the in-flight call
+        self._flights = {}
+
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            try:
+                return future.result(self.timeout)
+            except FutureTimeout:
+                self.timeouts += 1
+                raise FlightTimeout(f"no answer after {self.timeout}s from the in-flight call")
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                if self._flights.get(key) is future:
+                    del self._flights[key]
+
+    def forget(self, key):
+        """Let the next callers of the key run a new call instead of sharing
+        the in-flight one, e.g. once the result it will return is stale.
+        """
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def stats(self):
+        total = self.calls + self.coalesced
+        return {
+            'timeout': self.timeout,
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'coalesce_rate': self.coalesced / total if total else None,
+            'timeouts': self.timeouts,
+            'in_flight': len(self._flights),
+        }
@@ -0,0 +1,751 @@
+import bisect
+import heapq
+import random
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import blake2b
+
+# approximate bookkeeping cost of an entry: its dict slot plus the
+# policy's own slot for the key
+ENTRY_OVERHEAD = 64 + 104
+
+
+def entry_size(key, value):
+    """Returns the approximate number of bytes used to store the entry.
+    Containers (as decoded from JSON) are sized recursively.
+    """
+    return ENTRY_OVERHEAD + _sizeof(key) + _sizeof(value)
+
+
+def _sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_sizeof(item) for item in obj)
+    return size
+
+
+class EvictionPolicy:
+    """Decide which key leaves the storage when it is full."""
+
+    def insert(self, key):
+        raise NotImplementedError
+
+    def touch(self, key):
+        raise NotImplementedError
+
+    def remove(self, key):
+        raise NotImplementedError
+
+    def victim(self):
+        """Returns the next key to evict."""
+        raise NotImplementedError
+
+    def record(self, key):
+        """Record an access to the key, whether it is stored or not."""
+
+    def admit(self, key, victim):
+        """Returns whether the key may replace the victim."""
+        return True
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evict the least recently used key."""
+
+    def __init__(self):
+        self._order = OrderedDict()
+
+    def insert(self, key):
+        self._order[key] = None
+
+    def touch(self, key):
+        self._order.move_to_end(key)
+
+    def remove(self, key):
+        self._order.pop(key, None)
+
+    def victim(self):
+        return next(iter(self._order))
+
+
+class LFUPolicy(EvictionPolicy):
+    """Evict the least frequently used key, the least recently used one
+    among equally frequent keys.
+    The frequency is a logarithmic counter saturating at 255 (as redis does)
+    so that all the operations stay O(1).
+    """
+
+    MAX_COUNT = 255
+
+    def __init__(self, log_factor=10):
+        self._log_factor = log_factor
+        self._counts = {}
+        # count -> keys with that count, in LRU order
+        self._buckets = {}
+        self._min_count = 0
+
+    def _bucket(self, count):
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = OrderedDict()
+        return bucket
+
+    def insert(self, key):
+        self._counts[key] = 1
+        self._bucket(1)[key] = None
+        self._min_count = 1
+
+    def touch(self, key):
+        count = self._counts[key]
+        if count >= self.MAX_COUNT or not self._should_increment(count):
+            self._buckets[count].move_to_end(key)
+            return
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        self._counts[key] = count + 1
+        self._bucket(count + 1)[key] = None
+
+    def _should_increment(self, count):
+        return random.random() < 1.0 / ((count - 1) * self._log_factor + 1)
+
+    def remove(self, key):
+        count = self._counts.pop(key, None)
+        if count is None:
+            return
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+    def victim(self):
+        bucket = self._buckets.get(self._min_count)
+        if not bucket:
+            self._min_count = min(self._buckets)
+            bucket = self._buckets[self._min_count]
+        return next(iter(bucket))
+
+
+class FrequencySketch:
+    """Count-min sketch of the recent access frequency of keys.
+    Counters are halved every `sample_size` records so that the sketch
+    follows the popularity of the keys over time.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width=4096, sample_size=None):
+        self._width = 1 << max(1, (width - 1).bit_length())
+        self._rows = [bytearray(self._width) for _ in range(self.DEPTH)]
+        self._sample_size = sample_size or 10 * self._width
+        self._records = 0
+
+    def _indexes(self, key):
+        digest = blake2b(str(key).encode("utf-8"), digest_size=4 * self.DEPTH).digest()
+        mask = self._width - 1
+        return [
+            int.from_bytes(digest[4 * i:4 * i + 4], "little") & mask
+            for i in range(self.DEPTH)
+        ]
+
+    def record(self, key):
+        for row, i in zip(self._rows, self._indexes(key)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+        self._records += 1
+        if self._records >= self._sample_size:
+            self._reset()
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self._rows, self._indexes(key)))
+
+    def _reset(self):
+        self._records //= 2
+        for row in self._rows:
+            row[:] = bytes(count >> 1 for count in row)
+
+
+class TinyLFUPolicy(LRUPolicy):
+    """LRU eviction behind a TinyLFU admission filter: a new key only
+    replaces the LRU victim when it was accessed more often recently.
+    """
+
+    def __init__(self, width=4096):
+        super().__init__()
+        self.sketch = FrequencySketch(width)
+
+    def record(self, key):
+        self.sketch.record(key)
+
+    def admit(self, key, victim):
+        return self.sketch.estimate(key) > self.sketch.estimate(victim)
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "tinylfu": TinyLFUPolicy,
+}
+
+
+class ExpiryWheel:
+    """Bucket keys by the tick of their expiration time, so that expired
+    keys are reclaimed in amortized O(1) without scanning the storage.
+    Buckets may hold keys that were since updated or deleted, the caller
+    checks the actual expiration time of each returned key.
+    """
+
+    def __init__(self, resolution=1.0, now=None):
+        """
+        :param resolution: the duration of a tick, in seconds.
+        """
+        self.resolution = resolution
+        # tick -> keys expiring during that tick
+        self._buckets = {}
+        self._cursor = self._tick(time.time() if now is None else now)
+
+    def _tick(self, timestamp):
+        return int(timestamp // self.resolution)
+
+    def schedule(self, key, expires_at):
+        tick = max(self._tick(expires_at), self._cursor)
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            bucket = self._buckets[tick] = []
+        bucket.append(key)
+
+    def advance(self, now):
+        """Returns the keys of the ticks that fully elapsed since the last call."""
+        tick = self._tick(now)
+        if tick <= self._cursor:
+            return []
+        if tick - self._cursor > len(self._buckets):
+            # long idle period, only visit the existing buckets
+            ticks = [t for t in self._buckets if t < tick]
+        else:
+            ticks = range(self._cursor, tick)
+        self._cursor = tick
+        expired = []
+        for t in ticks:
+            expired.extend(self._buckets.pop(t, ()))
+        return expired
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+
+class StorageEngine:
+    """Byte bounded key/value storage of a cache node.
+
+    Once `max_bytes` is reached, the eviction policy picks the keys to drop.
+    Entries may carry an absolute expiration time, expired entries are
+    dropped lazily on read and by the expiry wheel on each operation.
+    Not thread-safe, see ShardedStorage.
+    """
+
+    def __init__(self, max_bytes=None, policy="lru", expiry_resolution=1.0):
+        """
+        :param max_bytes: the byte budget of the entries, None for unbounded.
+        :param policy: an EvictionPolicy or one of the EVICTION_POLICIES names.
+        :param expiry_resolution: the tick of the expiry wheel, in seconds.
+        """
+        if isinstance(policy, str):
+            try:
+                policy = EVICTION_POLICIES[policy]()
+            except KeyError:
+                raise ValueError(
+                    "unknown eviction policy '{}', available: {}".format(
+                        policy, list(EVICTION_POLICIES)
+                    )
+                )
+        self.policy = policy
+        self.max_bytes = max_bytes
+
+        # key -> (value, size, expires_at)
+        self._data = {}
+        self.bytes_used = 0
+        self._expiry = ExpiryWheel(expiry_resolution)
+        # notified of the stored and removed keys, e.g. a MerkleIndex
+        self.listener = None
+        # the sorted (key_hash, key) of the keys, built by a scan, then
+        # patched with the keys stored or removed since
+        self._positions = None
+        self._moved = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.rejections = 0
+        self.expirations = 0
+
+    def _lookup(self, key, now):
+        """Returns the live entry of the key, dropping it when expired."""
+        entry = self._data.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= now:
+            self.delete(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def expire(self, now=None):
+        """Drop the entries whose expiration time has passed."""
+        now = time.time() if now is None else now
+        for key in self._expiry.advance(now):
+            self._lookup(key, now)
+
+    def get(self, key, default=None):
+        now = time.time()
+        self.expire(now)
+        self.policy.record(key)
+        entry = self._lookup(key, now)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.policy.touch(key)
+        return entry[0]
+
+    def set(self, key, value, expires_at=None, written_at=None):
+        """Store the value, returns False when it was not admitted.
+        :param expires_at: absolute expiration time of the entry (epoch
+                           seconds), None to keep it until evicted.
+        :param written_at: time the value was written, reported to the
+                           listener, now by default.
+        """
+        now = time.time()
+        self.expire(now)
+        self.policy.record(key)
+        # an update is already admitted, it replaces the previous value
+        updated = self.delete(key)
+        if expires_at is not None and expires_at <= now:
+            return False
+
+        size = entry_size(key, value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.rejections += 1
+            return False
+        if self.max_bytes is not None and self._data and self.bytes_used + size > self.max_bytes:
+            # decided against the first victim, before evicting any key
+            if not updated and not self.policy.admit(key, self.policy.victim()):
+                self.rejections += 1
+                return False
+            while self._data and self.bytes_used + size > self.max_bytes:
+                self._drop(self.policy.victim())
+                self.evictions += 1
+        self._data[key] = (value, size, expires_at)
+        self.bytes_used += size
+        if self._positions is not None:
+            self._move(key)
+        self.policy.insert(key)
+        if expires_at is not None:
+            self._expiry.schedule(key, expires_at)
+        if self.listener is not None:
+            self.listener.stored(key, value, expires_at, now if written_at is None else written_at)
+        return True
+
+    def add(self, key, value, expires_at=None, written_at=None):
+        """Store the value only when the key is missing, returns whether it
+        was stored.
+        """
+        if self._lookup(key, time.time()) is not None:
+            return False
+        return self.set(key, value, expires_at, written_at)
+
+    def get_and_set(self, key, value, expires_at=None):
+        """Store the value, returns the previous one."""
+        entry = self._lookup(key, time.time())
+        self.set(key, value, expires_at)
+        return entry[0] if entry is not None else None
+
+    def compare_and_set(self, key, expected, value, expires_at=None):
+        """Store the value only when the current one equals `expected`,
+        None standing for a missing key. Returns whether it was stored.
+        """
+        entry = self._lookup(key, time.time())
+        current = entry[0] if entry is not None else None
+        if current != expected:
+            return False
+        return self.set(key, value, expires_at)
+
+    def _drop(self, key):
+        _, size, _ = self._data.pop(key)
+        self.bytes_used -= size
+        self.evicted_bytes += size
+        if self._positions is not None:
+            self._move(key)
+        self.policy.remove(key)
+        if self.listener is not None:
+            self.listener.removed(key)
+
+    def delete(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes_used -= entry[1]
+        if self._positions is not None:
+            self._move(key)
+        self.policy.remove(key)
+        if self.listener is not None:
+            self.listener.removed(key)
+        return True
+
+    __setitem__ = set
+
+    def __getitem__(self, key):
+        entry = self._lookup(key, time.time())
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._lookup(key, time.time()) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def _move(self, key):
+        self._moved.add(key)
+        # past that sorting them again is cheaper, until the next scan
+        if len(self._moved) > len(self._positions) // 8:
+            self._positions = None
+            self._moved.clear()
+
+    def scan_positions(self, start, count, after=None):
+        """Returns up to `count` of the sorted (key_hash, key) of the keys,
+        from the hash `start` or following the position `after`.
+
+        The positions are sorted once, then only the keys stored or removed
+        since are moved, so a page costs O(count + log n) plus the writes.
+        """
+        positions = self._positions
+        if positions is None:
+            positions = self._positions = sorted((key_hash(key), key) for key in self._data)
+        else:
+            for key in self._moved:
+                position = (key_hash(key), key)
+                i = bisect.bisect_left(positions, position)
+                present = i < len(positions) and positions[i] == position
+                if key in self._data:
+                    if not present:
+                        positions.insert(i, position)
+                elif present:
+                    del positions[i]
+        self._moved.clear()
+        if after is None:
+            i = bisect.bisect_left(positions, (start,))
+        else:
+            i = bisect.bisect_right(positions, after)
+        return positions[i:i + count]
+
+    def items(self):
+        now = time.time()
+        return [
+            (key, value)
+            for key, (value, _, expires_at) in self._data.items()
+            if expires_at is None or expires_at > now
+        ]
+
+    def entries(self):
+        """Returns the (key, value, expires_at) tuples of the live entries."""
+        now = time.time()
+        return [
+            (key, value, expires_at)
+            for key, (value, _, expires_at) in self._data.items()
+            if expires_at is None or expires_at > now
+        ]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "keys": len(self._data),
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "policy": type(self.policy).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "rejections": self.rejections,
+            "expirations": self.expirations,
+            "scheduled_expirations": len(self._expiry),
+        }
+
+
+class _Shard:
+    """A StorageEngine and the lock guarding it, counting how often the
+    lock was already held when acquired.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.wait_time += time.perf_counter() - start
+            self.contended += 1
+        self.acquisitions += 1
+        return self.engine
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+# scan cursors are the shard index * SHARD_SPAN + the hash of the key
+SHARD_SPAN = 1 << 64
+
+
+def key_hash(key):
+    """Returns the 64 bits hash of the key ordering the scans, unlike hash()
+    the same in every process so that the scan cursors outlive a restart.
+    """
+    return int.from_bytes(blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class ScanPage:
+    """Iterates the (key, value, expires_at) of up to `count` live entries of
+    a ShardedStorage, ordered by shard and key hash from the given cursor.
+
+    The order does not depend on the other keys, so resuming from `cursor`
+    returns every key kept during the whole scan exactly once, whatever was
+    written or deleted meanwhile (keys with the same hash may repeat). The
+    positions of the keys are read by batches from the sorted ones each shard
+    keeps, see StorageEngine.scan_positions.
+    """
+
+    def __init__(self, storage, cursor=0, count=None, prefix=None, batch_size=100):
+        """
+        :param cursor: where the page starts, 0 for the first page.
+        :param count: the maximum number of keys of the page, None for all.
+        :param prefix: only scan the keys starting with it.
+        :param batch_size: the number of keys read per lock acquisition.
+        """
+        if cursor < 0 or cursor >= len(storage._shards) * SHARD_SPAN:
+            raise ValueError("invalid scan cursor")
+        if count is not None and count < 1:
+            raise ValueError("count should be a positive number of keys")
+        self.storage = storage
+        self.count = count
+        self.prefix = prefix
+        self.batch_size = batch_size
+        # where the next page starts once iterated, 0 when the scan completed
+        self.cursor = cursor
+
+    def __iter__(self):
+        shards = self.storage._shards
+        index, start = divmod(self.cursor, SHARD_SPAN)
+        remaining = self.count
+        while index < len(shards):
+            shard = shards[index]
+            after = None
+            while True:
+                with shard as engine:
+                    positions = engine.scan_positions(start, self.batch_size, after)
+                    now = time.time()
+                    batch = [
+                        (position, engine._lookup(position[1], now))
+                        for position in positions
+                        if self.prefix is None
+                        or (isinstance(position[1], str) and position[1].startswith(self.prefix))
+                    ]
+                for position, entry in batch:
+                    if remaining is not None and not remaining:
+                        self.cursor = index * SHARD_SPAN + position[0]
+                        return
+                    if entry is not None:
+                        yield position[1], entry[0], entry[2]
+                        if remaining is not None:
+                            remaining -= 1
+                if len(positions) < self.batch_size:
+                    break
+                after = positions[-1]
+            index, start = index + 1, 0
+            if remaining is not None and not remaining:
+                self.cursor = index * SHARD_SPAN if index < len(shards) else 0
+                return
+        self.cursor = 0
+
+
+class ShardedStorage:
+    """Thread-safe storage partitioning the keys across lock-striped
+    StorageEngine shards, so that concurrent requests only contend on the
+    keys of the same shard.
+
+    Each shard evicts on its own, within an equal part of `max_bytes`.
+    """
+
+    # counters summed across the shards
+    COUNTERS = (
+        "keys", "bytes_used", "hits", "misses", "evictions", "evicted_bytes",
+        "rejections", "expirations", "scheduled_expirations",
+    )
+
+    def __init__(self, max_bytes=None, policy="lru", expiry_resolution=1.0, shards=16,
+                 listener=None):
+        """
+        :param max_bytes: the byte budget of the entries, None for unbounded.
+        :param policy: one of the EVICTION_POLICIES names, or an
+                       EvictionPolicy class, instantiated for each shard.
+        :param expiry_resolution: the tick of the expiry wheels, in seconds.
+        :param shards: the number of shards.
+        :param listener: notified of the stored and removed keys of all the
+                         shards, under the lock of the shard.
+        """
+        if isinstance(policy, str):
+            if policy not in EVICTION_POLICIES:
+                raise ValueError(
+                    "unknown eviction policy '{}', available: {}".format(
+                        policy, list(EVICTION_POLICIES)
+                    )
+                )
+            policy = EVICTION_POLICIES[policy]
+        if shards < 1:
+            raise ValueError("shards should be a positive number")
+        self.max_bytes = max_bytes
+        shard_bytes = max_bytes // shards if max_bytes is not None else None
+        self._shards = [
+            _Shard(StorageEngine(shard_bytes, policy(), expiry_resolution))
+            for _ in range(shards)
+        ]
+        for shard in self._shards:
+            shard.engine.listener = listener
+
+    def _shard(self, key):
+        # a stable hash, the shard index is part of the scan cursors
+        return self._shards[zlib.crc32(str(key).encode("utf-8")) % len(self._shards)]
+
+    def get(self, key, default=None):
+        with self._shard(key) as engine:
+            return engine.get(key, default)
+
+    def set(self, key, value, expires_at=None, written_at=None):
+        with self._shard(key) as engine:
+            return engine.set(key, value, expires_at, written_at)
+
+    def add(self, key, value, expires_at=None, written_at=None):
+        with self._shard(key) as engine:
+            return engine.add(key, value, expires_at, written_at)
+
+    def get_and_set(self, key, value, expires_at=None):
+        with self._shard(key) as engine:
+            return engine.get_and_set(key, value, expires_at)
+
+    def compare_and_set(self, key, expected, value, expires_at=None):
+        with self._shard(key) as engine:
+            return engine.compare_and_set(key, expected, value, expires_at)
+
+    def delete(self, key):
+        with self._shard(key) as engine:
+            return engine.delete(key)
+
+    def expire(self, now=None):
+        for shard in self._shards:
+            with shard as engine:
+                engine.expire(now)
+
+    __setitem__ = set
+
+    def __getitem__(self, key):
+        with self._shard(key) as engine:
+            return engine[key]
+
+    def __delitem__(self, key):
+        with self._shard(key) as engine:
+            del engine[key]
+
+    def __contains__(self, key):
+        with self._shard(key) as engine:
+            return key in engine
+
+    def __len__(self):
+        return sum(len(shard.engine) for shard in self._shards)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        keys = []
+        for shard in self._shards:
+            with shard as engine:
+                keys.extend(engine.keys())
+        return keys
+
+    def items(self):
+        items = []
+        for shard in self._shards:
+            with shard as engine:
+                items.extend(engine.items())
+        return items
+
+    def entries(self):
+        entries = []
+        for shard in self._shards:
+            with shard as engine:
+                entries.extend(engine.entries())
+        return entries
+
+    def scan(self, cursor=0, count=None, prefix=None):
+        """Returns the ScanPage of up to `count` entries from the cursor,
+        without copying the whole storage.
+        """
+        return ScanPage(self, cursor, count, prefix)
+
+    @property
+    def policy(self):
+        return self._shards[0].engine.policy
+
+    @property
+    def bytes_used(self):
+        return sum(shard.engine.bytes_used for shard in self._shards)
+
+    def stats(self):
+        totals = dict.fromkeys(self.COUNTERS, 0)
+        contention = []
+        for shard in self._shards:
+            with shard as engine:
+                stats = engine.stats()
+            for name in self.COUNTERS:
+                totals[name] += stats[name]
+            contention.append({
+                "keys": stats["keys"],
+                "acquisitions": shard.acquisitions,
+                "contended": shard.contended,
+                "wait_ms": shard.wait_time * 1000,
+            })
+        lookups = totals["hits"] + totals["misses"]
+        acquisitions = sum(shard["acquisitions"] for shard in contention)
+        contended = sum(shard["contended"] for shard in contention)
+        totals.update({
+            "max_bytes": self.max_bytes,
+            "policy": type(self.policy).__name__,
+            "hit_rate": totals["hits"] / lookups if lookups else None,
+            "shards": len(self._shards),
+            "contention_rate": contended / acquisitions if acquisitions else None,
+            "contention": contention,
+        })
+        return totals
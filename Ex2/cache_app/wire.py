@@ -0,0 +1,478 @@
+import itertools
+import json
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from .datanode import DataNodeClient
+
+# a frame is a header followed by `length` payload bytes; the request id
+# pairs a response with its request, so that many requests are in flight
+# on a single connection and are answered in any order
+HEADER = struct.Struct(">IIB")
+# sanity bound of a payload, a larger length means a corrupted stream
+MAX_PAYLOAD = 256 << 20
+
+# request opcodes
+SET_REPLICA = 1
+SET_REPLICAS = 2
+GET = 3
+GET_MANY = 4
+HANDOFF = 5
+
+# response statuses
+OK = 0
+ERROR = 1
+
+# value tags: strings and bytes travel as their raw bytes, numbers in
+# binary, other JSON values as JSON
+NONE, STR, BYTES, INT, FLOAT, TRUE, FALSE, JSON = range(8)
+
+U32 = struct.Struct(">I")
+I64 = struct.Struct(">q")
+F64 = struct.Struct(">d")
+TAG = struct.Struct(">B")
+
+# failures worth retrying on another attempt, the builtin exceptions
+# and not the ones of the HTTP client
+RETRY_EXCEPTIONS = (ConnectionError, TimeoutError)
+
+
+class PeerError(Exception):
+    """The peer failed to process the request."""
+
+
+def write_bytes(buf, data):
+    buf += U32.pack(len(data))
+    buf += data
+
+
+def write_str(buf, s):
+    write_bytes(buf, s.encode())
+
+
+def write_value(buf, value):
+    if value is None:
+        buf += TAG.pack(NONE)
+    elif isinstance(value, str):
+        buf += TAG.pack(STR)
+        write_str(buf, value)
+    elif isinstance(value, bytes):
+        buf += TAG.pack(BYTES)
+        write_bytes(buf, value)
+    elif value is True or value is False:
+        buf += TAG.pack(TRUE if value else FALSE)
+    elif isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+        buf += TAG.pack(INT)
+        buf += I64.pack(value)
+    elif isinstance(value, float):
+        buf += TAG.pack(FLOAT)
+        buf += F64.pack(value)
+    else:
+        buf += TAG.pack(JSON)
+        write_str(buf, json.dumps(value, separators=(',', ':')))
+
+
+def write_entry(buf, key, value, expires_at):
+    write_str(buf, key)
+    write_value(buf, value)
+    # NaN stands for no expiration
+    buf += F64.pack(float('nan') if expires_at is None else expires_at)
+
+
+def write_entries(buf, entries):
+    """:param entries: list of {'key', 'value', 'expires_at'} dicts."""
+    buf += U32.pack(len(entries))
+    for entry in entries:
+        write_entry(buf, entry['key'], entry['value'], entry.get('expires_at'))
+
+
+def write_replica(buf, key, value, expires_at, written_at):
+    """An entry followed by the time the coordinator took the write."""
+    write_entry(buf, key, value, expires_at)
+    buf += F64.pack(float('nan') if written_at is None else written_at)
+
+
+def write_replicas(buf, entries):
+    """:param entries: list of {'key', 'value', 'expires_at', 'written_at'} dicts."""
+    buf += U32.pack(len(entries))
+    for entry in entries:
+        write_replica(buf, entry['key'], entry['value'], entry.get('expires_at'), entry.get('written_at'))
+
+
+class Reader:
+    """Decode the fields of a payload in the order they were written."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values[0]
+
+    def bytes(self):
+        size = self.unpack(U32)
+        data = bytes(self.data[self.offset:self.offset + size])
+        self.offset += size
+        return data
+
+    def str(self):
+        return self.bytes().decode()
+
+    def value(self):
+        tag = self.unpack(TAG)
+        if tag == NONE:
+            return None
+        if tag == STR:
+            return self.str()
+        if tag == BYTES:
+            return self.bytes()
+        if tag == TRUE or tag == FALSE:
+            return tag == TRUE
+        if tag == INT:
+            return self.unpack(I64)
+        if tag == FLOAT:
+            return self.unpack(F64)
+        if tag == JSON:
+            return json.loads(self.str())
+        raise ValueError(f"unknown value tag {tag}")
+
+    def timestamp(self):
+        # NaN stands for a missing time
+        timestamp = self.unpack(F64)
+        return None if timestamp != timestamp else timestamp
+
+    def expires_at(self):
+        return self.timestamp()
+
+    def entry(self):
+        key = self.str()
+        value = self.value()
+        return {'key': key, 'value': value, 'expires_at': self.expires_at()}
+
+    def entries(self):
+        return [self.entry() for _ in range(self.unpack(U32))]
+
+    def replica(self):
+        entry = self.entry()
+        entry['written_at'] = self.timestamp()
+        return entry
+
+    def replicas(self):
+        return [self.replica() for _ in range(self.unpack(U32))]
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by the peer")
+        data += chunk
+    return data
+
+
+def read_frame(sock):
+    """Returns the (request id, opcode or status, payload) of the next frame."""
+    length, request_id, code = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise ConnectionError(f"frame of {length} bytes exceeds the limit")
+    return request_id, code, recv_exactly(sock, length) if length else b''
+
+
+class BinaryConnection:
+    """A persistent TCP connection to a peer, shared by all the threads
+    calling it: each request is sent as soon as it is made and a reader
+    thread hands the responses to their callers.
+    """
+
+    def __init__(self, address, connect_timeout):
+        try:
+            self.sock = socket.create_connection(address, connect_timeout)
+        except OSError as e:
+            raise ConnectionError(f"cannot connect to {address}: {e}") from e
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._ids = itertools.count(1)
+        # request id -> future of the (status, payload) response
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        threading.Thread(target=self._read_responses, name='binary-peer', daemon=True).start()
+
+    def call(self, opcode, payload, timeout):
+        """Returns the payload of the response, raises PeerError when the
+        peer failed to process the request.
+        """
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            request_id = next(self._ids) & 0xFFFFFFFF
+            self._pending[request_id] = future
+            self.requests += 1
+        frame = HEADER.pack(len(payload), request_id, opcode) + payload
+        try:
+            with self._send_lock:
+                self.sock.sendall(frame)
+        except OSError as e:
+            self.close(e)
+            raise ConnectionError(f"send failed: {e}") from e
+        self.bytes_sent += len(frame)
+        try:
+            status, body = future.result(timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(f"no response after {timeout}s")
+        if status != OK:
+            raise PeerError(bytes(body).decode())
+        return body
+
+    def _read_responses(self):
+        try:
+            while True:
+                request_id, status, body = read_frame(self.sock)
+                self.bytes_received += HEADER.size + len(body)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                # None when the caller timed out
+                if future is not None:
+                    future.set_result((status, body))
+        except (OSError, struct.error) as e:
+            self.close(e)
+
+    def close(self, error=None):
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError(f"connection lost: {error}"))
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def binary_address(private_dns, port_offset, default_port):
+    """Returns the (host, port) of the binary listener of a peer, listening
+    `port_offset` ports above its HTTP port.
+    """
+    host, _, port = private_dns.partition(':')
+    return host, (int(port) if port else default_port) + port_offset
+
+
+class BinaryDataNodeClient(DataNodeClient):
+    """Peer client sending the replica reads and writes, the batches and the
+    handoff chunks as binary frames over a single persistent connection per
+    peer. The other, rare, requests still go through HTTP.
+    """
+
+    def __init__(self, port_offset=1000, **kwargs):
+        """
+        :param port_offset: the binary listener of a node is on its HTTP
+                            port + port_offset.
+        """
+        super().__init__(**kwargs)
+        self.port_offset = port_offset
+        # private dns -> BinaryConnection
+        self._connections = {}
+        self.connects = 0
+
+    def _connection(self, private_dns):
+        connection = self._connections.get(private_dns)
+        if connection is None or connection.closed:
+            with self._lock:
+                connection = self._connections.get(private_dns)
+                if connection is None or connection.closed:
+                    address = binary_address(private_dns, self.port_offset, self.default_port)
+                    connection = BinaryConnection(address, self.timeout[0])
+                    self._connections[private_dns] = connection
+                    self.connects += 1
+        return connection
+
+    def _call(self, private_dns, opcode, payload=b''):
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.monotonic()
+                body = self._connection(private_dns).call(opcode, bytes(payload), self.timeout[1])
+                self._record_latency(private_dns, time.monotonic() - start)
+                return Reader(body)
+            except RETRY_EXCEPTIONS:
+                if attempt == self.retries:
+                    self.failures += 1
+                    self._failed_at[private_dns] = time.monotonic()
+                    raise
+            self.retried += 1
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def set_replica(self, private_dns, key, value, expires_at=None, written_at=None):
+        buf = bytearray()
+        write_replica(buf, key, value, expires_at, written_at)
+        self._call(private_dns, SET_REPLICA, buf)
+
+    def set_replicas(self, private_dns, entries):
+        buf = bytearray()
+        write_replicas(buf, entries)
+        self._call(private_dns, SET_REPLICAS, buf)
+
+    def get(self, private_dns, key, subscriber=None):
+        buf = bytearray()
+        write_str(buf, key)
+        write_str(buf, subscriber or '')
+        return self._call(private_dns, GET, buf).value()
+
+    def get_many(self, private_dns, keys):
+        buf = bytearray(U32.pack(len(keys)))
+        for key in keys:
+            write_str(buf, key)
+        reader = self._call(private_dns, GET_MANY, buf)
+        return {reader.str(): reader.value() for _ in range(reader.unpack(U32))}
+
+    def handoff(self, private_dns, entries):
+        buf = bytearray()
+        write_entries(buf, entries)
+        self._call(private_dns, HANDOFF, buf)
+
+    def evict(self, private_dns):
+        with self._lock:
+            connection = self._connections.pop(private_dns, None)
+        if connection is not None:
+            connection.close()
+        super().evict(private_dns)
+
+    def close(self):
+        for private_dns in set(self._sessions).union(self._connections):
+            self.evict(private_dns)
+
+    def stats(self):
+        stats = super().stats()
+        stats['protocol'] = 'binary'
+        stats['binary_connections_opened'] = self.connects
+        stats['binary_peers'] = {
+            private_dns: {
+                'requests': connection.requests,
+                'bytes_sent': connection.bytes_sent,
+                'bytes_received': connection.bytes_received,
+                'in_flight': len(connection._pending),
+            }
+            for private_dns, connection in list(self._connections.items())
+        }
+        return stats
+
+
+def _set_replica(coordinator, reader):
+    entry = reader.replica()
+    coordinator.set_replica(entry['key'], entry['value'], entry['expires_at'], entry['written_at'])
+
+
+def _set_replicas(coordinator, reader):
+    coordinator.set_replicas(reader.replicas())
+
+
+def _get(coordinator, reader, buf):
+    key = reader.str()
+    write_value(buf, coordinator.get_replica(key, reader.str() or None))
+
+
+def _get_many(coordinator, reader, buf):
+    values = coordinator.get_replicas([reader.str() for _ in range(reader.unpack(U32))])
+    buf += U32.pack(len(values))
+    for key, value in values.items():
+        write_str(buf, key)
+        write_value(buf, value)
+
+
+def _handoff(coordinator, reader):
+    coordinator.receive_handoff(reader.entries())
+
+
+# opcode -> handler(coordinator, reader[, response buffer])
+HANDLERS = {
+    SET_REPLICA: _set_replica,
+    SET_REPLICAS: _set_replicas,
+    GET: _get,
+    GET_MANY: _get_many,
+    HANDOFF: _handoff,
+}
+RESPONDING = {GET, GET_MANY}
+
+
+class BinaryServer(socketserver.ThreadingTCPServer):
+    """Serve the binary requests of the peers to a CacheCoordinator.
+
+    A connection is read by its own thread, its requests are processed by
+    a shared pool and answered as soon as they complete.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, coordinator, address, workers=32):
+        """
+        :param address: the (host, port) to listen on.
+        :param workers: maximum number of requests processed at once.
+        """
+        self.coordinator = coordinator
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='binary')
+        self.requests = 0
+        self.errors = 0
+        super().__init__(address, BinaryRequestHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='binary-server', daemon=True).start()
+
+    def process(self, opcode, payload):
+        """Returns the (status, payload) of the response to a request."""
+        self.requests += 1
+        handler = HANDLERS.get(opcode)
+        if handler is None:
+            self.errors += 1
+            return ERROR, f"unknown opcode {opcode}".encode()
+        buf = bytearray()
+        try:
+            if opcode in RESPONDING:
+                handler(self.coordinator, Reader(payload), buf)
+            else:
+                handler(self.coordinator, Reader(payload))
+        except Exception as e:
+            self.errors += 1
+            return ERROR, f"{type(e).__name__}: {e}".encode()
+        return OK, buf
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors}
+
+
+class BinaryRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_lock = threading.Lock()
+
+        def respond(request_id, future):
+            status, body = future.result()
+            try:
+                with send_lock:
+                    self.request.sendall(HEADER.pack(len(body), request_id, status) + body)
+            except OSError:
+                pass
+
+        while True:
+            try:
+                request_id, opcode, payload = read_frame(self.request)
+            except (OSError, struct.error):
+                return
+            future = self.server.executor.submit(self.server.process, opcode, payload)
+            future.add_done_callback(lambda future, request_id=request_id: respond(request_id, future))
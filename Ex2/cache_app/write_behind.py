@@ -0,0 +1,255 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class WriteBehindFull(Exception):
+    pass
+
+
+class PeerQueue:
+    """The replica writes waiting to be sent to one peer."""
+
+    def __init__(self, private_dns):
+        self.private_dns = private_dns
+        # key -> (value, expires_at, written_at, queued_at), in queuing order
+        self.pending = OrderedDict()
+        # signals the writes queued, sent and flush requests
+        self.changed = threading.Condition()
+        # the size of the batch being sent and the queuing time of its
+        # oldest write
+        self.in_flight = 0
+        self.in_flight_since = None
+        # set once the peer left the ring, stops its flusher
+        self.evicted = False
+
+    def lag(self, now):
+        """Returns the seconds the oldest unsent write of the peer waited."""
+        oldest = self.in_flight_since
+        if oldest is None and self.pending:
+            oldest = next(iter(self.pending.values()))[3]
+        return now - oldest if oldest is not None else 0.0
+
+
+class WriteBehind:
+    """Sends the replica writes to the peers in the background, in one
+    batched request per peer instead of one request per write.
+
+    The batch of a peer is sent once it holds `batch_size` keys or its
+    oldest write waited `flush_interval` seconds. A key written again
+    before its batch is sent is sent once, with its last value. Each peer
+    gets its batches in order, from its own flusher thread.
+    """
+
+    def __init__(self, client, batch_size=100, flush_interval=0.01, max_pending=10000,
+                 block_timeout=1.0, flush_timeout=10.0, lag_alpha=0.2):
+        """
+        :param client: the DataNodeClient sending the batches.
+        :param batch_size: the number of keys of a full batch.
+        :param flush_interval: seconds a write waits for its batch to fill.
+        :param max_pending: the number of keys a peer may have waiting,
+                            the writers then block until the peer catches up.
+        :param block_timeout: seconds a writer blocks on a full queue before
+                              WriteBehindFull is raised.
+        :param flush_timeout: seconds flush() waits for the queues to empty.
+        :param lag_alpha: weight of the last batch in the replication lag EWMA.
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self.flush_timeout = flush_timeout
+        self.lag_alpha = lag_alpha
+
+        # private dns -> PeerQueue
+        self._queues = {}
+        self._lock = threading.Lock()
+        # flushers send their batches right away while above 0
+        self._flushing = 0
+        self.closed = False
+
+        self.queued_writes = 0
+        self.collapsed_writes = 0
+        self.blocked_writes = 0
+        self.rejected_writes = 0
+        self.flushed_batches = 0
+        self.flushed_writes = 0
+        self.failed_batches = 0
+        self.failed_writes = 0
+        self.lag_ewma = None
+        self.max_lag = 0.0
+
+    def _queue(self, private_dns):
+        queue = self._queues.get(private_dns)
+        if queue is None:
+            with self._lock:
+                queue = self._queues.get(private_dns)
+                if queue is None:
+                    queue = self._queues[private_dns] = PeerQueue(private_dns)
+                    threading.Thread(
+                        target=self._flush_loop, args=(queue,),
+                        name=f'write-behind-{private_dns}', daemon=True,
+                    ).start()
+        return queue
+
+    def enqueue(self, private_dns, entries):
+        """Queue replica writes to the peer, blocking while its queue is
+        full. Raises WriteBehindFull when it stays full for `block_timeout`
+        seconds, the writes queued until then are still sent.
+        :param entries: list of (key, value, expires_at, written_at) tuples.
+        """
+        if self.closed:
+            raise WriteBehindFull("the write-behind queues are closed")
+        queue = self._queue(private_dns)
+        deadline = None
+        with queue.changed:
+            for key, value, expires_at, written_at in entries:
+                previous = queue.pending.get(key)
+                if previous is not None:
+                    # keeps the position and the queuing time of the first write
+                    queue.pending[key] = (value, expires_at, written_at, previous[3])
+                    self.collapsed_writes += 1
+                    continue
+                while len(queue.pending) >= self.max_pending:
+                    if deadline is None:
+                        deadline = time.monotonic() + self.block_timeout
+                        self.blocked_writes += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_writes += 1
+                        queue.changed.notify_all()
+                        raise WriteBehindFull(
+                            f"{len(queue.pending)} writes are waiting for {private_dns}")
+                    queue.changed.wait(remaining)
+                queue.pending[key] = (value, expires_at, written_at, time.monotonic())
+                self.queued_writes += 1
+            queue.changed.notify_all()
+
+    def _next_batch(self, queue):
+        """Wait for a batch of the queue to be due, under its condition."""
+        while True:
+            if queue.evicted:
+                queue.pending.clear()
+                return None
+            if queue.pending:
+                if len(queue.pending) >= self.batch_size or self._flushing or self.closed:
+                    break
+                oldest = next(iter(queue.pending.values()))[3]
+                timeout = oldest + self.flush_interval - time.monotonic()
+                if timeout <= 0:
+                    break
+            elif self.closed:
+                return None
+            else:
+                timeout = None
+            queue.changed.wait(timeout)
+        batch = []
+        while queue.pending and len(batch) < self.batch_size:
+            batch.append(queue.pending.popitem(last=False))
+        queue.in_flight = len(batch)
+        queue.in_flight_since = batch[0][1][3]
+        # room for the blocked writers
+        queue.changed.notify_all()
+        return batch
+
+    def _flush_loop(self, queue):
+        while True:
+            with queue.changed:
+                batch = self._next_batch(queue)
+            if batch is None:
+                return
+            self._send(queue, batch)
+            with queue.changed:
+                queue.in_flight = 0
+                queue.in_flight_since = None
+                queue.changed.notify_all()
+
+    def _send(self, queue, batch):
+        entries = [
+            {'key': key, 'value': value, 'expires_at': expires_at, 'written_at': written_at}
+            for key, (value, expires_at, written_at, _) in batch
+        ]
+        try:
+            self.client.set_replicas(queue.private_dns, entries)
+        except Exception:
+            # anti-entropy repairs the replicas that missed the batch
+            self.failed_batches += 1
+            self.failed_writes += len(batch)
+            return
+        lag = time.monotonic() - queue.in_flight_since
+        self.flushed_batches += 1
+        self.flushed_writes += len(batch)
+        self.max_lag = max(self.max_lag, lag)
+        if self.lag_ewma is None:
+            self.lag_ewma = lag
+        else:
+            self.lag_ewma += self.lag_alpha * (lag - self.lag_ewma)
+
+    def flush(self, timeout=None):
+        """Send all the queued writes now. Returns whether the queues were
+        emptied within `timeout` seconds, `flush_timeout` by default.
+        """
+        deadline = time.monotonic() + (self.flush_timeout if timeout is None else timeout)
+        with self._lock:
+            self._flushing += 1
+        try:
+            for queue in list(self._queues.values()):
+                with queue.changed:
+                    queue.changed.notify_all()
+                    while queue.pending or queue.in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        queue.changed.wait(remaining)
+            return True
+        finally:
+            with self._lock:
+                self._flushing -= 1
+
+    def close(self, timeout=None):
+        """Refuse new writes and send the queued ones, e.g. on shutdown."""
+        self.closed = True
+        return self.flush(timeout)
+
+    def evict(self, private_dns):
+        """Drop the queue of a peer that left the ring, its keys were
+        streamed to their new replicas.
+        """
+        with self._lock:
+            queue = self._queues.pop(private_dns, None)
+        if queue is not None:
+            with queue.changed:
+                queue.evicted = True
+                queue.pending.clear()
+                queue.changed.notify_all()
+
+    def stats(self):
+        now = time.monotonic()
+        peers = {}
+        for private_dns, queue in list(self._queues.items()):
+            with queue.changed:
+                peers[private_dns] = {
+                    'pending': len(queue.pending),
+                    'in_flight': queue.in_flight,
+                    'lag_ms': queue.lag(now) * 1000,
+                }
+        return {
+            'batch_size': self.batch_size,
+            'flush_interval_ms': self.flush_interval * 1000,
+            'max_pending': self.max_pending,
+            'queue_depth': sum(peer['pending'] + peer['in_flight'] for peer in peers.values()),
+            'replication_lag_ms': max((peer['lag_ms'] for peer in peers.values()), default=0.0),
+            'lag_ewma_ms': (self.lag_ewma or 0) * 1000,
+            'max_lag_ms': self.max_lag * 1000,
+            'peers': peers,
+            'queued_writes': self.queued_writes,
+            'collapsed_writes': self.collapsed_writes,
+            'blocked_writes': self.blocked_writes,
+            'rejected_writes': self.rejected_writes,
+            'flushed_batches': self.flushed_batches,
+            'flushed_writes': self.flushed_writes,
+            'mean_batch_size': self.flushed_writes / self.flushed_batches if self.flushed_batches else None,
+            'failed_batches': self.failed_batches,
+            'failed_writes': self.failed_writes,
+        }
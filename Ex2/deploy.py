@@ -1,5 +1,8 @@
 import base64
+import json
 import sys
+import time
+import urllib.request
 
 import boto3
 from botocore import exceptions
@@ -22,6 +25,8 @@ sudo apt-get install --yes --allow-unauthenticated awscli virtualenv python3-pip
               
 aws s3api get-object --bucket idc-ex2-cache-app-bucket --key cache_app.zip cache_app.zip
 export INSTANCE_ID=$(curl http://169.254.169.254/latest/meta-data/instance-id)
+# the keys survive restarts of the node
+export PERSIST_DIR=/var/lib/cache-node
 unzip cache_app.zip
 
 python3 -m venv cache-app-env
@@ -29,8 +34,9 @@ source cache-app-env/bin/activate
 
 cd cache_app
 pip install -r requirements.txt
+cd ..
 
-flask run --port=8080 --host=0.0.0.0 
+gunicorn --config cache_app/gunicorn.conf.py cache_app.app:app
 echo "Cache node up" > /home/ubuntu/cache_node  
 """
 
@@ -76,6 +82,13 @@ def init_security_groups(vpc_id):
         ToPort=8080,
         IpProtocol="TCP",
     )
+    # binary protocol between the nodes, see PEER_PROTOCOL
+    instance_sg.authorize_ingress(
+        CidrIp=cidr_block,
+        FromPort=9080,
+        ToPort=9080,
+        IpProtocol="TCP",
+    )
     return {
         "elb-access": elb["GroupId"],
         "instance-access": instances["GroupId"]
@@ -223,8 +236,51 @@ def provision_cache_node():
     register_instance_in_elb(instance_id)
 
 
-def kill_cache_node(instance_id):
-    pass
+def get_private_dns(instance_id):
+    response = ec2.describe_instances(InstanceIds=[instance_id])
+    return response["Reservations"][0]["Instances"][0].get("PrivateDnsName")
+
+
+def drain_cache_node(private_dns, start=False):
+    # the nodes refuse the drain requests coming through the load balancer,
+    # the node is called on its private address, from a host of the vpc
+    req = urllib.request.Request(
+        f"http://{private_dns}:8080/drain",
+        method="POST" if start else "GET")
+    with urllib.request.urlopen(req, timeout=30) as res:
+        return json.load(res)
+
+
+def kill_cache_node(instance_id, poll_interval=2):
+    private_dns = get_private_dns(instance_id)
+    if not private_dns:
+        print(f"{instance_id} has no private address, the node is kept")
+        sys.exit(1)
+    # stream the keys of the node to their new replicas before it leaves
+    progress = drain_cache_node(private_dns, start=True)
+    while progress["state"] == "draining":
+        time.sleep(poll_interval)
+        progress = drain_cache_node(private_dns)
+        print("Draining {}: {}/{} entries, {:.1f} keys/s, {:.2f} MB/s".format(
+            instance_id, progress["sent_entries"], progress["total_entries"],
+            progress["keys_per_second"] or 0, progress["mb_per_second"] or 0))
+    if progress["state"] != "drained":
+        print(f"Drain of {instance_id} failed, the node is kept: {progress['error']}")
+        sys.exit(1)
+    print("Drained {} entries ({} bytes) in {:.1f}s".format(
+        progress["sent_entries"], progress["sent_bytes"], progress["elapsed"]))
+
+    target_group = elb.describe_target_groups(Names=[PREFIX + "-tg"])
+    target_group_arn = target_group["TargetGroups"][0]["TargetGroupArn"]
+    elb.deregister_targets(
+        TargetGroupArn=target_group_arn,
+        Targets=[{
+            "Id": instance_id,
+            "Port": 8080
+        }]
+    )
+    ec2.terminate_instances(InstanceIds=[instance_id])
+    print(f"Terminated {instance_id}")
 
 
 if __name__ == "__main__":
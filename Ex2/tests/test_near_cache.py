@@ -0,0 +1,22 @@
+from cache_app.near_cache import NearCache
+
+
+def test_invalidation_of_another_key_does_not_block_a_fill():
+    cache = NearCache(1 << 20)
+    generation = cache.fetching("a")
+    cache.invalidate(["b"])
+    cache.fill("a", "value", generation)
+    assert cache.get("a") == "value"
+
+
+def test_invalidation_during_a_fetch_blocks_its_fill():
+    cache = NearCache(1 << 20)
+    generation = cache.fetching("a")
+    cache.invalidate(["a"])
+    cache.fill("a", "stale", generation)
+    assert cache.get("a") is None
+
+    # the next fetch fills it, and no fetch is tracked once all ended
+    cache.fill("a", "fresh", cache.fetching("a"))
+    assert cache.get("a") == "fresh"
+    assert not cache._fetches
@@ -0,0 +1,47 @@
+import os
+from unittest import mock
+
+import pytest
+
+from cache_app import persistence
+from cache_app.persistence import PersistentStorage
+
+
+def test_int_key_is_refused_before_any_change(tmp_path):
+    storage = PersistentStorage(str(tmp_path), fsync="no")
+    storage.set("5", "str")
+    records = storage.log.records
+    with pytest.raises(TypeError):
+        storage.set(5, "int")
+    with pytest.raises(TypeError):
+        storage.delete(5)
+    assert 5 not in storage
+    assert storage.log.records == records
+    # the log and the compaction are unaffected
+    assert storage.compact()
+    storage.close()
+
+    restarted = PersistentStorage(str(tmp_path), fsync="no")
+    assert restarted.get("5") == "str"
+    assert restarted.get(5) is None
+    restarted.close()
+
+
+def test_failed_compaction_keeps_the_generation(tmp_path):
+    storage = PersistentStorage(str(tmp_path), fsync="no")
+    for i in range(100):
+        storage.set(f"k{i}", i)
+    generation = storage.generation
+    with mock.patch.object(persistence, "_write_snapshot", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            storage.compact()
+    assert storage.generation == generation
+    assert sorted(os.listdir(tmp_path)) == [f"log.{generation:08d}"]
+    storage.set("after", 1)
+    assert storage.compact()
+    storage.close()
+
+    restarted = PersistentStorage(str(tmp_path), fsync="no")
+    assert restarted.get("k99") == 99
+    assert restarted.get("after") == 1
+    restarted.close()
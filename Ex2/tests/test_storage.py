@@ -0,0 +1,82 @@
+import time
+
+from cache_app.storage import ShardedStorage, StorageEngine, entry_size
+
+
+def scan_all(storage, count, write=None):
+    keys, cursor, pages = [], 0, 0
+    while True:
+        page = storage.scan(cursor, count)
+        keys.extend(key for key, _, _ in page)
+        cursor, pages = page.cursor, pages + 1
+        if write is not None:
+            write(pages)
+        if cursor == 0:
+            return keys, pages
+
+
+def test_large_shard_scans_to_the_end_in_linear_time():
+    storage = ShardedStorage(shards=1)
+    for i in range(200000):
+        storage.set(f"k{i}", i)
+
+    started = time.perf_counter()
+    keys, pages = scan_all(storage, 100)
+    elapsed = time.perf_counter() - started
+    assert pages == 2000
+    assert sorted(keys) == sorted(f"k{i}" for i in range(200000))
+    # re-sorting the shard on every page took minutes
+    assert elapsed < 10
+
+
+def test_scan_returns_the_kept_keys_once_across_writes():
+    storage = ShardedStorage(shards=4)
+    for i in range(20000):
+        storage.set(f"k{i}", i)
+
+    def write(page):
+        # new keys, updates and deletes between the pages
+        for i in range(page * 10, page * 10 + 10):
+            storage.set(f"new{i}", i)
+            storage.set(f"k{i + 10000}", -i)
+            storage.delete(f"k{i}")
+
+    keys, _ = scan_all(storage, 50, write)
+    kept = {f"k{i}" for i in range(5000, 20000)}
+    assert len(keys) == len(set(keys))
+    assert kept <= set(keys)
+
+
+def tinylfu_engine(first):
+    """Returns a tinylfu engine holding 10 entries, the first one written
+    once, then the 9 others written 5 times each.
+    """
+    engine = StorageEngine(max_bytes=entry_size("k0", "x" * 100) * 10 + 64, policy="tinylfu")
+    engine.set(first, "x" * 100)
+    for i in range(1, 10):
+        for _ in range(5):
+            engine.set(f"k{i}", "x" * 100)
+    return engine
+
+
+def test_tinylfu_keeps_an_update_of_a_rare_key():
+    engine = tinylfu_engine("rare")
+    # the victims are more frequent than the key, an update is kept anyway
+    assert engine.set("rare", "y" * 300)
+    assert engine.get("rare") == "y" * 300
+
+
+def test_tinylfu_admission_is_decided_before_evicting():
+    engine = tinylfu_engine("cold")
+    for _ in range(3):
+        engine.get("new")
+    # more frequent than the first victim only, admitted against it
+    assert engine.set("new", "x" * 300)
+    assert engine.get("new") == "x" * 300
+    assert "cold" not in engine
+
+    engine = tinylfu_engine("cold")
+    keys = set(engine.keys())
+    # a rare key is rejected without evicting anything
+    assert not engine.set("other", "x" * 300)
+    assert set(engine.keys()) == keys